@@ -0,0 +1,46 @@
+"""Benchmark: memory held per session slate by RamStorage, and the cost of
+loading one, for a typical logged in session (an 'auth' dict).
+
+Memory is measured as the growth in the process' peak RSS while the
+sessions are created, so run it on its own.
+
+Usage: python benchmarks/ram_memory.py [sessions]
+"""
+
+from __future__ import print_function
+
+import datetime
+import os
+import resource
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from lg_authority.slates.storage import get_storage_class
+
+def main(sessions):
+    cls = get_storage_class('ram')
+    cls.setup({})
+    authtime = datetime.datetime.utcnow()
+
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    for i in range(sessions):
+        cls('session', 's' + str(i), 3600).set('auth', {
+            'name': 'user' + str(i), 'groups': [ 'admin', 'editors' ]
+            , 'authtime': authtime
+            })
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #ru_maxrss is in kilobytes on Linux
+    print('{0} sessions: {1:.0f} bytes per session'.format(
+        sessions, (after - before) * 1024.0 / sessions
+        ))
+
+    def load():
+        cls('session', 's1', 3600).get('auth', None)
+    iterations = 100000
+    t = min(timeit.repeat(load, number=iterations, repeat=3))
+    print('{0:.2f} us per load'.format(t / iterations * 1e6))
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
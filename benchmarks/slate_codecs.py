@@ -0,0 +1,78 @@
+"""Benchmark: encode/decode time and encoded size of each slate value codec
+for a typical session 'auth' dict (see AuthInterface.login), and of
+pickle with and without compression for a large user 'auth_token' list.
+
+Usage: python benchmarks/slate_codecs.py [iterations]
+"""
+
+from __future__ import print_function
+
+import datetime
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from lg_authority.slates.storage import codec
+
+def session_auth():
+    now = datetime.datetime.utcnow()
+    return {
+        '__id__': 'f3c2a1b4d5e6478899aabbccddeeff00'
+        ,'__name__': 'someuser'
+        ,'name': 'someuser'
+        ,'groups': [ 'admin', 'editors' ]
+        ,'emails': [ 'someuser@example.com' ]
+        ,'auth_openid': []
+        ,'auth_password': { 
+            'date': now
+            ,'pass': [ 'sha256', [ 'bff74028f285748241375d1c9c7f9b6e85fd3900edf8e601a78f7f84d848b42e', 'someuser' ] ]
+            }
+        ,'authtime': now
+        ,'authtime_admin': now
+        }
+
+def user_tokens():
+    now = datetime.datetime.utcnow()
+    return [ 
+        { 'token': '{0:032x}'.format(i * 7919), 'name': 'api', 'date': now }
+        for i in range(100)
+        ]
+
+def time_value(label, c, value, iterations, compress_threshold=None):
+    data = codec.encode(c, value, compress_threshold)
+    enc = min(timeit.repeat(
+        lambda: codec.encode(c, value, compress_threshold)
+        , number=iterations, repeat=3))
+    dec = min(timeit.repeat(lambda: codec.decode(data)
+        , number=iterations, repeat=3))
+    print('{0}: {1} bytes, encode {2:.2f} us, decode {3:.2f} us'.format(
+        label, len(data)
+        , enc / iterations * 1e6, dec / iterations * 1e6
+        ))
+
+def main(iterations):
+    value = session_auth()
+    for name in sorted(codec.codec_classes.keys()):
+        try:
+            c = codec.get_codec(name)
+        except ImportError:
+            print('{0}: not installed'.format(name))
+            continue
+        data = codec.encode(c, value)
+        if ord(data[:1]) != c.tag:
+            print('{0}: cannot encode value (falls back to pickle)'.format(
+                name
+                ))
+            continue
+        time_value(name, c, value, iterations)
+
+    tokens = user_tokens()
+    c = codec.get_codec('pickle')
+    time_value('auth_token list', c, tokens, iterations // 10)
+    time_value('auth_token list, compressed', c, tokens, iterations // 10
+        , compress_threshold=1024)
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
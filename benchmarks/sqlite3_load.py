@@ -0,0 +1,59 @@
+"""Benchmark: cold loads of a session slate from Sqlite3Storage, i.e.
+constructing storage for an existing slate and reading one key, as
+Session.__init__ does at the start of every request.
+
+"all keys" loads a section with no cache list (every key fetched on first
+access); "cache list" loads a section that prefetches only 'auth';
+"document layout" loads a section stored one row per slate.
+
+Usage: python benchmarks/sqlite3_load.py [iterations]
+"""
+
+from __future__ import print_function
+
+import datetime
+import os
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import lg_authority
+from lg_authority.slates.storage import get_storage_class
+
+def main(iterations):
+    dbFile = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    cls = get_storage_class('sqlite3')
+    cls.setup({ 'file': dbFile })
+    lg_authority.common.config['site_storage_sections_cached'] = {
+        'cache': [ 'auth' ]
+        }
+    lg_authority.common.config['site_storage_sections_document'] = {
+        'layout': 'document'
+        }
+
+    value = {
+        'auth': { 'name': 'someuser', 'groups': [ 'admin', 'editors' ]
+            , 'authtime': datetime.datetime.utcnow() }
+        ,'cart': [ 'item' + str(i) for i in range(10) ]
+        ,'flash': 'Saved'
+        ,'prefs': { 'theme': 'dark', 'page_size': 50 }
+        ,'last_page': '/admin/users'
+        }
+    for section in [ 'session', 'cached', 'document' ]:
+        cls(section, 'existing', 3600).update(value)
+
+    def load(section):
+        cls(section, 'existing', 3600).get('auth', None)
+
+    for name, section in [ ('all keys', 'session'), ('cache list', 'cached')
+        , ('document layout', 'document') ]:
+        t = min(timeit.repeat(lambda: load(section)
+            , number=iterations, repeat=3))
+        print('{0}: {1:.2f} us per load'.format(
+            name, t / iterations * 1e6
+            ))
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
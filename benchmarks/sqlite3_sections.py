@@ -0,0 +1,42 @@
+"""Benchmark: cost of constructing Sqlite3Storage objects for a section that
+already exists on disk.
+
+"cold" clears the section registry before every construction, which is what
+every construction cost before sections found on disk were registered (one
+SQLite_Master query each).  "warm" is the current behavior.
+
+Usage: python benchmarks/sqlite3_sections.py [iterations]
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from lg_authority.slates.storage import get_storage_class
+
+def main(iterations):
+    dbFile = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    cls = get_storage_class('sqlite3')
+    cls.setup({ 'file': dbFile })
+    cls('session', 'existing', 60).touch()
+
+    def cold():
+        cls.storage_checked.clear()
+        cls('session', 'existing', {})
+
+    def warm():
+        cls('session', 'existing', {})
+
+    for name, fn in [ ('cold', cold), ('warm', warm) ]:
+        t = min(timeit.repeat(fn, number=iterations, repeat=3))
+        print('{0}: {1:.2f} us per construction'.format(
+            name, t / iterations * 1e6
+            ))
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
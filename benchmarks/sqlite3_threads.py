@@ -0,0 +1,87 @@
+"""Benchmark: session read/write throughput of Sqlite3Storage from several
+threads at once, as under CherryPy's worker thread pool (10 threads by
+default), for a few journal_mode / synchronous settings.
+
+Each thread repeatedly loads a random session slate and reads its 'auth'
+key; one operation in every write_every also writes to it.
+
+Usage: python benchmarks/sqlite3_threads.py [seconds] [threads] [write_every]
+"""
+
+from __future__ import print_function
+
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from lg_authority.slates.storage import get_storage_class
+
+SESSIONS = 1000
+
+CONFIGS = [
+    ('default', {})
+    ,('wal', { 'journal_mode': 'wal' })
+    ,('wal, synchronous=normal'
+        , { 'journal_mode': 'wal', 'synchronous': 'normal' })
+    ,('wal, synchronous=normal, mmap'
+        , { 'journal_mode': 'wal', 'synchronous': 'normal'
+            , 'mmap_size': 64 * 1024 * 1024, 'cache_size': -8000 })
+    ]
+
+def run(cls, seconds, threads, write_every):
+    counts = [ [ 0, 0 ] for i in range(threads) ]
+    stop = [ False ]
+
+    def worker(counter):
+        rand = random.Random()
+        n = 0
+        while not stop[0]:
+            store = cls('session', 's' + str(rand.randrange(SESSIONS)), 3600)
+            store.get('auth', None)
+            n += 1
+            if n % write_every == 0:
+                store.set('last', n)
+                counter[1] += 1
+            else:
+                counter[0] += 1
+
+    workers = [ threading.Thread(target=worker, args=(c,)) for c in counts ]
+    for w in workers:
+        w.start()
+    time.sleep(seconds)
+    stop[0] = True
+    for w in workers:
+        w.join()
+    return sum(c[0] for c in counts), sum(c[1] for c in counts)
+
+def main(seconds, threads, write_every):
+    cls = get_storage_class('sqlite3')
+    for name, conf in CONFIGS:
+        dbFile = os.path.join(tempfile.mkdtemp(), 'bench.db')
+        conf = dict(conf, file=dbFile)
+        cls.setup(conf)
+        for i in range(SESSIONS):
+            cls('session', 's' + str(i), 3600).update({
+                'auth': { 'name': 'user' + str(i), 'groups': [ 'a', 'b' ] }
+                })
+
+        reads, writes = run(cls, seconds, threads, write_every)
+        print('{0}: {1:.0f} reads/s, {2:.0f} writes/s'.format(
+            name, reads / seconds, writes / seconds
+            ))
+        stats = cls.pool.get_stats()
+        print('    pool: {0} connections, {1} checkouts, {2} waits'.format(
+            stats['opened'], stats['checkouts'], stats['waits']
+            ))
+
+if __name__ == '__main__':
+    main(
+        float(sys.argv[1]) if len(sys.argv) > 1 else 5.0
+        , int(sys.argv[2]) if len(sys.argv) > 2 else 10
+        , int(sys.argv[3]) if len(sys.argv) > 3 else 10
+        )
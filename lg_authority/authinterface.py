@@ -126,8 +126,9 @@ class AuthInterface(object):
 
         dataNew = data.copy()
         dataNew['name'] = userName
-        user.update(dataNew)
-        userNameSlate['userId'] = user.id
+        with Slate.batch():
+            user.update(dataNew)
+            userNameSlate['userId'] = user.id
         return user.id
        
     def user_create_holder(self, userName, data, timeout=None):
@@ -483,10 +484,11 @@ class AuthInterface(object):
             raise AuthError('User creation error')
 
         nameSlate.set_timeout(None)
-        user.update(uargs)
-        uid = user.id
-        nameSlate['userId'] = uid
-        del nameSlate['holder']
+        with Slate.batch():
+            user.update(uargs)
+            uid = user.id
+            nameSlate['userId'] = uid
+            del nameSlate['holder']
 
         return uid
 
@@ -59,10 +59,30 @@ config.update({
     #Just replace "_user" with "_{section name}" to set up config.
     #Most sections do not need any options, but if you want anything
     #indexed, or admin-editable, then this is where you specify it.
+    #Options:
+    #index_lists - Keys holding lists of strings, searchable with 
+    #    Slate.find_with and Slate.count_with.
+    #cache - Keys fetched when a slate is first accessed.  Other keys are
+    #    fetched one at a time when read (or all at once for items(), keys()
+    #    and values()).  If unset, every key is fetched on first access.
+    #layout - sqlite3 only.  'rows' (default) stores each key in its own row;
+    #    'document' stores the whole slate in one row.  See Sqlite3Storage.
+    #max_entries, max_bytes - ram only.  Caps on the number of slates and the
+    #    approximate bytes of their data; expired, then least recently used
+    #    slates are evicted to stay within them.  See RamStorage.
+    #cache_ttl - tiered only.  Seconds a slate is served from the in-process
+    #    cache before being read again.  See TieredStorage.
     ,
     'site_storage_clean_freq': 60
     #Minutes between cleaning up expired site storage.
     ,
+    'site_storage_buffered': False
+    #If True, slate writes made while handling a request are held in memory
+    #and written once per slate just before the response is finalized,
+    #rather than on every assignment.  Slates loaded later in the same
+    #request see the held writes.  Writes are dropped if the request fails
+    #with an unhandled error.  Has no effect on ram storage.
+    ,
     'site_email': {
         'smtpserver': '127.0.0.1'
         ,'smtpport': 25
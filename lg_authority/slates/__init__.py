@@ -5,13 +5,15 @@ Usage: Put tools.lg_slates.on = True in the [global] section in your config file
 tools.lg_slates.storage_type may be specified to change the storage medium (defaults to 'ram' for RamStorage)
 """
 
-__all__ = [ 'Slate', 'init_session' ]
+__all__ = [ 'Slate', 'SlateBatch', 'init_session' ]
 __author__ = 'Walt Woods'
 
 import cherrypy
 from ..common import *
 from .slates import Slate
 from .session import init_session, send_session_cookie
+from .batch import SlateBatch, begin_request_batch, flush_request_batch
+from .batch import end_request_batch
 
 #Seed global config with Slate variable
 config.Slate = Slate
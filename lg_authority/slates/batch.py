@@ -0,0 +1,188 @@
+"""Write buffering for slates.
+
+While a SlateBatch is active on a thread, writes to slates (set, update,
+pop, clear and touch) are applied to the writing slate's local state and
+remembered, rather than sent to storage.  The batch's flush() then writes
+everything remembered for each slate at once.  Slates first accessed while
+a batch holds writes for them see those writes, so code running inside a
+batch reads what it wrote.
+
+Expiring a slate is never buffered; it forgets any writes held for that
+slate and deletes it immediately.
+
+A SlateBatch may be used as a context manager (see Slate.batch()).  On a
+clean exit everything held is written with one round trip per storage
+class where the backend supports it (a single sqlite transaction, so the
+writes are all-or-nothing; one bulk write per Mongo collection).  If the
+block raises, held writes are dropped.  A batch entered while another is
+active joins it, and its writes are made when the enclosing batch flushes.
+
+Storage backends that keep slates in process memory (ram) have nothing to
+gain from buffering and write immediately regardless.
+"""
+
+import contextlib
+import threading
+
+import cherrypy
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    OrderedDict = dict
+
+from ..common import *
+
+class SlateBatchEntry(object):
+    """The writes held by a SlateBatch for a single slate."""
+
+    storage = None
+    storage__doc = """The storage object that last wrote to this slate; its
+        timeout and configuration are used when writing.
+        """
+
+    expired = None
+    expired__doc = """The slate's expired state (as understood by its
+        storage class) before the first held write.
+        """
+
+    clear = False
+    clear__doc = "True if all data stored for this slate is to be erased"
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.expired = storage.expired
+        self.fields = {}
+
+
+class SlateBatch(object):
+    """Holds slate writes until flush() is called.  See module docstring."""
+
+    _local = threading.local()
+
+    def __init__(self):
+        self.entries = OrderedDict()
+
+    def __enter__(self):
+        self._joined = SlateBatch.current() is not None
+        if not self._joined:
+            self.begin()
+        return self
+
+    def __exit__(self, type, value, tb):
+        if self._joined:
+            return False
+        self.end()
+        if type is None:
+            self.flush()
+        else:
+            self.discard()
+        return False
+
+    @classmethod
+    def current(cls):
+        """Returns the innermost active SlateBatch for this thread, or None.
+        """
+        stack = getattr(cls._local, 'stack', None)
+        if not stack:
+            return None
+        return stack[-1]
+
+    @classmethod
+    @contextlib.contextmanager
+    def set_aside(cls):
+        """Deactivates this thread's batches for the duration of the block,
+        so that writes made in it (or in a batch begun in it) are not held
+        by them.
+        """
+        stack = getattr(cls._local, 'stack', None)
+        cls._local.stack = []
+        try:
+            yield
+        finally:
+            cls._local.stack = stack
+
+    def begin(self):
+        """Make this the active batch for the current thread."""
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        stack.append(self)
+
+    def end(self):
+        """Stop collecting writes in this batch.  Held writes are kept until
+        flush() or discard().
+        """
+        stack = getattr(self._local, 'stack', None)
+        if stack and self in stack:
+            stack.remove(self)
+
+    def get(self, storage):
+        """Returns the SlateBatchEntry held for storage's slate, or None."""
+        return self.entries.get(self._key(storage))
+
+    def hold(self, storage, fields, clear=False):
+        """Remember fields (a dict of key: value, where a value of missing
+        means the key is deleted) for storage's slate.  If clear is set,
+        any data already stored for the slate is to be erased first.
+        """
+        key = self._key(storage)
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = self.entries[key] = SlateBatchEntry(storage)
+        entry.storage = storage
+        if clear:
+            entry.clear = True
+            entry.fields = {}
+        entry.fields.update(fields)
+
+    def forget(self, storage):
+        """Drop any writes held for storage's slate."""
+        self.entries.pop(self._key(storage), None)
+
+    def flush(self):
+        """Write all held writes.  Each storage class is handed its entries
+        in the order the slates were first written.
+        """
+        entries = self.entries
+        self.entries = OrderedDict()
+        by_class = OrderedDict()
+        for entry in entries.values():
+            by_class.setdefault(type(entry.storage), []).append(entry)
+        for storage_class, class_entries in by_class.items():
+            storage_class.write_batch(class_entries)
+
+    def discard(self):
+        """Drop all held writes without writing them."""
+        self.entries = OrderedDict()
+
+    def _key(self, storage):
+        return (type(storage), storage.section, storage.id)
+
+
+def begin_request_batch(**kwargs):
+    """Start buffering slate writes for the current request.  Attached to
+    before_request_body when site_storage_buffered is set.
+    """
+    batch = SlateBatch()
+    batch.begin()
+    cherrypy.serving.lg_slate_batch = batch
+
+def flush_request_batch(**kwargs):
+    """Write all slate writes buffered during the current request.
+    Attached to before_finalize, next to send_session_cookie.
+    """
+    batch = getattr(cherrypy.serving, 'lg_slate_batch', None)
+    if batch is not None:
+        batch.end()
+        batch.flush()
+
+def end_request_batch(**kwargs):
+    """Drop buffered writes that were never flushed (the request failed).
+    Attached to on_end_request.
+    """
+    batch = getattr(cherrypy.serving, 'lg_slate_batch', None)
+    if batch is not None:
+        batch.end()
+        batch.discard()
+        cherrypy.serving.lg_slate_batch = None
@@ -22,6 +22,7 @@ import cherrypy
 from cherrypy.lib import httputil
 
 from ..common import *
+from .batch import SlateBatch
 
 class Slate(object): #PY3 , metaclass=cherrypy._AttributeDocstrings):
     """A CherryPy dict-like Slate object (one per request for session state, 
@@ -90,6 +91,19 @@ class Slate(object): #PY3 , metaclass=cherrypy._AttributeDocstrings):
         """
         self.storage.touch()
 
+    @classmethod
+    def batch(cls):
+        """Returns a SlateBatch for use in a with statement.  Writes to any
+        slate inside the block are held and made together when the block
+        exits, in one round trip per storage backend where possible; if
+        the block raises, they are dropped.  For example:
+
+            with Slate.batch():
+                user.update(data)
+                userName['userId'] = user.id
+        """
+        return SlateBatch()
+
     @classmethod
     def count_with(cls, section, key, value):
         """Return the number of slates who have value in the array keyed
@@ -114,13 +128,24 @@ class Slate(object): #PY3 , metaclass=cherrypy._AttributeDocstrings):
         return config.storage_class.count_between(section, start, end)
 
     @classmethod
-    def find_between(cls, section, start, end, limit=None, skip=None):
+    def find_between(cls, section, start, end, limit=None, skip=None
+        , after=None
+        ):
         """Return a list of slates between start (inclusive) and end 
-        (exclusive).  Optionally limit the number of results returned and skip 
-        the first X.
+        (exclusive), ordered by name.  Optionally limit the number of results 
+        returned and skip the first X.
+
+        after may be the name of the last slate from a previous call; only
+        slates named after it are returned.  Prefer this to skip for paging
+        through large sections, e.g.:
+
+            page = Slate.find_between('user', '', 'zzzzzz', 100)
+            next = Slate.find_between('user', '', 'zzzzzz', 100
+                , after=page[-1].id
+                )
         """
         return config.storage_class.find_between(
-            section, start, end, limit, skip
+            section, start, end, limit, skip, after=after
             )
     
     def __getitem__(self, key):
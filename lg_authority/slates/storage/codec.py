@@ -0,0 +1,209 @@
+"""Value codecs for slate storage.
+
+Storage classes that serialize slate values (sqlite3, and pymongo for keys
+that are not index_lists) do so through one of the codecs registered here.
+The codec is chosen per section with the 'codec' option of
+site_storage_sections_{section}, falling back to the 'codec' option of
+site_storage_conf, and then to 'pickle'.
+
+Every encoded value starts with a tag byte naming the codec that wrote it,
+so values are always decoded correctly regardless of the section's current
+codec.  Values without a tag are pickles written before codecs existed.
+
+Available codecs:
+    pickle - Any picklable value.
+    json - JSON-compatible values; datetimes are also supported.  Strings
+        come back as unicode.
+    marshal - Builtin types only.
+    msgpack - As json, but smaller and faster, and dict keys may also be
+        numbers.  Requires msgpack.
+
+A value the section's codec cannot represent is pickled instead.  That
+includes values json or msgpack would change on the way through: anything
+holding a tuple (which would come back as a list), a datetime with a
+tzinfo (which would come back naive), or a dict with a '__datetime__' key
+(which might come back as a datetime), and for json, a dict with keys that
+are not strings (which would come back as strings).
+
+Values whose encoding is at least compress_threshold bytes long (set per
+section or in site_storage_conf; off by default) are zlib compressed when
+that makes them smaller.  Compression is flagged in the tag byte, so
+compressed and uncompressed values may be mixed freely.
+"""
+
+import datetime
+import json
+import marshal
+import zlib
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+class Codec(object):
+    """Base class for value codecs."""
+
+    name = None
+    name__doc = "Name used to select this codec in configuration"
+
+    tag = None
+    tag__doc = """Byte value prefixed to everything this codec encodes.
+        Must be less than COMPRESSED.  Neither it nor tag | COMPRESSED may
+        be the first byte of any pickle; see decode().
+        """
+
+    def encode(self, value):
+        """Returns value as a byte string.  Raises TypeError or ValueError
+        if value cannot be represented.
+        """
+        raise NotImplementedError()
+
+    def decode(self, data):
+        """Returns the value for a byte string produced by encode()."""
+        raise NotImplementedError()
+
+
+class PickleCodec(Codec):
+    name = 'pickle'
+    tag = 1
+
+    def encode(self, value):
+        return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+    def decode(self, data):
+        return pickle.loads(data)
+
+
+def _json_default(value):
+    if isinstance(value, datetime.datetime):
+        return { '__datetime__': value.strftime('%Y-%m-%dT%H:%M:%S.%f') }
+    raise TypeError("Cannot encode " + str(type(value)))
+
+def _check_plain(value, string_keys):
+    """Raises TypeError if value holds a tuple, an aware datetime, a dict
+    with a '__datetime__' key, or (if string_keys) a dict key that is not a
+    string; JSON and msgpack would not return these unchanged.
+    """
+    if isinstance(value, dict):
+        if '__datetime__' in value:
+            raise TypeError("Cannot encode key __datetime__")
+        for k, v in value.items():
+            if string_keys and not isinstance(k, basestring):
+                raise TypeError("Cannot encode key " + repr(k))
+            _check_plain(v, string_keys)
+    elif isinstance(value, list):
+        for v in value:
+            _check_plain(v, string_keys)
+    elif isinstance(value, tuple):
+        raise TypeError("Cannot encode tuples")
+    elif isinstance(value, datetime.datetime) and value.tzinfo is not None:
+        raise TypeError("Cannot encode datetimes with a tzinfo")
+
+def _json_object_hook(obj):
+    if len(obj) == 1 and '__datetime__' in obj:
+        return datetime.datetime.strptime(
+            obj['__datetime__'], '%Y-%m-%dT%H:%M:%S.%f'
+            )
+    return obj
+
+class JsonCodec(Codec):
+    name = 'json'
+    tag = 2
+
+    def encode(self, value):
+        _check_plain(value, True)
+        return json.dumps(
+            value, default=_json_default, separators=(',',':')
+            ).encode('utf-8')
+
+    def decode(self, data):
+        return json.loads(data.decode('utf-8'), object_hook=_json_object_hook)
+
+
+class MarshalCodec(Codec):
+    name = 'marshal'
+    tag = 3
+
+    def encode(self, value):
+        return marshal.dumps(value)
+
+    def decode(self, data):
+        return marshal.loads(data)
+
+
+class MsgpackCodec(Codec):
+    name = 'msgpack'
+    tag = 4
+
+    def __init__(self):
+        import msgpack
+        self.msgpack = msgpack
+
+    def encode(self, value):
+        _check_plain(value, False)
+        return self.msgpack.packb(
+            value, default=_json_default, use_bin_type=True
+            )
+
+    def decode(self, data):
+        return self.msgpack.unpackb(
+            data, object_hook=_json_object_hook, raw=False
+            )
+
+
+COMPRESSED = 0x10
+COMPRESSED__doc = "Flag set in the tag byte of zlib compressed values"
+
+codec_classes = dict([ (c.name, c)
+    for c in [ PickleCodec, JsonCodec, MarshalCodec, MsgpackCodec ]
+    ])
+codec_names_by_tag = dict([ (c.tag, c.name) for c in codec_classes.values() ])
+codecs = {}
+_tag_bytes = dict([ (t, bytes(bytearray([ t ])))
+    for c in codec_classes.values()
+    for t in [ c.tag, c.tag | COMPRESSED ]
+    ])
+
+def get_codec(name):
+    """Returns the codec instance registered under name."""
+    result = codecs.get(name)
+    if result is None:
+        cls = codec_classes.get(name)
+        if cls is None:
+            raise ValueError("Unknown slate codec: {0}".format(name))
+        result = codecs[name] = cls()
+    return result
+
+def encode(codec, value, compress_threshold=None):
+    """Encodes value with codec (or with pickle, if codec cannot represent
+    it), and returns the tagged byte string.  If compress_threshold is 
+    given and the encoded value is at least that many bytes, it is 
+    compressed unless that would not save anything.
+    """
+    try:
+        data = codec.encode(value)
+    except (TypeError, ValueError):
+        if codec.name == 'pickle':
+            raise
+        codec = get_codec('pickle')
+        data = codec.encode(value)
+
+    tag = codec.tag
+    if compress_threshold is not None and len(data) >= compress_threshold:
+        compressed = zlib.compress(data)
+        if len(compressed) < len(data):
+            tag |= COMPRESSED
+            data = compressed
+    return _tag_bytes[tag] + data
+
+def decode(data):
+    """Decodes a byte string produced by encode(), or an untagged pickle."""
+    tag = ord(data[:1])
+    name = codec_names_by_tag.get(tag & ~COMPRESSED)
+    if name is None:
+        #Pickles start with an opcode, which is never a tag byte
+        return pickle.loads(data)
+    data = data[1:]
+    if tag & COMPRESSED:
+        data = zlib.decompress(data)
+    return get_codec(name).decode(data)
@@ -1,5 +1,20 @@
 
 from ...common import *
+from ..batch import SlateBatch
+from . import codec
+
+class StoredValue(object):
+    """A value as read from storage, not yet decoded.  Storage classes keep
+    these in their cache until the key is read, so that values which are 
+    never read are never decoded.
+    """
+    __slots__ = [ 'raw' ]
+
+    def __init__(self, raw):
+        self.raw = raw
+
+    def __repr__(self):
+        return '<stored>'
 
 class SlateStorage(object): #PY3 , metaclass=cherrypy._AttributeDocstring):
     """The base class for slate storage types.  These should only use the
@@ -9,6 +24,19 @@ class SlateStorage(object): #PY3 , metaclass=cherrypy._AttributeDocstring):
     name = None
     name__doc = "The slate's name"
 
+    default_codec = 'pickle'
+    default_codec__doc = """Name of the codec for sections that do not
+        specify one; set from site_storage_conf's 'codec' by storage classes
+        that encode values.  See storage/codec.py.
+        """
+
+    default_compress_threshold = None
+    default_compress_threshold__doc = """Encoded size in bytes at which
+        values are compressed, for sections that do not specify one; set
+        from site_storage_conf's 'compress_threshold' like default_codec.
+        None disables compression.
+        """
+
     def __init__(self, section, id, timeout):
         """Initializes storage for a slate.  Shouldn't do any network activity.
 
@@ -100,10 +128,90 @@ class SlateStorage(object): #PY3 , metaclass=cherrypy._AttributeDocstring):
         """Return True if this given slate is expired or does not exist"""
         raise NotImplementedError()
 
+    def _cache_get(self, key):
+        """Returns self.cache[key], first decoding it (once) if it is still 
+        a StoredValue.
+        """
+        value = self.cache[key]
+        if isinstance(value, StoredValue):
+            value = self.cache[key] = self._get(key, value.raw)
+        return value
+
+    def _cache_items(self):
+        """Returns the decoded (key, value) pairs in self.cache, skipping
+        keys known to be missing.
+        """
+        return [ (k, self._cache_get(k)) for k in list(self.cache.keys())
+            if self.cache[k] is not missing
+            ]
+
+    def _batch_hold(self, fields, clear=False):
+        """If a SlateBatch is active, hold fields (key: value, or key: 
+        missing for deletion) in it for this slate and return True; the 
+        caller must not write them itself.  Otherwise return False.
+
+        Must be called before self.expired is cleared for the write.
+        """
+        batch = SlateBatch.current()
+        if batch is None:
+            return False
+        batch.hold(self, fields, clear)
+        return True
+
+    def _batch_apply(self):
+        """Called at the end of a buffering storage's first access.  Applies
+        any writes the active SlateBatch holds for this slate to 
+        self.cache, so that they may be read back before being written.
+        If the held writes clear the slate, self.cache_complete is set, as
+        nothing that is not in the cache remains.
+        """
+        batch = SlateBatch.current()
+        entry = batch and batch.get(self)
+        if entry is None:
+            return
+        if entry.clear:
+            for k in self.cache.keys():
+                self.cache[k] = missing
+            self.cache_complete = True
+        self.cache.update(entry.fields)
+        self.expired = False
+        if isinstance(self.timeout, dict):
+            self.timeout = entry.storage.timeout
+
+    def _batch_forget(self):
+        """Drops any writes held for this slate by the active SlateBatch."""
+        batch = SlateBatch.current()
+        if batch is not None:
+            batch.forget(self)
+
+    def _write_entry(self, entry):
+        """Writes the SlateBatchEntry entry, held for this slate."""
+        raise NotImplementedError()
+
+    @classmethod
+    def write_batch(cls, entries):
+        """Writes the given SlateBatchEntry objects, all held for slates of
+        this storage class.  Override to write them in fewer round trips.
+        """
+        for entry in entries:
+            entry.storage._write_entry(entry)
+
     def get_section_config(self):
         """Instance method to get the section config"""
         return config.get('site_storage_sections_' + self.section, {})
 
+    def get_section_codec(self):
+        """Returns the value codec for this slate's section"""
+        return codec.get_codec(
+            self.get_section_config().get('codec', self.default_codec)
+            )
+
+    def get_section_compress_threshold(self):
+        """Returns the compression threshold for this slate's section"""
+        return self.get_section_config().get(
+            'compress_threshold', self.default_compress_threshold
+            )
+
     @classmethod
     def _get_section_config(cls, section):
         """Class method to get the section config"""
@@ -120,6 +228,13 @@ class SlateStorage(object): #PY3 , metaclass=cherrypy._AttributeDocstring):
     def setup(cls, config):
         """Set up slate storage medium according to passed config"""
 
+    @classmethod
+    def shutdown(cls):
+        """Release resources (such as connections) held by the storage 
+        medium.  Called when cherrypy.engine stops; storage must still work
+        if used afterward.
+        """
+
     @classmethod
     def clean_up(cls):
         """Clean up expired sessions (expired < present).  It is recommended
@@ -152,9 +267,16 @@ class SlateStorage(object): #PY3 , metaclass=cherrypy._AttributeDocstring):
         return len(cls.find_between(section, start, end))
 
     @classmethod
-    def find_between(cls, section, start, end, limit=None, skip=None):
-        """Return a list of slates between start and end, optionally
-        limiting the number of results and/or skipping the first X results.
+    def find_between(cls, section, start, end, limit=None, skip=None
+        , after=None
+        ):
+        """Return a list of slates between start and end, ordered by name,
+        optionally limiting the number of results and/or skipping the first 
+        X results.
+
+        If after is specified, only slates whose names sort strictly after
+        it are returned.  Passing the last name of one page as after fetches
+        the next page without the cost of skipping the preceding ones.
         """
         raise NotImplementedError()
         
@@ -0,0 +1,145 @@
+"""Cross-process invalidation of cached slates.
+
+Every process that caches slates (see TieredStorage) opens an
+InvalidationBus on the same directory.  Each bus binds a UNIX datagram
+socket in that directory; publish() sends a (section, id) event to every
+other socket there, and a thread in each receiving process hands it to the
+bus's callback, which drops the slate from its cache.  Events arrive within
+a millisecond or so, rather than when a cached copy's TTL runs out.
+
+Delivery is best effort: an event for a process whose socket buffer is
+full is dropped, leaving its copy to expire with its TTL.  Sockets left
+behind by processes that died are removed when sending to them fails.
+Only sockets named the way the bus names them are sent to or removed;
+anything else in the directory is left alone.
+"""
+
+import errno
+import os
+import re
+import socket
+import stat
+import threading
+import uuid
+
+from ...common import *
+
+_socket_name = re.compile(r'^\d+\.[0-9a-f]{8}$')
+
+def _text(data):
+    """Returns utf-8 data as a str if it is ascii, or else as unicode, so
+    that it compares and hashes equal to the id it was sent for.
+    """
+    try:
+        data.decode('ascii')
+        return data
+    except UnicodeDecodeError:
+        return data.decode('utf-8')
+
+class InvalidationBus(object):
+    """See module docstring.  callback is called with (section, id) for
+    every event published by another process, from the bus' own thread.
+    """
+
+    directory = None
+    directory__doc = "Directory holding every process' socket"
+
+    def __init__(self, directory, callback):
+        self.directory = directory
+        self.callback = callback
+        self.open_lock = threading.Lock()
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory, 0700)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        self._open()
+
+    def _open(self):
+        """Binds this process' socket and starts its receiving thread."""
+        self.pid = os.getpid()
+        self.path = os.path.join(self.directory, '{0}.{1}'.format(
+            self.pid, uuid.uuid4().hex[:8]
+            ))
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(self.path)
+        self.sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sender.setblocking(False)
+        self.closed = False
+        self.thread = threading.Thread(target=self._receive)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def check_fork(self):
+        """Opens a socket for this process if it was forked since the bus
+        was opened (the bus' socket is then its parent's).
+        """
+        if self.pid != os.getpid():
+            with self.open_lock:
+                if self.pid != os.getpid():
+                    self._open()
+
+    def publish(self, section, id):
+        """Tells every other process that the given slate has changed."""
+        self.check_fork()
+        message = section + '\0' + id
+        if isinstance(message, unicode):
+            message = message.encode('utf-8')
+
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if path == self.path or not _socket_name.match(name):
+                continue
+            try:
+                if not stat.S_ISSOCK(os.lstat(path).st_mode):
+                    continue
+            except OSError:
+                continue
+            try:
+                self.sender.sendto(message, path)
+            except socket.error as e:
+                if e.errno == errno.ECONNREFUSED:
+                    #Nobody is listening; its process is gone
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                elif e.errno in (errno.EAGAIN, errno.ENOBUFS):
+                    log('Invalidation for {0} dropped'.format(path))
+                elif e.errno != errno.ENOENT:
+                    raise
+
+    def close(self):
+        """Stops receiving and removes this process' socket."""
+        if self.closed or self.pid != os.getpid():
+            return
+        self.closed = True
+        try:
+            #Wake the receiving thread
+            self.sender.sendto(b'', self.path)
+        except socket.error:
+            pass
+        self.thread.join()
+        self.sock.close()
+        self.sender.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    def _receive(self):
+        while True:
+            try:
+                message = self.sock.recv(65536)
+            except socket.error:
+                return
+            if self.closed:
+                return
+            if not message:
+                continue
+            try:
+                section, id = message.split(b'\0', 1)
+                self.callback(_text(section), _text(id))
+            except Exception as e:
+                log('Invalidation callback failed: {0}'.format(e))
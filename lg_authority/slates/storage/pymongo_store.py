@@ -1,9 +1,5 @@
 import datetime
 import uuid
-try:
-    import cPickle as pickle
-except ImportError:
-    import pickle
 from .common import *
 from ..slates import Slate
 
@@ -17,6 +13,9 @@ class PymongoStorage(SlateStorage):
         collection_base: Collection base name to which the Section name is
             appended.  This is not the collection that is actually created.
             If not specified, presumed the empty string.
+        codec: Value codec for sections that do not name one (see codec.py)
+        compress_threshold: Encoded size in bytes at which values are zlib
+            compressed, for sections that do not specify one.  Default off.
     """
 
     def __init__(self, section, id, timeout):
@@ -25,10 +24,13 @@ class PymongoStorage(SlateStorage):
         self.timeout = timeout
         self._section = self._get_section(self.section)
         self._conf = self.get_section_config()
+        self._codec = self.get_section_codec()
+        self._compress_threshold = self.get_section_compress_threshold()
     
     def _expired(self):
         """Call to set this Slate's local state as expired"""
         self.expired = True
+        self.cache_complete = True
         for j in self.cache.keys():
             self.cache[j] = missing
 
@@ -38,7 +40,16 @@ class PymongoStorage(SlateStorage):
             return
         self._first_access = True
 
-        core = self._section.find_one({ '_id': self.id })
+        #Fetch only the data in the section's cache list, if it has one; 
+        #the rest is fetched on demand.
+        prefetch = self._conf.get('cache')
+        if prefetch is None:
+            core = self._section.find_one({ '_id': self.id })
+        else:
+            core = self._section.find_one(
+                { '_id': self.id }
+                , [ 'timeout', 'expire' ] + [ 'data.' + k for k in prefetch ]
+                )
         now = datetime.datetime.utcnow()
 
         if core is None or core.get('expire', now) < now:
@@ -55,24 +66,36 @@ class PymongoStorage(SlateStorage):
             self.expired = False
             self.cache = core.get('data', {})
             for k,v in self.cache.items():
-                self.cache[k] = self._get(k,v)
+                self.cache[k] = StoredValue(v)
+            self.cache_complete = prefetch is None
+            for k in prefetch or []:
+                self.cache.setdefault(k, missing)
             self.expiry = core.get('expire', None)
             if isinstance(self.timeout, dict):
                 self.timeout = core.get('timeout', None)
             log('Loaded slate {1} with {0}'.format(self.cache, self.id))
 
-    def _write(self, fields=None):
+        self._batch_apply()
+
+    def _write(self, fields=None, clear=False):
         """Called before any write operation to setup the storage.
         Implicitly calls _access(), then writes either a brand
         new record or updates the old one, depending on expired status.
 
         fields may be set to a dict to also set those values (in addition
-        to the timeout)
+        to the timeout); a value of missing deletes that key.  If clear is
+        set, all values not in fields are deleted.
+
+        If a SlateBatch is active, the write is held in it rather than
+        written now.
         """
         self._access()
 
         fields = fields or {}
 
+        if clear:
+            self.cache = {}
+            self.cache_complete = True
         for k,v in fields.items():
             self.cache[k] = v
 
@@ -85,41 +108,102 @@ class PymongoStorage(SlateStorage):
 
             if self.id is None:
                 self.id = PymongoStorage.generateId()
+        elif not useTimeout:
+            raise Exception("Code assertion failure - we must have a " +
+                "timeout to be here.")
 
-            new_dict = {
-                '_id': self.id
-                ,'data': {}
-                }
-            if useTimeout:
-                new_dict['timeout'] = self.timeout
-                if self.timeout is not None:
-                    new_dict['expire'] = datetime.datetime.utcnow() + datetime.timedelta(seconds=self.timeout)
-            for k,v in fields.items():
-                new_dict['data'][k] = self._set(k,v)
-            self._section.save(new_dict)
-            self.expired = False
+        if not self._batch_hold(fields, clear):
+            if self.expired:
+                self._section.save(self._write_doc(fields))
+            else:
+                self._section.update(
+                    { '_id': self.id }
+                    , self._write_update(fields, clear)
+                    )
+
+        self.expired = False
+
+    def _write_entry(self, entry):
+        if entry.expired:
+            self._section.save(self._write_doc(entry.fields))
         else:
-            updates = {}
-            sets = updates['$set'] = {}
-            unsets = updates['$unset'] = {}
+            self._section.update(
+                { '_id': self.id }
+                , self._write_update(entry.fields, entry.clear)
+                )
 
-            if not useTimeout:
-                raise Exception("Code assertion failure - we must have a " +
-                    "timeout to be here.")
+    @classmethod
+    def write_batch(cls, entries):
+        # Bulk writes are per collection; keep first-write order
+        sections = []
+        by_section = {}
+        for entry in entries:
+            section = entry.storage.section
+            if section not in by_section:
+                sections.append(section)
+                by_section[section] = []
+            by_section[section].append(entry)
+
+        for section in sections:
+            bulk = cls._get_section(section).initialize_ordered_bulk_op()
+            for entry in by_section[section]:
+                s = entry.storage
+                if entry.expired:
+                    bulk.find({ '_id': s.id }).upsert().replace_one(
+                        s._write_doc(entry.fields)
+                        )
+                else:
+                    bulk.find({ '_id': s.id }).update_one(
+                        s._write_update(entry.fields, entry.clear)
+                        )
+            bulk.execute()
+
+    def _write_doc(self, fields):
+        """Returns the full document for this slate as a new slate holding
+        fields.
+        """
+        new_dict = {
+            '_id': self.id
+            ,'data': {}
+            ,'timeout': self.timeout
+            }
+        if self.timeout is not None:
+            new_dict['expire'] = datetime.datetime.utcnow() + datetime.timedelta(seconds=self.timeout)
+        for k,v in fields.items():
+            if v is not missing:
+                new_dict['data'][k] = self._set(k,v)
+        return new_dict
 
-            sets['timeout'] = self.timeout
-            if self.timeout is not None:
-                sets['expire'] = datetime.datetime.utcnow() + datetime.timedelta(seconds=self.timeout)
-            else:
-                unsets['expire'] = 1
+    def _write_update(self, fields, clear=False):
+        """Returns the update document that touches this existing slate and
+        writes fields (see _write).
+        """
+        updates = {}
+        sets = updates['$set'] = {}
+        unsets = {}
 
+        sets['timeout'] = self.timeout
+        if self.timeout is not None:
+            sets['expire'] = datetime.datetime.utcnow() + datetime.timedelta(seconds=self.timeout)
+        else:
+            unsets['expire'] = 1
+
+        if clear:
+            sets['data'] = dict([ 
+                (k, self._set(k, v)) 
+                for k,v in fields.items() 
+                if v is not missing 
+                ])
+        else:
             for k,v in fields.items():
                 if v is missing:
                     unsets['data.' + k] = 1
                 else:
                     sets['data.' + k] = self._set(k, v)
 
-            self._section.update({ '_id': self.id }, updates)
+        if unsets:
+            updates['$unset'] = unsets
+        return updates
 
     def __str__(self):
         return "PYMONGO({0})".format(self.id)
@@ -136,11 +220,13 @@ class PymongoStorage(SlateStorage):
     def _set(self, key, value):
         """Translates a python value into one suitable for mongodb storage"""
         if key in self._section.lgauth_conf_indexed:
-            pickled = value
+            encoded = value
         else:
-            pickled = self.binary(pickle.dumps(value))
+            encoded = self.binary(codec.encode(
+                self._codec, value, self._compress_threshold
+                ))
 
-        return pickled
+        return encoded
 
     def get(self, key, default):
         if not isinstance(key, basestring):
@@ -149,21 +235,38 @@ class PymongoStorage(SlateStorage):
         self._access()
         if self.expired:
             return default
-        if key in self.cache:
-            result = self.cache[key]
-            if result is missing:
-                result = default
-        else:
+        if key not in self.cache:
+            if self.cache_complete:
+                return default
+            core = self._section.find_one({ '_id': self.id }, [ 'data.' + key ])
+            value = (core or {}).get('data', {}).get(key, missing)
+            if value is not missing:
+                value = StoredValue(value)
+            self.cache[key] = value
+        result = self._cache_get(key)
+        if result is missing:
             result = default
         return result
 
+    def _load_all(self):
+        """Fetches any values not yet in the cache (see the section's 
+        cache configuration).
+        """
+        if self.cache_complete:
+            return
+        core = self._section.find_one({ '_id': self.id }, [ 'data' ])
+        for k,v in (core or {}).get('data', {}).items():
+            if k not in self.cache:
+                self.cache[k] = StoredValue(v)
+        self.cache_complete = True
+
     def _get(self, key, value):
         """Translates the given value for the specified key into
-        python objects (from pickle).
+        python objects (see codec.decode).
         """
         result = value
         if key not in self._section.lgauth_conf_indexed:
-            result = pickle.loads(result)
+            result = codec.decode(result)
         return result
 
     def pop(self, key, default):
@@ -171,19 +274,22 @@ class PymongoStorage(SlateStorage):
         self._write({ key: missing })
         return result
 
+    def update(self, d):
+        self._write(dict(d))
+
     def clear(self):
-        self._write()
-        self._section.update({ '_id': self.id }, { '$set': { 'data': {} } })
-        self.cache = {}
+        self._write(clear=True)
 
     def items(self):
         self._access()
         if self.expired:
             return []
-        return self.cache.items()
+        self._load_all()
+        return self._cache_items()
 
     def expire(self):
         self._access()
+        self._batch_forget()
         self._section.remove(self.id)
         self._expired()
 
@@ -209,6 +315,11 @@ class PymongoStorage(SlateStorage):
         s = cls._get_section(section)
         s.remove()
 
+    @classmethod
+    def count_with(cls, section, key, value):
+        _section = cls._get_section(section)
+        return _section.find({ 'data.' + key: value }).count()
+
     @classmethod
     def find_with(cls, section, key, value):
         results = []
@@ -218,17 +329,28 @@ class PymongoStorage(SlateStorage):
         return results
 
     @classmethod
-    def find_between(cls, section, start, end, limit=None, skip=None):
-        result = []
+    def count_between(cls, section, start, end):
+        _section = cls._get_section(section)
+        return _section.find({ '_id': { '$gte': start, '$lt': end } }).count()
+
+    @classmethod
+    def find_between(cls, section, start, end, limit=None, skip=None
+        , after=None
+        ):
         _section = cls._get_section(section)
+        idRange = { '$gte': start, '$lt': end }
+        if after is not None:
+            idRange['$gt'] = after
         cursor = _section.find(
-            { '_id': { '$gte': start, '$lt': end } }, { '_id': 1 }
+            { '_id': idRange }, { '_id': 1 }
             ).sort(
             [ ('_id',1) ]
             )
-        skip = skip or 0
-        limit = skip + limit if limit else None
-        return [ Slate(section, d['_id']) for d in cursor[skip:limit] ]
+        if skip:
+            cursor = cursor.skip(skip)
+        if limit:
+            cursor = cursor.limit(limit)
+        return [ Slate(section, d['_id']) for d in cursor ]
 
     @classmethod
     def generateId(cls):
@@ -241,8 +363,11 @@ class PymongoStorage(SlateStorage):
           host=conf.get('host', None)
           ,port=conf.get('port', None)
           )
+        cls.connection = c
         cls.db = c[conf['db']]
         cls.collection_base = conf.get('collection_base', '')
+        cls.default_codec = conf.get('codec', 'pickle')
+        cls.default_compress_threshold = conf.get('compress_threshold', None)
         cls.collections = {}
 
         from bson.binary import Binary
@@ -267,6 +392,11 @@ class PymongoStorage(SlateStorage):
         cls.collections[section] = result
         return result
 
+    @classmethod
+    def shutdown(cls):
+        #Reconnects automatically if used again
+        cls.connection.disconnect()
+
     @classmethod
     def clean_up(cls):
         now = datetime.datetime.utcnow()
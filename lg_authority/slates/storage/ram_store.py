@@ -1,13 +1,123 @@
+import bisect
+import collections
+import contextlib
+import heapq
+import sys
+import threading
 import time
 from .common import *
 from ..slates import Slate
 
+def _approx_size(value):
+    """Rough bytes held by value: sys.getsizeof of it and of everything in
+    the dicts, lists, tuples and sets it contains.
+    """
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        for k, v in value.items():
+            size += _approx_size(k) + _approx_size(v)
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        for v in value:
+            size += _approx_size(v)
+    return size
+
+class RamRecord(object):
+    """One slate as held in RamStorage.section_cache.
+
+    data is never changed in place once a loaded slate may share it 
+    (shared); the first write after that stores a modified copy instead, 
+    which only the writing slate object sees, and which it changes in 
+    place until the slate is next loaded.  So loading a slate can share 
+    data rather than copy it, what a loaded slate sees does not change 
+    under it, and a run of writes through one slate object copies once.
+    """
+    __slots__ = ('timeout', 'data', 'expire', 'size', 'shared')
+
+    def __init__(self, timeout, data):
+        self.timeout = timeout
+        self.data = data
+        self.expire = None #None if timeout is None
+        self.size = 0 #Estimated bytes of data, if the section has max_bytes
+        self.shared = False #Whether a slate object loaded data
+
 class RamStorage(SlateStorage):
+    """Storing slates in process memory.
+
+    Available params in storage_conf:
+        clean_chunk: Expired slates deleted by clean_up before it briefly
+            releases the GIL for other threads.  Default 1000.
+        lock_stripes: Number of slate locks.  Default 64.
+
+    Each slate is guarded by one of a fixed set of striped locks (chosen by
+    hashing its section and id), held while it is loaded and for the whole
+    of each write, so concurrent writers to one slate cannot lose each 
+    other's updates, and writers to different slates rarely contend.  A 
+    section's expiry heap, index and sorted ids are guarded by a lock per 
+    section, which is only ever taken after (or without) a slate lock.
+
+    Available params in site_storage_sections_{section}:
+        max_entries: Most slates kept in the section.
+        max_bytes: Most bytes of slate data (as estimated by sys.getsizeof)
+            kept in the section.
+    When a write takes a section over either cap, its expired slates are
+    deleted first, and then its least recently used slates until it is
+    under both.  See get_stats() for the section's size and evictions.
+    """
     
     # Class-level objects. Don't rebind these!
     section_cache = {}
     random_id_num = 1
 
+    expiry_heaps = {}
+    expiry_heaps__doc = """Per section heap of (expire, id) for every write
+        that set an expiration, so clean_up only visits slates that are due.
+        Entries are not removed when a slate is rewritten or expired; such
+        stale entries are skipped (their expire no longer matches the
+        record's) and dropped when the heap is rebuilt (see _schedule).
+        """
+
+    indexes = {}
+    indexes__doc = """Per section inverted index of the keys in the 
+        section's index_lists: { key: { value: set(ids) } }, kept up to date
+        on every write, like the sqlite3 {section}_index table.
+        """
+
+    indexed = {}
+    indexed__doc = """Per section { id: { key: tuple(values) } } of what
+        each slate has in indexes.  Stored lists may be changed in place by
+        whoever read them before being set again, so ids are removed from
+        indexes for the values recorded here, not those in the slate.
+        """
+
+    sorted_ids = {}
+    sorted_ids__doc = """Per section sorted list of the ids in the section,
+        kept with bisect so find_between and count_between are
+        O(log n + k) rather than sorting the whole section on each call.
+        """
+
+    clean_chunk = 1000
+
+    locks = [ threading.RLock() for i in range(64) ]
+    locks__doc = "Striped slate locks; see _slate_lock()"
+
+    section_locks = {}
+    section_locks__doc = """Per section lock for expiry_heaps, indexes and
+        sorted_ids
+        """
+
+    id_lock = threading.Lock()
+    id_lock__doc = "Guards random_id_num"
+
+    lru = {}
+    lru__doc = """Per section OrderedDict of ids, least recently used 
+        first, for sections with max_entries or max_bytes set
+        """
+
+    section_stats = {}
+    section_stats__doc = """Per section counters for sections with 
+        max_entries or max_bytes set; see get_stats()
+        """
+
     def __init__(self, section, id, timeout):
         self.section = section
         self.section_store = self.section_cache.setdefault(section, {})
@@ -18,6 +128,7 @@ class RamStorage(SlateStorage):
         """Sets this object up so that it has expired."""
         self.expired = True
         self.data = {}
+        self._data_owned = True
 
     def _access(self):
         """Called before access of any type"""
@@ -28,53 +139,81 @@ class RamStorage(SlateStorage):
         section = self.section
         id = self.id
 
-        if RamStorage._is_expired(section, id):
-            self._expired()
-            self.data = {}
-            log('Loaded new (expired) slate')
-        else:
-            self.expired = False
-            record = self.section_store[id]
-            self.data = record['data'].copy()
-            self.expiry = record.get('expire', None)
-            if isinstance(self.timeout, dict):
-                self.timeout = record['timeout']
-            log('Loaded slate with {0}'.format(self.data))
+        with self._lock():
+            if RamStorage._is_expired(section, id):
+                self._expired()
+                self.data = {}
+                log('Loaded new (expired) slate')
+            else:
+                self.expired = False
+                record = self.section_store[id]
+                self.data = record.data
+                self._data_owned = False
+                record.shared = True
+                self.expiry = record.expire
+                if isinstance(self.timeout, dict):
+                    self.timeout = record.timeout
+                if self._is_capped(section):
+                    self._used(section, id)
+                log('Loaded slate with {0}'.format(self.data))
 
     def _write(self):
         """Called before any write operation to setup the storage.
-        Implicitly calls _access().
+        Implicitly calls _access().  Must be called with _lock() held, and
+        the write completed before releasing it.
         """
         self._access()
 
+        #Another thread may have created or deleted the slate since we 
+        #loaded it.
+        if not self.expired and self.id not in self.section_store:
+            self._expired()
+        elif (
+            self.expired and self.id is not None
+            and not RamStorage._is_expired(self.section, self.id)
+            ):
+            record = self.section_store[self.id]
+            self.data = record.data
+            self._data_owned = False
+            record.shared = True
+            self.expired = False
+            if isinstance(self.timeout, dict):
+                self.timeout = record.timeout
+
         #If timeout is a dict, that means we shouldn't do anything with 
         #existing timeout.
         useTimeout = not isinstance(self.timeout, dict)
 
         if self.expired:
             if self.id is None:
-                idNum = RamStorage.random_id_num
-                RamStorage.random_id_num += 1
-                self.id = 'ramStore_' + str(idNum)
+                #A new id is never seen by another thread until we return,
+                #so the stripe held for (section, None) is good enough.
+                self.id = self._new_id()
             if not useTimeout:
                 raise ValueError("Timeout must be specified when writing "
                     + "a new slate."
                     )
-            self.record = self.section_store[self.id] = {}
-            self.record['timeout'] = self.timeout
-            self.record['data'] = {}
+            old = self.section_store.get(self.id)
+            if old is not None:
+                self._drop(self.section, self.id, old)
+            self._add_id(self.section, self.id)
+            self.record = RamRecord(self.timeout, {})
+            self.data = self.record.data
+            self._data_owned = False
+            self.section_store[self.id] = self.record
             self.expired = False
         else:
             if not useTimeout:
                 raise Exception("Programming error.  Must have timeout here.")
             self.record = self.section_store[self.id]
-            self.record['timeout'] = self.timeout
+            self.record.timeout = self.timeout
 
-        timeout = self.record['timeout']
+        timeout = self.record.timeout
         if timeout is not None:
-            self.record['expire'] = time.time() + timeout
+            self.record.expire = time.time() + timeout
+            self._schedule(self.section, self.id, self.record.expire)
         else:
-            self.record.pop('expire', None)
+            self.record.expire = None
 
     def __str__(self):
         desc = '_id-' + self.id
@@ -85,28 +224,70 @@ class RamStorage(SlateStorage):
     def __repr__(self):
         return str(self)
 
+    @contextlib.contextmanager
+    def _writing(self):
+        """Holds _lock() around a write, and calls _write() first.  
+        Afterward, updates the section's accounting and enforces its caps.
+        """
+        with self._lock():
+            self._write()
+            yield
+            if self._is_capped(self.section):
+                self._account()
+        self._evict(self.section)
+
+    def _change(self, change):
+        """Applies change (which modifies a dict in place) to the record's
+        data and to this object's view of it, copying either first if 
+        anything else may see it (copy on write).  Returns what change 
+        returned for this object's view.
+        """
+        record = self.record
+        if self.data is record.data:
+            if record.shared:
+                record.data = self.data = record.data.copy()
+                record.shared = False
+            return change(self.data)
+
+        #Another object wrote since this one loaded; keep the views apart
+        data = record.data.copy()
+        change(data)
+        record.data = data
+        record.shared = False
+        if not self._data_owned:
+            self.data = self.data.copy()
+            self._data_owned = True
+        return change(self.data)
+
     def touch(self):
-        self._write()
+        with self._writing():
+            pass
 
     def set(self, key, value):
-        self._write()
-        self.data[key] = value
-        self.record['data'][key] = value
+        def change(data):
+            data[key] = value
+        with self._writing():
+            self._unindex(self.section, self.id, key)
+            self._change(change)
+            self._index(self.section, self.id, self.record.data, key)
 
     def get(self, key, default):
         self._access()
         return self.data.get(key, default)
 
     def pop(self, key, default):
-        self._write()
-        result = self.data.pop(key, default)
-        self.record['data'].pop(key, default)
-        return result
+        def change(data):
+            return data.pop(key, default)
+        with self._writing():
+            self._unindex(self.section, self.id, key)
+            return self._change(change)
 
     def clear(self):
-        self._write()
-        self.record['data'] = {}
-        self.data = {}
+        with self._writing():
+            self._unindex(self.section, self.id)
+            self.record.data = self.data = {}
+            self._data_owned = False
+            self.record.shared = False
 
     def keys(self):
         self._access()
@@ -121,8 +302,9 @@ class RamStorage(SlateStorage):
         return self.data.values()
     
     def expire(self):
-        self._expire(self.section, self)
-        self._expired()
+        with self._lock():
+            self._expire(self.section, self)
+            self._expired()
 
     def is_expired(self):
         self._access()
@@ -139,9 +321,34 @@ class RamStorage(SlateStorage):
     @classmethod
     def destroySectionBeCarefulWhenYouCallThis(cls, section):
       cls.section_cache[section] = {}
+      cls.expiry_heaps[section] = []
+      cls.indexes[section] = {}
+      cls.indexed[section] = {}
+      cls.sorted_ids[section] = []
+      cls.lru[section] = collections.OrderedDict()
+      cls.section_stats.pop(section, None)
+
+    @classmethod
+    def count_with(cls, section, key, value):
+        if key in cls._index_lists(section):
+            with cls._section_lock(section):
+                ids = cls.indexes.get(section, {}).get(key, {}).get(value, ())
+                return len(ids)
+
+        result = 0
+        for v in cls.section_cache.get(section, {}).values():
+            if value in v.get('data', {}).get(key, []):
+                result += 1
+        return result
 
     @classmethod
     def find_with(cls, section, key, value):
+        if key in cls._index_lists(section):
+            with cls._section_lock(section):
+                ids = cls.indexes.get(section, {}).get(key, {}).get(value, ())
+                ids = list(ids)
+            return [ Slate(section, k) for k in ids ]
+
         result = []
         for k,v in cls.section_cache.get(section, {}).items():
             d = v.get('data', {})
@@ -151,45 +358,316 @@ class RamStorage(SlateStorage):
         return result
 
     @classmethod
-    def find_between(cls, section, start, end, limit=None, skip=None):
-        sec = cls.section_cache.get(section, {}).keys()
-        sec = [ s for s in sec if start <= s and s < end ]
-        sec.sort()
-        if skip is None:
-            skip = 0
-        if limit is None:
-            limit = len(sec) - skip
-        return [ Slate(section, s) for s in sec[skip:skip + limit] ]
+    def _index_lists(cls, section):
+        return cls._get_section_config(section).get('index_lists', [])
+
+    @classmethod
+    def _index(cls, section, id, data, key=None):
+        """Adds id to the index for data's index_lists keys (or only for
+        key, if given).
+        """
+        index_lists = cls._index_lists(section)
+        keys = [ key ] if key is not None else data.keys()
+        with cls._section_lock(section):
+            for k in keys:
+                if k in index_lists and k in data:
+                    values = cls.indexes.setdefault(section, {}).setdefault(
+                        k, {}
+                        )
+                    snapshot = tuple(data[k])
+                    for v in snapshot:
+                        values.setdefault(v, set()).add(id)
+                    cls.indexed.setdefault(section, {}).setdefault(id, {})[
+                        k] = snapshot
+
+    @classmethod
+    def _unindex(cls, section, id, key=None):
+        """Removes id from the index for the values it was indexed under
+        (see indexed), for all keys or only for key, if given.
+        """
+        with cls._section_lock(section):
+            slate = cls.indexed.get(section, {}).get(id)
+            if not slate:
+                return
+            keys = [ key ] if key is not None else list(slate.keys())
+            for k in keys:
+                snapshot = slate.pop(k, None)
+                if snapshot is None:
+                    continue
+                values = cls.indexes.get(section, {}).get(k, {})
+                for v in snapshot:
+                    ids = values.get(v)
+                    if ids is not None:
+                        ids.discard(id)
+                        if not ids:
+                            del values[v]
+            if not slate:
+                del cls.indexed[section][id]
+
+    @classmethod
+    def count_between(cls, section, start, end):
+        with cls._section_lock(section):
+            ids = cls.sorted_ids.get(section, [])
+            return max(0,
+                bisect.bisect_left(ids, end) - bisect.bisect_left(ids, start)
+                )
+
+    @classmethod
+    def find_between(cls, section, start, end, limit=None, skip=None
+        , after=None
+        ):
+        with cls._section_lock(section):
+            ids = cls.sorted_ids.get(section, [])
+            if after is not None and after >= start:
+                lo = bisect.bisect_right(ids, after)
+            else:
+                lo = bisect.bisect_left(ids, start)
+            hi = bisect.bisect_left(ids, end)
+            if skip is not None:
+                lo += skip
+            if limit is not None:
+                hi = min(hi, lo + limit)
+            ids = ids[lo:hi]
+        return [ Slate(section, s) for s in ids ]
+
+    @classmethod
+    def _add_id(cls, section, id):
+        with cls._section_lock(section):
+            bisect.insort(cls.sorted_ids.setdefault(section, []), id)
+
+    @classmethod
+    def _remove_id(cls, section, id):
+        with cls._section_lock(section):
+            ids = cls.sorted_ids.get(section, [])
+            i = bisect.bisect_left(ids, id)
+            if i < len(ids) and ids[i] == id:
+                del ids[i]
 
     @classmethod
     def _is_expired(cls, section, name):
         obj = cls.section_cache.get(section, {}).get(name, None)
         if obj is None:
             return True
-        if obj['timeout'] is None:
+        if obj.timeout is None:
             return False
-        if obj['expire'] < time.time():
+        if obj.expire < time.time():
             return True
         return False
     
+    @classmethod
+    def setup(cls, conf):
+        cls.clean_chunk = int(conf.get('clean_chunk', 1000))
+        stripes = int(conf.get('lock_stripes', 64))
+        if stripes < 1:
+            raise ValueError("lock_stripes must be at least 1")
+        if stripes != len(cls.locks):
+            cls.locks = [ threading.RLock() for i in range(stripes) ]
+
+    @classmethod
+    def _slate_lock(cls, section, id):
+        """Returns the lock guarding the given slate."""
+        return cls.locks[hash((section, id)) % len(cls.locks)]
+
+    def _lock(self):
+        return self._slate_lock(self.section, self.id)
+
+    @classmethod
+    def _section_lock(cls, section):
+        """Returns the lock guarding section's expiry heap, index and 
+        sorted ids.
+        """
+        lock = cls.section_locks.get(section)
+        if lock is None:
+            lock = cls.section_locks.setdefault(section, threading.Lock())
+        return lock
+
+    @classmethod
+    def _new_id(cls):
+        with cls.id_lock:
+            idNum = cls.random_id_num
+            RamStorage.random_id_num = idNum + 1
+        return 'ramStore_' + str(idNum)
+
     @classmethod
     def clean_up(cls):
-        """Clean up expired slates."""
-        for s,c in list(cls.section_cache.items()):
-            for id in list(c.keys()):
-                if cls._is_expired(s, id):
-                    cls._expire(c, s, c[id])
+        """Clean up expired slates.  Only slates that are due are visited,
+        by popping them from the section's expiry heap clean_chunk at a
+        time; between chunks, other threads are given a chance to run.
+
+        Returns a dict of section: number of slates deleted.
+        """
+        result = {}
+        for section in list(cls.expiry_heaps.keys()):
+            count = cls._clean_section(section, time.time())
+            result[section] = count
+            if count:
+                log('Cleaned {0} expired slates from {1}'.format(
+                    count, section
+                    ))
         log('Cleaned expired slates')
+        return result
+
+    @classmethod
+    def _clean_section(cls, section, now):
+        """Deletes the slates in section that expired before now.  Returns
+        the number deleted.
+        """
+        heap = cls.expiry_heaps.get(section, [])
+        store = cls.section_cache.get(section, {})
+        count = 0
+        while True:
+            due = []
+            with cls._section_lock(section):
+                while heap and heap[0][0] < now and len(due) < cls.clean_chunk:
+                    due.append(heapq.heappop(heap))
+            for expire, id in due:
+                with cls._slate_lock(section, id):
+                    record = store.get(id)
+                    if record is not None and record.expire == expire:
+                        del store[id]
+                        cls._drop(section, id, record)
+                        count += 1
+            if len(due) < cls.clean_chunk:
+                break
+            time.sleep(0)
+        return count
+
+    @classmethod
+    def _drop(cls, section, id, record):
+        """Removes a record that was just deleted from (or replaced in) 
+        section_cache from the section's index, sorted ids and accounting.
+        Called with the slate's lock held.
+        """
+        cls._unindex(section, id)
+        cls._remove_id(section, id)
+        if section in cls.section_stats:
+            with cls._section_lock(section):
+                cls.lru[section].pop(id, None)
+                cls.section_stats[section]['bytes'] -= record.size
+
+    @classmethod
+    def _is_capped(cls, section):
+        conf = cls._get_section_config(section)
+        return 'max_entries' in conf or 'max_bytes' in conf
+
+    @classmethod
+    def _capped_section(cls, section):
+        """Returns the section's LRU ordering and counters, creating them
+        the first time.  Called with the section lock held.
+        """
+        stats = cls.section_stats.get(section)
+        if stats is None:
+            stats = cls.section_stats[section] = {
+                'bytes': 0
+                ,'evictions': 0
+                ,'expired_evictions': 0
+                }
+            cls.lru[section] = collections.OrderedDict()
+        return cls.lru[section], stats
+
+    @classmethod
+    def _used(cls, section, id):
+        """Marks a slate as most recently used."""
+        with cls._section_lock(section):
+            lru, stats = cls._capped_section(section)
+            lru.pop(id, None)
+            lru[id] = True
+
+    def _account(self):
+        """Updates the size of this slate's record and marks it as most 
+        recently used.  Called with _lock() held, after a write.
+        """
+        size = 0
+        if 'max_bytes' in self.get_section_config():
+            size = _approx_size(self.record.data)
+        with self._section_lock(self.section):
+            lru, stats = self._capped_section(self.section)
+            stats['bytes'] += size - self.record.size
+            self.record.size = size
+            lru.pop(self.id, None)
+            lru[self.id] = True
+
+    @classmethod
+    def _evict(cls, section):
+        """Deletes slates from section until it is within its max_entries 
+        and max_bytes; expired slates first, then least recently used.
+        """
+        conf = cls._get_section_config(section)
+        max_entries = conf.get('max_entries')
+        max_bytes = conf.get('max_bytes')
+        if max_entries is None and max_bytes is None:
+            return
+        store = cls.section_cache.get(section, {})
+        stats = cls.section_stats.get(section)
+        if stats is None:
+            return
+
+        def over():
+            return (
+                max_entries is not None and len(store) > max_entries
+                or max_bytes is not None and stats['bytes'] > max_bytes
+                )
+
+        if not over():
+            return
+        expired = cls._clean_section(section, time.time())
+        with cls._section_lock(section):
+            stats['expired_evictions'] += expired
+
+        while over():
+            with cls._section_lock(section):
+                lru = cls.lru[section]
+                if not lru:
+                    break
+                id = lru.popitem(last=False)[0]
+            with cls._slate_lock(section, id):
+                record = store.pop(id, None)
+                if record is not None:
+                    cls._drop(section, id, record)
+                    with cls._section_lock(section):
+                        stats['evictions'] += 1
+        log('Evicted slates from {0}; now {1} slates, {2} bytes'.format(
+            section, len(store), stats['bytes']
+            ))
+
+    @classmethod
+    def get_stats(cls, section):
+        """Returns a dict of counters for section: entries (slates held),
+        bytes (estimated size of their data, if max_bytes is set), 
+        evictions (live slates deleted to stay within the caps) and 
+        expired_evictions (expired slates deleted for the same reason).
+        """
+        with cls._section_lock(section):
+            result = dict(cls.section_stats.get(section, {
+                'bytes': 0, 'evictions': 0, 'expired_evictions': 0
+                }))
+        result['entries'] = len(cls.section_cache.get(section, {}))
+        return result
+
+    @classmethod
+    def _schedule(cls, section, id, expire):
+        """Adds a slate's new expiration time to its section's expiry heap.
+        Rebuilds the heap from the live records if stale entries have come
+        to outnumber them.
+        """
+        with cls._section_lock(section):
+            heap = cls.expiry_heaps.setdefault(section, [])
+            heapq.heappush(heap, (expire, id))
+            store = cls.section_cache.get(section, {})
+            if len(heap) > 2 * len(store) + 64:
+                heap[:] = [ (r.expire, i) for i, r in list(store.items())
+                    if r.expire is not None
+                    ]
+                heapq.heapify(heap)
 
     @classmethod
     def _expire(cls, section, slate):
         """Utility function to expire a certain slate.  
         slate is the Slate object, section is the section key.
         """
-        try:
-            del cls.section_cache[section][slate.id]
-        except KeyError:
-            pass
+        record = cls.section_cache.get(section, {}).pop(slate.id, None)
+        if record is not None:
+            cls._drop(section, slate.id, record)
     
     def __len__(self):
         """Return the number of active sessions."""
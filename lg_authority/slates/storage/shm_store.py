@@ -0,0 +1,491 @@
+import contextlib
+import fcntl
+import marshal
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+import uuid
+import zlib
+
+from .common import *
+from . import codec
+from ..slates import Slate
+
+class ShmBucketFullError(Exception):
+    """A slate did not fit in its bucket, even with every other slate
+    dropped from it.  See ShmStorage's bucket_size.
+    """
+
+
+class ShmStorage(SlateStorage):
+    """Storing slates in a memory-mapped file shared by every process on
+    the host that opens it, so that pre-forked servers share slates
+    without a database.  Put the file on a tmpfs (such as /dev/shm) and it
+    never touches the disk.
+
+    The file is a hash table of fixed-size buckets.  Each slate lives in the
+    bucket that its section and id hash to, as an entry (timeout, expire,
+    encoded data) in the bucket's marshalled dict of slates.  Every read or
+    write of a slate locks its bucket, against other processes with an
+    fcntl lock on the bucket's bytes and against other threads with a lock
+    per bucket, and rewrites only that bucket.  So writes to one slate
+    never lose each other's changes, and writes to different slates rarely
+    wait on each other.
+
+    Expired slates are dropped from every bucket by clean_up.  A write
+    that would overflow its bucket drops the bucket's expired slates, and
+    then its other slates in order of expiry (soonest first), until it
+    fits.  find_with, find_between and the count_ methods scan every
+    bucket.
+
+    Each bucket holds the length and crc32 of its marshalled entries,
+    written after the entries themselves.  A bucket left half written (by
+    a process killed while writing it) fails the check and reads as empty,
+    losing its slates rather than every later read and write of them.
+
+    Available params in storage_conf:
+        file: Path of the shared file.  Default lg_authority.slates in
+            /dev/shm if it exists, or else in the temporary directory.
+        buckets: Number of buckets.  Default 4096.
+        bucket_size: Bytes per bucket.  A slate too big for a bucket of 
+            its own raises ShmBucketFullError.  Default 16384.
+        codec, compress_threshold: As for Sqlite3Storage.
+    Every process sharing a file must use the same buckets and bucket_size;
+    opening an existing file with others raises ValueError.
+    """
+
+    magic = b'LGSHM001'
+    magic__doc = "First bytes of the shared file"
+
+    header_format = '<8sII'
+    header_format__doc = "struct format of magic, buckets and bucket_size"
+
+    header_size = 4096
+    header_size__doc = "Bytes before the first bucket"
+
+    bucket_header_format = '<II'
+    bucket_header_format__doc = """struct format of the length and crc32 of
+        a bucket's entries, which follow it
+        """
+
+    storage_file = None
+    buckets = 4096
+    bucket_size = 16384
+
+    fd = None
+    fd__doc = "File descriptor of the open shared file"
+
+    map = None
+    map__doc = "mmap of the shared file"
+
+    bucket_locks = []
+    bucket_locks__doc = "Per bucket threading locks"
+
+    def __init__(self, section, id, timeout):
+        self.section = section
+        self.id = id
+        self.timeout = timeout
+
+    def _key(self):
+        return self._make_key(self.section, self.id)
+
+    def _expired(self):
+        """Sets this object up so that it has expired."""
+        self.expired = True
+        self.data = {}
+
+    def _access(self):
+        """Called before access of any type"""
+        if hasattr(self, '_first_access'):
+            return
+        self._first_access = True
+
+        entry = None
+        if self.id is not None:
+            key = self._key()
+            bucket = self._bucket_of(key)
+            with self._locked(bucket, False):
+                entry = self._read_bucket(bucket).get(key)
+
+        if entry is None or self._entry_expired(entry, time.time()):
+            self._expired()
+            log('Loaded new (expired) slate')
+        else:
+            self.expired = False
+            self.data = codec.decode(entry[2])
+            self.expiry = entry[1]
+            if isinstance(self.timeout, dict):
+                self.timeout = entry[0]
+            log('Loaded slate with {0}'.format(self.data))
+
+    def _write(self, change):
+        """Applies change (which modifies a dict in place) to the stored
+        slate, with its bucket locked, and then to this object's view of
+        the slate.  Returns what change returned for the view.
+        """
+        self._access()
+        if self.id is None:
+            self.id = self.generateId()
+
+        #If timeout is a dict, that means we shouldn't do anything with
+        #existing timeout.
+        useTimeout = not isinstance(self.timeout, dict)
+
+        key = self._key()
+        bucket = self._bucket_of(key)
+        with self._locked(bucket, True):
+            entries = self._read_bucket(bucket)
+            entry = entries.get(key)
+            now = time.time()
+            if entry is None or self._entry_expired(entry, now):
+                if not useTimeout:
+                    raise ValueError("Timeout must be specified when writing "
+                        + "a new slate."
+                        )
+                if not self.expired:
+                    #Expired or deleted elsewhere since we loaded it
+                    self._expired()
+                data = {}
+                timeout = self.timeout
+            else:
+                data = codec.decode(entry[2])
+                if self.expired:
+                    #Created elsewhere since we loaded it
+                    self.data = data.copy()
+                timeout = self.timeout if useTimeout else entry[0]
+
+            change(data)
+            expire = None
+            if timeout is not None:
+                expire = now + timeout
+            entries[key] = (timeout, expire, codec.encode(
+                self.get_section_codec(), data
+                , self.get_section_compress_threshold()
+                ))
+            self._write_bucket(bucket, entries, key)
+
+        self.expired = False
+        self.timeout = timeout
+        self.expiry = expire
+        return change(self.data)
+
+    def __str__(self):
+        return "SHM({0})".format(self.id)
+
+    def __repr__(self):
+        return str(self)
+
+    def touch(self):
+        self._write(lambda data: None)
+
+    def set(self, key, value):
+        def change(data):
+            data[key] = value
+        self._write(change)
+
+    def update(self, d):
+        self._write(lambda data: data.update(d))
+
+    def get(self, key, default):
+        self._access()
+        return self.data.get(key, default)
+
+    def pop(self, key, default):
+        return self._write(lambda data: data.pop(key, default))
+
+    def clear(self):
+        self._write(lambda data: data.clear())
+
+    def keys(self):
+        self._access()
+        return self.data.keys()
+
+    def items(self):
+        self._access()
+        return self.data.items()
+
+    def values(self):
+        self._access()
+        return self.data.values()
+
+    def expire(self):
+        if self.id is not None:
+            key = self._key()
+            bucket = self._bucket_of(key)
+            with self._locked(bucket, True):
+                entries = self._read_bucket(bucket)
+                if entries.pop(key, None) is not None:
+                    self._write_bucket(bucket, entries)
+        self._first_access = True
+        self._expired()
+
+    def is_expired(self):
+        self._access()
+        return self.expired
+
+    def time_to_expire(self):
+        self._access()
+        if self.expired:
+            return 0
+        if self.expiry is None:
+            return None
+        return max(0, self.expiry - time.time())
+
+    @classmethod
+    def generateId(cls):
+        """Generates a UUID for a new slate that has no ID"""
+        return uuid.uuid4().hex
+
+    @classmethod
+    def destroySectionBeCarefulWhenYouCallThis(cls, section):
+        prefix = cls._make_key(section, '')
+        for bucket in range(cls.buckets):
+            with cls._locked(bucket, True):
+                entries = cls._read_bucket(bucket)
+                keys = [ k for k in entries if k.startswith(prefix) ]
+                if keys:
+                    for k in keys:
+                        del entries[k]
+                    cls._write_bucket(bucket, entries)
+
+    @classmethod
+    def count_with(cls, section, key, value):
+        result = 0
+        for id, entry in cls._scan(section):
+            if value in codec.decode(entry[2]).get(key, []):
+                result += 1
+        return result
+
+    @classmethod
+    def find_with(cls, section, key, value):
+        return [ Slate(section, id) for id, entry in cls._scan(section)
+            if value in codec.decode(entry[2]).get(key, [])
+            ]
+
+    @classmethod
+    def count_between(cls, section, start, end):
+        result = 0
+        for id, entry in cls._scan(section):
+            if start <= id and id < end:
+                result += 1
+        return result
+
+    @classmethod
+    def find_between(cls, section, start, end, limit=None, skip=None
+        , after=None
+        ):
+        sec = [ id for id, entry in cls._scan(section)
+            if start <= id and id < end
+            ]
+        if after is not None:
+            sec = [ s for s in sec if s > after ]
+        sec.sort()
+        if skip is None:
+            skip = 0
+        if limit is None:
+            limit = len(sec) - skip
+        return [ Slate(section, s) for s in sec[skip:skip + limit] ]
+
+    @classmethod
+    def setup(cls, conf):
+        file = conf.get('file')
+        if file is None:
+            dir = '/dev/shm'
+            if not os.path.isdir(dir):
+                dir = tempfile.gettempdir()
+            file = os.path.join(dir, 'lg_authority.slates')
+        buckets = int(conf.get('buckets', 4096))
+        bucket_size = int(conf.get('bucket_size', 16384))
+        if buckets < 1:
+            raise ValueError("buckets must be at least 1")
+        if bucket_size < 64:
+            raise ValueError("bucket_size must be at least 64")
+
+        cls.shutdown()
+        cls.default_codec = conf.get('codec', 'pickle')
+        cls.default_compress_threshold = conf.get('compress_threshold', None)
+
+        size = cls.header_size + buckets * bucket_size
+        fd = os.open(file, os.O_RDWR | os.O_CREAT, 0600)
+        try:
+            #Whoever gets here first initializes the file
+            fcntl.lockf(fd, fcntl.LOCK_EX, cls.header_size, 0)
+            try:
+                header = os.read(fd, struct.calcsize(cls.header_format))
+                if len(header) < struct.calcsize(cls.header_format):
+                    os.ftruncate(fd, size)
+                    os.lseek(fd, 0, os.SEEK_SET)
+                    os.write(fd, struct.pack(cls.header_format, cls.magic
+                        , buckets, bucket_size
+                        ))
+                else:
+                    magic, fileBuckets, fileBucketSize = struct.unpack(
+                        cls.header_format, header
+                        )
+                    if magic != cls.magic:
+                        raise ValueError("Not a slate file: " + file)
+                    if (fileBuckets, fileBucketSize) != (buckets, bucket_size):
+                        raise ValueError(("{0} has {1} buckets of {2} bytes, "
+                            + "not {3} of {4}").format(file, fileBuckets
+                                , fileBucketSize, buckets, bucket_size
+                                )
+                            )
+            finally:
+                fcntl.lockf(fd, fcntl.LOCK_UN, cls.header_size, 0)
+            shared = mmap.mmap(fd, size)
+        except:
+            os.close(fd)
+            raise
+
+        cls.storage_file = file
+        cls.buckets = buckets
+        cls.bucket_size = bucket_size
+        cls.bucket_locks = [ threading.Lock() for i in range(buckets) ]
+        cls.fd = fd
+        cls.map = shared
+
+    @classmethod
+    def shutdown(cls):
+        """Unmaps and closes the shared file."""
+        if cls.map is not None:
+            cls.map.close()
+            cls.map = None
+        if cls.fd is not None:
+            os.close(cls.fd)
+            cls.fd = None
+
+    @classmethod
+    def clean_up(cls):
+        """Drops expired slates from every bucket.
+
+        Returns a dict of section: number of slates deleted, for sections
+        that had any.
+        """
+        result = {}
+        for bucket in range(cls.buckets):
+            with cls._locked(bucket, True):
+                entries = cls._read_bucket(bucket)
+                now = time.time()
+                expired = [ k for k, e in entries.items()
+                    if cls._entry_expired(e, now)
+                    ]
+                if expired:
+                    for k in expired:
+                        del entries[k]
+                        section = k.split('\0', 1)[0]
+                        result[section] = result.get(section, 0) + 1
+                    cls._write_bucket(bucket, entries)
+        for section, count in result.items():
+            log('Cleaned {0} expired slates from {1}'.format(count, section))
+        log('Cleaned expired slates')
+        return result
+
+    @staticmethod
+    def _make_key(section, id):
+        """Returns the key of a slate within its bucket"""
+        key = section + '\0' + id
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return key
+
+    @staticmethod
+    def _entry_expired(entry, now):
+        return entry[1] is not None and entry[1] < now
+
+    @classmethod
+    def _bucket_of(cls, key):
+        return (zlib.crc32(key) & 0xffffffff) % cls.buckets
+
+    @classmethod
+    @contextlib.contextmanager
+    def _locked(cls, bucket, exclusive):
+        """Locks a bucket against other threads and processes; shared
+        between processes unless exclusive.
+        """
+        start = cls.header_size + bucket * cls.bucket_size
+        with cls.bucket_locks[bucket]:
+            fcntl.lockf(cls.fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+                , cls.bucket_size, start
+                )
+            try:
+                yield
+            finally:
+                fcntl.lockf(cls.fd, fcntl.LOCK_UN, cls.bucket_size, start)
+
+    @classmethod
+    def _read_bucket(cls, bucket):
+        """Returns the dict of slate entries in bucket, which must be
+        locked.
+        """
+        start = cls.header_size + bucket * cls.bucket_size
+        length, crc = struct.unpack_from(cls.bucket_header_format, cls.map
+            , start
+            )
+        if not length:
+            return {}
+        offset = start + struct.calcsize(cls.bucket_header_format)
+        data = cls.map[offset:offset + length]
+        try:
+            if zlib.crc32(data) & 0xffffffff != crc:
+                raise ValueError("Bad checksum")
+            return marshal.loads(data)
+        except (EOFError, TypeError, ValueError) as e:
+            #The next write replaces it
+            log('Dropping unreadable shm bucket {0}: {1}'.format(bucket, e))
+            return {}
+
+    @classmethod
+    def _write_bucket(cls, bucket, entries, key=None):
+        """Stores entries in bucket, which must be locked exclusively.  If
+        they do not fit, expired entries are dropped first, and then those
+        closest to expiry other than key (the slate being written); if key
+        alone does not fit, raises ShmBucketFullError.
+        """
+        room = cls.bucket_size - struct.calcsize(cls.bucket_header_format)
+        data = marshal.dumps(entries) if entries else b''
+        if len(data) > room:
+            now = time.time()
+            for k, e in list(entries.items()):
+                if cls._entry_expired(e, now):
+                    del entries[k]
+            data = marshal.dumps(entries) if entries else b''
+            live = sorted([ (e[1] is None, e[1], k)
+                for k, e in entries.items() if k != key
+                ])
+            evicted = 0
+            while len(data) > room and evicted < len(live):
+                del entries[live[evicted][2]]
+                evicted += 1
+                data = marshal.dumps(entries) if entries else b''
+            if evicted:
+                log('Evicted {0} slates from full shm bucket {1}'.format(
+                    evicted, bucket
+                    ))
+            if len(data) > room:
+                raise ShmBucketFullError(("Slate {0!r} does not fit in its "
+                    + "bucket ({1} bytes needed, bucket_size is {2})").format(
+                        key, len(data) + cls.bucket_size - room
+                        , cls.bucket_size
+                        )
+                    )
+        start = cls.header_size + bucket * cls.bucket_size
+        offset = start + struct.calcsize(cls.bucket_header_format)
+        cls.map[offset:offset + len(data)] = data
+        struct.pack_into(cls.bucket_header_format, cls.map, start, len(data)
+            , zlib.crc32(data) & 0xffffffff
+            )
+
+    @classmethod
+    def _scan(cls, section):
+        """Yields (id, entry) for every unexpired slate in section."""
+        prefix = cls._make_key(section, '')
+        for bucket in range(cls.buckets):
+            with cls._locked(bucket, False):
+                entries = cls._read_bucket(bucket)
+            now = time.time()
+            for k, e in entries.items():
+                if k.startswith(prefix) and not cls._entry_expired(e, now):
+                    yield k[len(prefix):], e
@@ -0,0 +1,34 @@
+"""Converts a section of a sqlite3 slate database between the 'rows' and
+'document' layouts (see Sqlite3Storage).  Stop every process using the
+database first, and set the section's 'layout' option to match afterward.
+
+Values are written with the pickle codec; set a codec in site_storage_conf
+and call Sqlite3Storage.migrate_layout() directly to use another.
+
+Usage: python -m lg_authority.slates.storage.sqlite3_migrate FILE SECTION LAYOUT
+"""
+
+from __future__ import print_function
+
+import sys
+
+from .sqlite3_store import Sqlite3Storage
+
+def main(args):
+    if len(args) != 3 or args[2] not in Sqlite3Storage.layouts:
+        print(__doc__)
+        return 1
+
+    file, section, layout = args
+    Sqlite3Storage.setup({ 'file': file })
+    try:
+        count = Sqlite3Storage.migrate_layout(section, layout)
+    finally:
+        Sqlite3Storage.shutdown()
+    print('Converted {0} slates in {1} to layout {2}'.format(
+        count, section, layout
+        ))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
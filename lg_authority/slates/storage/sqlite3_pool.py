@@ -0,0 +1,207 @@
+"""A bounded pool of sqlite3 connections shared by all threads.
+
+Connections are checked out for the duration of one storage operation (see
+ConnectionPool.connection()) and returned afterward, so the number of open
+connections is bounded by the pool size rather than by the number of
+threads that ever touched storage.  A thread that already holds a
+connection gets the same one back when it asks again, so nested operations
+neither deadlock on a small pool nor split one transaction across
+connections.
+
+Connections idle for longer than idle_timeout are closed by reap(), which
+runs whenever a connection is returned and from Sqlite3Storage.clean_up.
+"""
+
+import threading
+import time
+
+class PoolTimeoutError(Exception):
+    """No connection became free within the pool's wait_timeout."""
+
+
+class ConnectionPool(object):
+    """See module docstring.  connect is called with no arguments to open a
+    new connection; it must return one usable from any thread (sqlite3's
+    check_same_thread=False).
+    """
+
+    max_size = 10
+    max_size__doc = "Most connections open at once"
+
+    idle_timeout = 300
+    idle_timeout__doc = """Seconds a connection may sit unused before it is
+        closed.  None keeps idle connections open.
+        """
+
+    wait_timeout = 30
+    wait_timeout__doc = """Seconds to wait for a free connection before
+        raising PoolTimeoutError.  None waits forever.
+        """
+
+    def __init__(self, connect, max_size=10, idle_timeout=300
+        , wait_timeout=30
+        ):
+        self._connect = connect
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.wait_timeout = wait_timeout
+
+        self._lock = threading.Condition(threading.Lock())
+        self._local = threading.local()
+        self._idle = [] #(connection, time returned), most recent last
+        self._open = 0
+        self._generation = 0
+        self.stats = {
+            'checkouts': 0
+            ,'waits': 0
+            ,'wait_time': 0.0
+            ,'timeouts': 0
+            ,'opened': 0
+            ,'closed': 0
+            }
+
+    def connection(self):
+        """Returns a context manager that checks a connection out for the
+        current thread and returns it to the pool on exit:
+
+            with pool.connection() as db:
+                db.execute(...)
+        """
+        return _PooledConnection(self)
+
+    def checkout(self):
+        """Returns a connection for the current thread.  Every checkout()
+        must be matched by a checkin().
+        """
+        held = getattr(self._local, 'held', None)
+        if held is not None:
+            held[1] += 1
+            return held[0]
+
+        with self._lock:
+            self.stats['checkouts'] += 1
+            while not self._idle and self._open >= self.max_size:
+                self._wait()
+            generation = self._generation
+            if self._idle:
+                db = self._idle.pop()[0]
+            else:
+                #Reserve the slot, then connect without holding the lock
+                self._open += 1
+                db = None
+
+        if db is None:
+            try:
+                db = self._connect()
+            except:
+                with self._lock:
+                    self._open -= 1
+                    self._lock.notify()
+                raise
+            with self._lock:
+                self.stats['opened'] += 1
+
+        self._local.held = [ db, 1, generation ]
+        return db
+
+    def checkin(self, db, failed=False):
+        """Returns a connection obtained from checkout().  If failed is set,
+        any transaction left open on it is rolled back before it is reused.
+        """
+        held = self._local.held
+        held[1] -= 1
+        if held[1] > 0:
+            return
+        self._local.held = None
+
+        if failed:
+            try:
+                db.rollback()
+            except Exception:
+                pass
+
+        with self._lock:
+            if held[2] != self._generation:
+                self._close(db)
+            else:
+                self._idle.append((db, time.time()))
+            self._lock.notify()
+        self.reap()
+
+    def reap(self):
+        """Closes connections that have been idle for too long."""
+        if self.idle_timeout is None:
+            return
+        cutoff = time.time() - self.idle_timeout
+        with self._lock:
+            #_idle is in the order connections were returned
+            while self._idle and self._idle[0][1] < cutoff:
+                self._close(self._idle.pop(0)[0])
+                self._lock.notify()
+
+    def close(self):
+        """Closes all idle connections, and any checked out connections as
+        they are returned.  The pool may still be used afterward; it will
+        open new connections as needed.
+        """
+        with self._lock:
+            self._generation += 1
+            while self._idle:
+                self._close(self._idle.pop()[0])
+            self._lock.notify_all()
+
+    def get_stats(self):
+        """Returns a copy of the pool's counters, plus the number of open and
+        idle connections.
+        """
+        with self._lock:
+            result = dict(self.stats)
+            result['open'] = self._open
+            result['idle'] = len(self._idle)
+        return result
+
+    def _wait(self):
+        """Waits (with _lock held) for a connection to be returned."""
+        self.stats['waits'] += 1
+        start = time.time()
+        if self.wait_timeout is None:
+            self._lock.wait()
+        else:
+            self._lock.wait(self.wait_timeout)
+        waited = time.time() - start
+        self.stats['wait_time'] += waited
+        if (
+            self.wait_timeout is not None
+            and not self._idle
+            and self._open >= self.max_size
+            and waited >= self.wait_timeout
+            ):
+            self.stats['timeouts'] += 1
+            raise PoolTimeoutError(
+                "No sqlite3 connection free after {0} seconds".format(
+                    self.wait_timeout
+                    )
+                )
+
+    def _close(self, db):
+        """Closes db (with _lock held)."""
+        self._open -= 1
+        self.stats['closed'] += 1
+        try:
+            db.close()
+        except Exception:
+            pass
+
+
+class _PooledConnection(object):
+    def __init__(self, pool):
+        self.pool = pool
+
+    def __enter__(self):
+        self.db = self.pool.checkout()
+        return self.db
+
+    def __exit__(self, type, value, tb):
+        self.pool.checkin(self.db, type is not None)
+        return False
+
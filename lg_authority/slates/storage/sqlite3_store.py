@@ -1,11 +1,9 @@
-import datetime
+import math
 import threading
+import time
 import uuid
-try:
-    import cPickle as pickle
-except ImportError:
-    import pickle
 from .common import *
+from .sqlite3_pool import ConnectionPool
 from ..slates import Slate
 
 try:
@@ -20,18 +18,87 @@ class Sqlite3Storage(SlateStorage):
 
     Available params in storage_conf:
         file: The sqlite database file.
+        codec: Value codec for sections that do not name one (see codec.py)
+        compress_threshold: Encoded size in bytes at which values are zlib
+            compressed, for sections that do not specify one.  Default off.
+        journal_mode: SQLite journal mode (delete, truncate, persist, 
+            memory, wal or off).  'wal' lets other threads and processes
+            read while a slate is being written.  Default is SQLite's own
+            (delete).
+        synchronous: SQLite synchronous setting (off, normal, full or 
+            extra).  'normal' is safe with 'wal' and much faster than 
+            SQLite's default of 'full'.
+        cache_size: SQLite page cache size per connection; pages if 
+            positive, KiB if negative.
+        mmap_size: Bytes of the database file to access through mmap.
+        busy_timeout: Seconds to wait for another connection's lock before
+            raising.  Default 5.
+        pool_size: Most connections open at once, shared by all threads.
+            Default 10.  Always 1 for ':memory:' databases, since each
+            connection to one would see a different database.
+        pool_idle: Seconds before an unused connection is closed.  Default
+            300; None keeps connections open.
+        pool_wait: Seconds to wait for a free connection before raising
+            sqlite3_pool.PoolTimeoutError.  Default 30; None waits forever.
+        statement_cache: Prepared statements kept per connection.  Default
+            100.
+        clean_chunk: Expired slates deleted per transaction by clean_up.
+            Default 500.
+
+    Sections may also set 'layout' in site_storage_sections_{section}:
+        rows: (default) One row per key in {section}_data, so a slate's keys
+            are loaded and written individually (see the 'cache' option).
+        document: The whole slate is encoded into a data column of its
+            {section} row, so loading or writing it touches one row (plus 
+            {section}_index rows for index_lists keys).  Suits sections 
+            that are always read whole, such as sessions.  'cache' is 
+            ignored.  Writes read the stored document back before changing
+            it, so that concurrent writes to different keys both survive.
+    The layout of a section's existing tables is used regardless of its 
+    configuration; convert them with migrate_layout() (or the 
+    sqlite3_migrate module).
     """
 
+    layouts = ( 'rows', 'document' )
+    layouts__doc = "Allowed values for a section's 'layout' option"
+
+    schema_version = 2
+    schema_version__doc = """Version of the table layout for a section.
+        Recorded per section in schema_table, and checked when a section is
+        first seen (see _get_section).
+            1 - expire stored as a TIMESTAMP string
+            2 - expire stored as integer seconds since the epoch (UTC)
+        """
+
+    schema_table = 'lg_authority_schema'
+    schema_table__doc = "Table recording each section's schema version"
+
+    pragma_values = {
+        'journal_mode': ( 'delete', 'truncate', 'persist', 'memory', 'wal'
+            , 'off' )
+        ,'synchronous': ( 'off', 'normal', 'full', 'extra' )
+        ,'cache_size': int
+        ,'mmap_size': int
+        }
+    pragma_values__doc = """site_storage_conf options applied as PRAGMAs
+        to each new connection, with either the allowed values or the type
+        they must be converted to.
+        """
+
     def __init__(self, section, id, timeout):
         self.section = section
         self.id = id
         self.timeout = timeout
         self._section = self._get_section(self.section)
+        self._layout = self.section_layouts[self.section]
         self._conf = self.get_section_config()
+        self._codec = self.get_section_codec()
+        self._compress_threshold = self.get_section_compress_threshold()
     
     def _expired(self):
         """Call to set this Slate's local state as expired"""
         self.expired = True
+        self.cache_complete = True
         for j in self.cache.keys():
             self.cache[j] = missing
 
@@ -41,52 +108,90 @@ class Sqlite3Storage(SlateStorage):
             return
         self._first_access = True
 
-        db = self._get_db()
-        try:
-            cur = db.cursor()
-            cur.execute("""SELECT id,timeout,expire FROM "{0}" WHERE id = ?""".format(self.section), (self.id,))
-            core = cur.fetchone()
+        #The header and data rows come back in one query.  Data rows are
+        #only joined for unexpired slates, and only for keys in the 
+        #section's cache list if it has one; the rest are fetched on 
+        #demand.
+        now = time.time()
+        prefetch = self._conf.get('cache')
+        if self._layout == 'document':
+            prefetch = None
+            query = """SELECT timeout,expire,data FROM "{0}" WHERE id = ?"""
+            args = []
+        else:
+            query = """SELECT h.timeout,h.expire,d.key,d.value FROM "{0}" h LEFT JOIN "{0}_data" d ON d.id = h.id AND (h.expire IS NULL OR h.expire >= ?)"""
+            args = [ now ]
+            if prefetch is not None:
+                query += """ AND d.key IN ({1})"""
+                args.extend(prefetch)
+            query += """ WHERE h.id = ?"""
+        args.append(self.id)
+
+        with self._connection() as db:
+            try:
+                cur = db.cursor()
+                cur.execute(query.format(
+                    self.section, ','.join([ '?' ] * len(prefetch or []))
+                    ), args)
+                rows = cur.fetchall()
+            finally:
+                cur.close()
 
-            now = datetime.datetime.utcnow()
-            self.cache = {}
-    
-            if core is None or (core[2] is not None and core[2] < now):
-                self._expired()
-                if core is not None:
-                    self.expired = 'existed'
-                log('Loaded new {1}slate: {0}'.format(
-                    self.id
-                    , '(expired) ' if core is not None else ''
-                    ))
+        self.cache = {}
+        core = rows[0] if rows else None
+        if core is None or (core[1] is not None and core[1] < now):
+            self._expired()
+            if core is not None:
+                self.expired = 'existed'
+            log('Loaded new {1}slate: {0}'.format(
+                self.id
+                , '(expired) ' if core is not None else ''
+                ))
+        else:
+            self.expired = False
+            self.expiry = core[1]
+
+            if prefetch is None:
+                self.cache_complete = True
             else:
-                self.expired = False
-                self.expiry = core[2]
-    
-                #Fetch data elements
-                cur.execute("""SELECT key,value FROM "{0}_data" WHERE id = ?""".format(self.section), (self.id,))
-                vals = cur.fetchall()
-                for k,v in vals:
-                    self.cache[k] = self._get(k, v)
+                self.cache_complete = False
+                for k in prefetch:
+                    self.cache[k] = missing
+            if self._layout == 'document':
+                if core[2] is not None:
+                    self.cache = self._get(None, core[2])
+            else:
+                for row in rows:
+                    if row[2] is not None:
+                        self.cache[row[2]] = StoredValue(row[3])
 
-                if isinstance(self.timeout, dict):
-                    self.timeout = core[1]
-    
-                log('Loaded slate {1} with {0}'.format(self.cache, self.id))
-                
-        finally:
-            cur.close()
+            if isinstance(self.timeout, dict):
+                self.timeout = core[0]
+
+            log('Loaded slate {1} with {0}'.format(self.cache, self.id))
 
-    def _write(self, fields=None):
+        self._batch_apply()
+
+    def _write(self, fields=None, clear=False):
         """Called before any write operation to setup the storage.
         Implicitly calls _access(), then writes either a brand
         new record or updates the old one, depending on expired status.
 
-        fields may be set to a dict to also set those values.
+        fields may be set to a dict to also set those values; a value of
+        missing deletes that key.  If clear is set, all values not in
+        fields are deleted.
+
+        If a SlateBatch is active, the write is held in it rather than
+        written now.
         """
         self._access()
 
         fields = fields or {}
 
+        if clear:
+            for k in self.cache.keys():
+                self.cache[k] = missing
+            self.cache_complete = True
         for k,v in fields.items():
             self.cache[k] = v
 
@@ -96,37 +201,107 @@ class Sqlite3Storage(SlateStorage):
             else:
                 raise ArgumentError("Code assertion - should have timeout")
 
-        db = self._get_db()
-        with db:
-            cur = db.cursor()
+        if self.expired and self.id is None:
+            self.id = Sqlite3Storage.generateId()
 
-            if self.expired:
-                if self.expired == 'existed':
-                    self._clear_slate(self.section, self.id, True)
-                if self.id is None:
-                    self.id = Sqlite3Storage.generateId()
-                new_vals = [self.id, self.timeout, None]
-                if self.timeout is not None:
-                    new_vals[2] = datetime.datetime.utcnow() + datetime.timedelta(seconds=self.timeout)
+        if not self._batch_hold(fields, clear):
+            with self._connection() as db:
+                with db:
+                    cur = db.cursor()
+                    self._write_rows(cur, self.expired, fields, clear)
+
+        self.expired = False
+
+    def _write_entry(self, entry):
+        with self._connection() as db:
+            with db:
+                cur = db.cursor()
+                self._write_rows(cur, entry.expired, entry.fields, entry.clear)
+
+    @classmethod
+    def write_batch(cls, entries):
+        with cls._connection() as db:
+            with db:
+                cur = db.cursor()
+                for entry in entries:
+                    entry.storage._write_rows(
+                        cur, entry.expired, entry.fields, entry.clear
+                        )
+
+    def _write_rows(self, cur, expired, fields, clear=False):
+        """Writes this slate's header and the given fields (see _write) 
+        through cur, without committing.  expired is the slate's expired
+        state before the write.
+        """
+        if expired:
+            if expired == 'existed':
+                self._delete_slate_rows(cur, self.section, self.id, True)
+        elif clear:
+            self._delete_slate_rows(cur, self.section, self.id)
+
+        if self._layout == 'document':
+            #Only the written fields are applied to the stored document, so
+            #writes to other keys since we loaded are kept.  Updating the
+            #header first takes the write lock before the document is read.
+            doc = {}
+            if not expired:
+                new_vals = [self.timeout, self._expire_time(), self.id]
+                cur.execute("""UPDATE "{0}" SET timeout=?, expire=? WHERE id=?""".format(self.section), new_vals)
+                if not clear:
+                    row = cur.execute("""SELECT data FROM "{0}" WHERE id = ?""".format(self.section), (self.id,)).fetchone()
+                    if row is not None and row[0] is not None:
+                        doc = self._get(None, row[0])
+            for k,v in fields.items():
+                if v is missing:
+                    doc.pop(k, None)
+                else:
+                    doc[k] = v
 
+            if expired:
+                new_vals = [self.id, self.timeout, self._expire_time()
+                    , self._set(None, doc)
+                    ]
+                cur.execute("""INSERT INTO "{0}" (id,timeout,expire,data) VALUES (?,?,?,?)""".format(self.section), new_vals)
+            else:
+                cur.execute("""UPDATE "{0}" SET data=? WHERE id=?""".format(self.section), (self._set(None, doc), self.id))
+        else:
+            if expired:
+                new_vals = [self.id, self.timeout, self._expire_time()]
                 cur.execute("""INSERT INTO "{0}" (id,timeout,expire) VALUES (?,?,?)""".format(self.section), new_vals)
             else:
-                new_vals = [self.timeout, None, self.id]
-                if self.timeout is not None:
-                    new_vals[1] = datetime.datetime.utcnow() + datetime.timedelta(seconds=self.timeout)
+                new_vals = [self.timeout, self._expire_time(), self.id]
                 cur.execute("""UPDATE "{0}" SET timeout=?, expire=? WHERE id=?""".format(self.section), new_vals)
 
-            #Now update our values
-            for k,v in fields.items():
-                cur.execute("""DELETE FROM "{0}_data" WHERE id = ? AND key = ?""".format(self.section), (self.id,k))
-                if k in self._conf.get('index_lists', []):
-                    cur.execute("""DELETE FROM "{0}_index" WHERE id = ? AND key = ?""".format(self.section), (self.id,k))
-                    for v2 in v:
-                        cur.execute("""INSERT INTO "{0}_index" (id,key,value) VALUES (?,?,?)""".format(self.section), (self.id,k,v2))
-                nv = self._set(k, v)
-                cur.execute("""INSERT INTO "{0}_data" (id,key,value) VALUES (?,?,?)""".format(self.section), (self.id,k,nv))
-
-            self.expired = False
+            #Now update our values; a constant number of statements
+            #regardless of how many fields are written.
+            sets = [ (self.id, k, self._set(k, v)) 
+                for k,v in fields.items() 
+                if v is not missing
+                ]
+            if sets:
+                cur.executemany(self.upsert_data.format(self.section), sets)
+            deletes = [ (self.id, k) for k,v in fields.items() if v is missing ]
+            if deletes:
+                cur.executemany("""DELETE FROM "{0}_data" WHERE id = ? AND key = ?""".format(self.section), deletes)
+
+        index_lists = self._conf.get('index_lists', [])
+        index_keys = [ (self.id, k) for k in fields if k in index_lists ]
+        if index_keys:
+            cur.executemany("""DELETE FROM "{0}_index" WHERE id = ? AND key = ?""".format(self.section), index_keys)
+            cur.executemany("""INSERT INTO "{0}_index" (id,key,value) VALUES (?,?,?)""".format(self.section), [
+                (self.id, k, v2) 
+                for _,k in index_keys 
+                if fields[k] is not missing
+                for v2 in fields[k]
+                ])
+
+    def _expire_time(self):
+        """Returns the expire column value for a write made now: integer
+        seconds since the epoch, rounded up so a slate never expires early.
+        """
+        if self.timeout is None:
+            return None
+        return int(math.ceil(time.time() + self.timeout))
 
     def __str__(self):
         return "SQLITE({0})".format(self.id)
@@ -140,10 +315,14 @@ class Sqlite3Storage(SlateStorage):
     def set(self, key, value):
         self._write({ key: value })
 
+    def update(self, d):
+        self._write(dict(d))
+
     def _set(self, key, value):
         """Translates a python value into one suitable for storage"""
-        pickled = my_buffer(pickle.dumps(value))
-        return pickled
+        return my_buffer(codec.encode(
+            self._codec, value, self._compress_threshold
+            ))
 
     def get(self, key, default):
         if not isinstance(key, basestring):
@@ -153,71 +332,73 @@ class Sqlite3Storage(SlateStorage):
         if self.expired:
             log('WARNING: GETTING FROM EXPIRED')
             return default
-        if key in self.cache:
-            result = self.cache[key]
-            if result is missing:
-                result = default
-        else:
-            db = self._get_db()
+        if key not in self.cache:
+            if self.cache_complete:
+                return default
+            with self._connection() as db:
+                try:
+                    cur = db.cursor()
+                    cur.execute("""SELECT value FROM "{0}_data" WHERE id = ? AND key = ?""".format(self.section), (self.id,key))
+                    row = cur.fetchone()
+                    if row is None:
+                        self.cache[key] = missing
+                    else:
+                        self.cache[key] = StoredValue(row[0])
+                finally:
+                    cur.close()
+        result = self._cache_get(key)
+        if result is missing:
+            result = default
+        return result
+
+    def _load_all(self):
+        """Fetches any values not yet in the cache (see the section's 
+        cache configuration).
+        """
+        if self.cache_complete:
+            return
+        with self._connection() as db:
             try:
                 cur = db.cursor()
-                cur.execute("""SELECT value FROM "{0}_data" WHERE id = ? AND key = ?""".format(self.section), (self.id,key))
-                result = cur.fetchone()
-                if result is None:
-                    result = default
-                else:
-                    result = self._get(key, result[0])
+                cur.execute("""SELECT key,value FROM "{0}_data" WHERE id = ?""".format(self.section), (self.id,))
+                for k,v in cur.fetchall():
+                    if k not in self.cache:
+                        self.cache[k] = StoredValue(v)
+                self.cache_complete = True
             finally:
                 cur.close()
-        return result
 
     def _get(self, key, value):
         """Translates the given value for the specified key into
-        python objects (from pickle).
+        python objects (see codec.decode).
         """
         if not isinstance(value, my_buffer):
             raise ValueError('Value is not buffer; is {0}'.format(type(value)))
         if has_buffer:
             value = str(value)
-        result = pickle.loads(value)
-        return result
+        return codec.decode(value)
 
     def pop(self, key, default):
-        self._access()
-        db = self._get_db()
-        try:
-            cur = db.cursor()
-            cur.execute("""SELECT value FROM "{0}_data" WHERE id = ? AND key = ?""".format(self.section), (self.id,key))
-            data = cur.fetchall()
-            if len(data) == 1:
-                result = self._get(key, data[0][0])
-            else:
-                result = default
-
-            cur.execute("""DELETE FROM "{0}_data" WHERE id = ? AND key = ?""".format(self.section), (self.id,key))
-            db.commit()
-
-            try:
-                del self.cache[key]
-            except KeyError:
-                pass
-
-            return result
-        finally:
-            cur.close()
+        result = self.get(key, default)
+        if not self.expired and self.cache.get(key, missing) is not missing:
+            self._write({ key: missing })
+        return result
 
     def clear(self):
-        self._clear_slate(self.section, self.id)
-        self.cache = {}
+        self._access()
+        if not self.expired:
+            self._write(clear=True)
 
     def items(self):
         self._access()
         if self.expired:
             return []
-        return self.cache.items()
+        self._load_all()
+        return self._cache_items()
 
     def expire(self):
         self._access()
+        self._batch_forget()
         self._clear_slate(self.section, self.id, True)
         self.cache = {}
         self._expired()
@@ -232,55 +413,98 @@ class Sqlite3Storage(SlateStorage):
             return 0
         if not hasattr(self, 'expiry'):
             return None
-        diff = self.expiry - datetime.datetime.utcnow()
-        diff = diff.days * 3600 * 24 + diff.seconds + diff.microseconds * 1e-6
-        return max(0, diff)
+        if self.expiry is None:
+            return None
+        return max(0, self.expiry - time.time())
 
     @classmethod
     def destroySectionBeCarefulWhenYouCallThis(cls, section):
-        db = cls._get_db()
-        try:
-            cur = db.cursor()
-            cur.execute(
-                """DROP TABLE IF EXISTS "{0}_index" """.format(section)
-                )
-            cur.execute(
-                """DROP TABLE IF EXISTS "{0}_data" """.format(section)
-                )
-            cur.execute(
-                """DROP TABLE IF EXISTS "{0}" """.format(section)
-                )
-            db.commit()
-        finally:
-            cur.close()
+        with cls.storage_checked_lock:
+            with cls._connection() as db:
+                try:
+                    cur = db.cursor()
+                    cur.execute(
+                        """DROP TABLE IF EXISTS "{0}_index" """.format(section)
+                        )
+                    cur.execute(
+                        """DROP TABLE IF EXISTS "{0}_data" """.format(section)
+                        )
+                    cur.execute(
+                        """DROP TABLE IF EXISTS "{0}" """.format(section)
+                        )
+                    cur.execute("""CREATE TABLE IF NOT EXISTS "{0}" (section TEXT PRIMARY KEY, version INTEGER)""".format(cls.schema_table))
+                    cur.execute(
+                        """DELETE FROM "{0}" WHERE section = ?""".format(
+                            cls.schema_table
+                            )
+                        , (section,)
+                        )
+                    db.commit()
+                finally:
+                    cur.close()
+            cls.storage_checked.discard(section)
+            cls.section_layouts.pop(section, None)
 
     @classmethod
     def find_with(cls, section, key, value):
-        db = cls._get_db()
         # To init section
         sec = cls._get_section(section)
-        try:
-            cur = db.cursor()
-            cur.execute("""SELECT id FROM "{0}_index" WHERE key = ? AND value = ?""".format(section), (key, value))
-            rows = cur.fetchall()
-            return [ Slate(section, row[0]) for row in rows ]
-        finally:
-            cur.close()
+        with cls._connection() as db:
+            try:
+                cur = db.cursor()
+                cur.execute("""SELECT id FROM "{0}_index" WHERE key = ? AND value = ?""".format(section), (key, value))
+                rows = cur.fetchall()
+                return [ Slate(section, row[0]) for row in rows ]
+            finally:
+                cur.close()
 
     @classmethod
-    def find_between(cls, section, start, end, limit=None, skip=None):
-        db = cls._get_db()
+    def count_with(cls, section, key, value):
         # To init section
         sec = cls._get_section(section)
-        try:
-            cur = db.cursor()
-            cur.execute("""SELECT id FROM "{0}" WHERE id >= ? AND id < ?""".format(section), (start, end))
-            rows = cur.fetchall()
-            skip = skip or 0
-            limit = skip + limit if limit else None
-            return [ Slate(section, row[0]) for row in rows ]
-        finally:
-            cur.close()
+        with cls._connection() as db:
+            try:
+                cur = db.cursor()
+                cur.execute("""SELECT COUNT(*) FROM "{0}_index" WHERE key = ? AND value = ?""".format(section), (key, value))
+                return cur.fetchone()[0]
+            finally:
+                cur.close()
+
+    @classmethod
+    def count_between(cls, section, start, end):
+        # To init section
+        sec = cls._get_section(section)
+        with cls._connection() as db:
+            try:
+                cur = db.cursor()
+                cur.execute("""SELECT COUNT(*) FROM "{0}" WHERE id >= ? AND id < ?""".format(section), (start, end))
+                return cur.fetchone()[0]
+            finally:
+                cur.close()
+
+    @classmethod
+    def find_between(cls, section, start, end, limit=None, skip=None
+        , after=None
+        ):
+        # To init section
+        sec = cls._get_section(section)
+        with cls._connection() as db:
+            try:
+                cur = db.cursor()
+                query = """SELECT id FROM "{0}" WHERE id >= ? AND id < ?"""
+                args = [ start, end ]
+                if after is not None:
+                    query += """ AND id > ?"""
+                    args.append(after)
+                # SQLite requires a LIMIT for OFFSET; -1 means no limit
+                query += """ ORDER BY id LIMIT ? OFFSET ?"""
+                args.append(limit if limit is not None else -1)
+                args.append(skip or 0)
+                cur.execute(query.format(section), args)
+                rows = cur.fetchall()
+                return [ Slate(section, row[0]) for row in rows ]
+            finally:
+                cur.close()
 
     @classmethod
     def generateId(cls):
@@ -291,76 +515,330 @@ class Sqlite3Storage(SlateStorage):
     def setup(cls, conf):
         import sqlite3
 
-        cls.storage = threading.local()
         cls.storage_file = conf.get('file', ':memory:')
-        cls.storage_checked = []
-        
+        cls.default_codec = conf.get('codec', 'pickle')
+        cls.default_compress_threshold = conf.get('compress_threshold', None)
+        cls.storage_checked = set()
+        cls.storage_checked_lock = threading.Lock()
+        cls.section_layouts = {}
+        cls.storage_timeout = float(conf.get('busy_timeout', 5.0))
+        cls.storage_statement_cache = int(conf.get('statement_cache', 100))
+        cls.storage_clean_chunk = int(conf.get('clean_chunk', 500))
+
+        cls.storage_pragmas = []
+        for name in sorted(cls.pragma_values.keys()):
+            value = conf.get(name)
+            if value is None:
+                continue
+            allowed = cls.pragma_values[name]
+            if isinstance(allowed, tuple):
+                value = str(value).lower()
+                if value not in allowed:
+                    raise ValueError("Bad sqlite3 {0}: {1}".format(name, value))
+            else:
+                value = allowed(value)
+            cls.storage_pragmas.append((name, value))
+
+        #UPSERT syntax needs SQLite 3.24; older libraries get the (also
+        #single statement) REPLACE, which relies on the {0}_data_pk index.
+        if sqlite3.sqlite_version_info >= (3, 24, 0):
+            cls.upsert_data = """INSERT INTO "{0}_data" (id,key,value) VALUES (?,?,?) ON CONFLICT(id,key) DO UPDATE SET value=excluded.value"""
+        else:
+            cls.upsert_data = """INSERT OR REPLACE INTO "{0}_data" (id,key,value) VALUES (?,?,?)"""
+
+        old_pool = getattr(cls, 'pool', None)
+        if old_pool is not None:
+            old_pool.close()
+        if cls.storage_file == ':memory:':
+            cls.pool = ConnectionPool(cls._connect, 1, None
+                , conf.get('pool_wait', 30)
+                )
+        else:
+            cls.pool = ConnectionPool(cls._connect
+                , int(conf.get('pool_size', 10))
+                , conf.get('pool_idle', 300)
+                , conf.get('pool_wait', 30)
+                )
+
+    @classmethod
+    def shutdown(cls):
+        #Closing a :memory: database would lose it
+        if cls.storage_file != ':memory:':
+            cls.pool.close()
+
     @classmethod
-    def _get_db(cls):
-        db = getattr(cls.storage, 'db', None)
-        if db is None:
-            import sqlite3
-            db = cls.storage.db = sqlite3.Connection(cls.storage_file, detect_types=sqlite3.PARSE_DECLTYPES)
+    def _connect(cls):
+        """Opens a new connection for the pool"""
+        import sqlite3
+        db = sqlite3.Connection(
+            cls.storage_file
+            , timeout=cls.storage_timeout
+            , check_same_thread=False
+            , cached_statements=cls.storage_statement_cache
+            )
+        for name, value in cls.storage_pragmas:
+            db.execute("PRAGMA {0} = {1}".format(name, value))
         return db
 
+    @classmethod
+    def _connection(cls):
+        """Returns a context manager holding a pooled connection; see
+        sqlite3_pool.ConnectionPool.connection().
+        """
+        return cls.pool.connection()
+
     @classmethod
     def _get_section(cls, section):
         """Returns the table base name representing the requested section.
         If not already exists, create it and all supplementary tables.
+
+        Sections are remembered in storage_checked the first time they are
+        seen (whether created or found on disk), so that constructing a
+        slate for a known section does not touch the database.  Sections
+        found on disk with an older schema_version are migrated then.
         """
-        db = cls._get_db()
-        try:
-            cur = db.cursor()
+        if section in cls.storage_checked:
+            return section
 
-            already_queried = section in cls.storage_checked
-            if not already_queried and cur.execute("SELECT COUNT(*) FROM SQLite_Master WHERE type='table' AND name=?", (section,)).fetchone()[0] != 1:
-                #Create tables
-                cls.storage_checked.append(section)
-                cur.execute("""CREATE TABLE "{0}" (id TEXT, timeout INTEGER, expire TIMESTAMP)""".format(section))
-                cur.execute("""CREATE UNIQUE INDEX "{0}_pk" ON "{0}" (id ASC)""".format(section))
-                cur.execute("""CREATE INDEX "{0}_expire" ON "{0}" (expire DESC)""".format(section))
+        with cls.storage_checked_lock:
+            if section in cls.storage_checked:
+                return section
+
+            with cls._connection() as db:
+                try:
+                    cur = db.cursor()
+                    cur.execute("""CREATE TABLE IF NOT EXISTS "{0}" (section TEXT PRIMARY KEY, version INTEGER)""".format(cls.schema_table))
+                    layout = cls._get_section_config(section).get(
+                        'layout', 'rows'
+                        )
+                    if layout not in cls.layouts:
+                        raise ValueError("Bad layout for section {0}: {1}".format(section, layout))
+                    if cur.execute("SELECT COUNT(*) FROM SQLite_Master WHERE type='table' AND name=?", (section,)).fetchone()[0] != 1:
+                        cls._create_tables(cur, section, layout)
+                        cls._set_schema_version(cur, section)
+                        db.commit()
+                    else:
+                        cls._migrate_section(db, cur, section)
+                        found = cls._get_table_layout(cur, section)
+                        if found != layout:
+                            log('Section {0} is stored with layout {1}, not {2}; see migrate_layout()'.format(section, found, layout))
+                        layout = found
+
+                    cls.section_layouts[section] = layout
+                    cls.storage_checked.add(section)
+                    return section
+                finally:
+                    cur.close()
 
-                cur.execute("""CREATE TABLE "{0}_data" (id TEXT, key TEXT, value BLOB)""".format(section))
-                cur.execute("""CREATE UNIQUE INDEX "{0}_data_pk" ON "{0}_data" (id ASC, key ASC)""".format(section))
+    @classmethod
+    def _create_tables(cls, cur, section, layout):
+        """Creates the tables for a section with the given layout.  The
+        {section}_index table is left alone if it already exists.
+        """
+        if layout == 'document':
+            cur.execute("""CREATE TABLE "{0}" (id TEXT, timeout INTEGER, expire INTEGER, data BLOB)""".format(section))
+        else:
+            cur.execute("""CREATE TABLE "{0}" (id TEXT, timeout INTEGER, expire INTEGER)""".format(section))
+            cur.execute("""CREATE TABLE "{0}_data" (id TEXT, key TEXT, value BLOB)""".format(section))
+            cur.execute("""CREATE UNIQUE INDEX "{0}_data_pk" ON "{0}_data" (id ASC, key ASC)""".format(section))
+        cur.execute("""CREATE UNIQUE INDEX "{0}_pk" ON "{0}" (id ASC)""".format(section))
+        cur.execute("""CREATE INDEX "{0}_expire" ON "{0}" (expire DESC)""".format(section))
 
-                cur.execute("""CREATE TABLE "{0}_index" (id TEXT, key TEXT, value TEXT)""".format(section))
-                cur.execute("""CREATE INDEX "{0}_index_pk" ON "{0}_index" (id ASC)""".format(section))
-                cur.execute("""CREATE INDEX "{0}_index_search" ON "{0}_index" (key ASC, value ASC)""".format(section))
+        cur.execute("""CREATE TABLE IF NOT EXISTS "{0}_index" (id TEXT, key TEXT, value TEXT)""".format(section))
+        cur.execute("""CREATE INDEX IF NOT EXISTS "{0}_index_pk" ON "{0}_index" (id ASC)""".format(section))
+        cur.execute("""CREATE INDEX IF NOT EXISTS "{0}_index_search" ON "{0}_index" (key ASC, value ASC)""".format(section))
 
-                db.commit()
+    @classmethod
+    def _get_table_layout(cls, cur, section):
+        """Returns the layout of a section's existing tables"""
+        columns = [ row[1] for row in cur.execute(
+            """PRAGMA table_info("{0}")""".format(section)
+            ).fetchall() ]
+        if 'data' in columns:
+            return 'document'
+        return 'rows'
 
-            return section
-        finally:
-            cur.close()
+    @classmethod
+    def migrate_layout(cls, section, layout):
+        """Converts an existing section's tables to the given layout (see
+        the class docstring), in one transaction.  Returns the number of
+        slates converted.  Other processes using the section must be 
+        stopped first, and its 'layout' option changed to match.
+        """
+        if layout not in cls.layouts:
+            raise ValueError("Unknown layout: {0}".format(layout))
+        section = cls._get_section(section)
+        old_layout = cls.section_layouts[section]
+        if old_layout == layout:
+            return 0
+
+        conf = cls._get_section_config(section)
+        section_codec = codec.get_codec(conf.get('codec', cls.default_codec))
+        threshold = conf.get('compress_threshold'
+            , cls.default_compress_threshold
+            )
+        def encode(value):
+            return my_buffer(codec.encode(section_codec, value, threshold))
+        def decode(value):
+            return codec.decode(bytes(value))
+
+        count = 0
+        with cls.storage_checked_lock:
+            with cls._connection() as db:
+                #Python 2's sqlite3 commits before DDL statements unless
+                #transactions are managed by hand.
+                isolation_level = db.isolation_level
+                db.isolation_level = None
+                cur = db.cursor()
+                try:
+                    cur.execute("""BEGIN""")
+                    cur.execute("""DROP INDEX "{0}_pk" """.format(section))
+                    cur.execute("""DROP INDEX "{0}_expire" """.format(section))
+                    cur.execute("""ALTER TABLE "{0}" RENAME TO "{0}_old" """.format(section))
+                    cls._create_tables(cur, section, layout)
+
+                    if layout == 'document':
+                        headers = cur.execute("""SELECT id,timeout,expire FROM "{0}_old" """.format(section)).fetchall()
+                        for id, timeout, expire in headers:
+                            doc = dict([ (k, decode(v)) for k, v in cur.execute("""SELECT key,value FROM "{0}_data" WHERE id = ?""".format(section), (id,)).fetchall() ])
+                            cur.execute("""INSERT INTO "{0}" (id,timeout,expire,data) VALUES (?,?,?,?)""".format(section), (id, timeout, expire, encode(doc)))
+                            count += 1
+                        cur.execute("""DROP TABLE "{0}_data" """.format(section))
+                    else:
+                        rows = cur.execute("""SELECT id,timeout,expire,data FROM "{0}_old" """.format(section)).fetchall()
+                        for id, timeout, expire, data in rows:
+                            cur.execute("""INSERT INTO "{0}" (id,timeout,expire) VALUES (?,?,?)""".format(section), (id, timeout, expire))
+                            if data is not None:
+                                cur.executemany("""INSERT INTO "{0}_data" (id,key,value) VALUES (?,?,?)""".format(section), [ (id, k, encode(v)) for k, v in decode(data).items() ])
+                            count += 1
+
+                    cur.execute("""DROP TABLE "{0}_old" """.format(section))
+                    cur.execute("""COMMIT""")
+                except:
+                    cur.execute("""ROLLBACK""")
+                    raise
+                finally:
+                    cur.close()
+                    db.isolation_level = isolation_level
+                cls.section_layouts[section] = layout
+        log('Migrated {0} slates in {1} to layout {2}'.format(
+            count, section, layout
+            ))
+        return count
+
+    @classmethod
+    def _set_schema_version(cls, cur, section):
+        cur.execute("""INSERT OR REPLACE INTO "{0}" (section,version) VALUES (?,?)""".format(cls.schema_table), (section, cls.schema_version))
+
+    @classmethod
+    def _migrate_section(cls, db, cur, section):
+        """Brings an existing section's tables up to schema_version, in
+        place and in one transaction.  Sections without a version were
+        created before versions were recorded, and are version 1.
+        """
+        row = cur.execute("""SELECT version FROM "{0}" WHERE section = ?""".format(cls.schema_table), (section,)).fetchone()
+        version = row[0] if row is not None else 1
+        if version >= cls.schema_version:
+            return
+
+        log('Migrating section {0} from schema {1}'.format(section, version))
+        with db:
+            if version < 2:
+                #expire was a TIMESTAMP string in UTC.  Convert it to epoch
+                #seconds, rounding up any fraction (%f is seconds with a
+                #fraction, %S without) as _expire_time does.  The column's
+                #NUMERIC affinity stores the results as integers.
+                cur.execute("""UPDATE "{0}" SET expire = 
+                    CAST(strftime('%s', expire) AS INTEGER)
+                    + (CAST(strftime('%f', expire) AS REAL) 
+                        > CAST(strftime('%S', expire) AS REAL))
+                    WHERE expire IS NOT NULL""".format(section))
+            cls._set_schema_version(cur, section)
 
     @classmethod
     def _clear_slate(cls, section, id, expire=False):
         section = cls._get_section(section)
-        db = cls._get_db()
-        try:
-            cur = db.cursor()
-            id_tuple = (id,)
+        with cls._connection() as db:
+            try:
+                cur = db.cursor()
+                cls._delete_slate_rows(cur, section, id, expire)
+                db.commit()
+            finally:
+                cur.close()
+
+    @classmethod
+    def _delete_slate_rows(cls, cur, section, id, expire=False):
+        """Deletes a slate's data and index rows (and its header row if
+        expire is set) using the given cursor, without committing.
+        """
+        id_tuple = (id,)
+        if cls.section_layouts.get(section) != 'document':
             cur.execute("""DELETE FROM "{0}_data" WHERE id = ?""".format(section), id_tuple)
-            cur.execute("""DELETE FROM "{0}_index" WHERE id = ?""".format(section), id_tuple)
-            if expire:
-                cur.execute("""DELETE FROM "{0}" WHERE id = ?""".format(section), id_tuple)
-            db.commit()
-        finally:
-            cur.close()
+        cur.execute("""DELETE FROM "{0}_index" WHERE id = ?""".format(section), id_tuple)
+        if expire:
+            cur.execute("""DELETE FROM "{0}" WHERE id = ?""".format(section), id_tuple)
 
     @classmethod
     def clean_up(cls):
-        now = datetime.datetime.utcnow()
-        db = cls._get_db()
-        for section in cls.storage_checked:
+        """Deletes expired slates from every section in the database, 
+        including sections this process has not used.  Slates are deleted
+        clean_chunk at a time, each chunk in its own transaction, so other
+        connections may write between chunks.
+
+        Returns a dict of section: number of slates deleted.
+        """
+        now = time.time()
+        result = {}
+        for section in cls._find_sections():
+            section = cls._get_section(section)
+            document = cls.section_layouts[section] == 'document'
+            count = 0
+            while True:
+                deleted = cls._clean_chunk(section, document, now)
+                count += deleted
+                if deleted < cls.storage_clean_chunk:
+                    break
+            result[section] = count
+            if count:
+                log('Cleaned {0} expired slates from {1}'.format(
+                    count, section
+                    ))
+        cls.pool.reap()
+        log('Cleaned expired slates')
+        return result
+
+    @classmethod
+    def _clean_chunk(cls, section, document, now):
+        """Deletes up to clean_chunk slates from section that expired 
+        before now, in one transaction.  Returns the number deleted.
+        """
+        with cls._connection() as db:
+            cur = db.cursor()
             try:
-                cur = db.cursor()
-                rows = cur.execute("""SELECT id FROM "{0}" WHERE expire < ?""".format(section), (now,)).fetchall()
-                cur.executemany("""DELETE FROM "{0}" WHERE id = ?""".format(section), rows)
-                cur.executemany("""DELETE FROM "{0}_data" WHERE id = ?""".format(section), rows)
-                cur.executemany("""DELETE FROM "{0}_index" WHERE id = ?""".format(section), rows)
-                db.commit()
+                #The chunk's ids are gathered once, so that each table is
+                #cleaned of exactly the same slates.
+                cur.execute("""CREATE TEMP TABLE IF NOT EXISTS lg_authority_reap (id TEXT PRIMARY KEY)""")
+                with db:
+                    cur.execute("""INSERT INTO temp.lg_authority_reap (id) SELECT id FROM "{0}" WHERE expire < ? LIMIT ?""".format(section), (now, cls.storage_clean_chunk))
+                    count = cur.rowcount
+                    if count:
+                        if not document:
+                            cur.execute("""DELETE FROM "{0}_data" WHERE id IN (SELECT id FROM temp.lg_authority_reap)""".format(section))
+                        cur.execute("""DELETE FROM "{0}_index" WHERE id IN (SELECT id FROM temp.lg_authority_reap)""".format(section))
+                        cur.execute("""DELETE FROM "{0}" WHERE id IN (SELECT id FROM temp.lg_authority_reap)""".format(section))
+                    cur.execute("""DELETE FROM temp.lg_authority_reap""")
+                return count
             finally:
                 cur.close()
-        log('Cleaned expired slates')
+
+    @classmethod
+    def _find_sections(cls):
+        """Returns the names of all sections with tables in the database"""
+        with cls._connection() as db:
+            cur = db.cursor()
+            try:
+                tables = set([ row[0] for row in cur.execute("""SELECT name FROM SQLite_Master WHERE type='table'""").fetchall() ])
+            finally:
+                cur.close()
+        return sorted([ t for t in tables if t + '_index' in tables ])
 
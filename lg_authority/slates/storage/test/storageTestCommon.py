@@ -1,14 +1,21 @@
+import atexit
 import os
 import re
+import shutil
+import tempfile
 import time
 
 import cherrypy
 import lg_authority
+from lg_authority.slates.batch import SlateBatch
 from lg_authority.slates.storage import get_storage_class
 from lg_authority.testutil import *
 
 missing = {}
 
+testDir = tempfile.mkdtemp(prefix='lg_authority_test')
+atexit.register(shutil.rmtree, testDir, True)
+
 class StorageTestCommon(object):
     """Storage tests.  Cannot derive from TestCase or would be ran as a test.
     All derivatives should also derive from lg_authority.testutil.LgTestCase.
@@ -20,9 +27,33 @@ class StorageTestCommon(object):
     storageConfig__doc = "Config dict passed to StorageClass.setup()"
 
     def setUp(self):
+        config = lg_authority.common.config
+        self._savedConfig = (
+            config.get('site_storage_sections_test', missing)
+            , getattr(config, 'storage_class', missing)
+            )
         self.storageClass = get_storage_class(self.storageName)
+        lg_authority.common.config['site_storage_sections_test'] = {
+            'index_lists': [ 'tags' ]
+            }
         self.storageClass.setup(self.storageConfig)
         self.storageClass.destroySectionBeCarefulWhenYouCallThis('test')
+        # Slates returned by find_* are built through the configured class
+        lg_authority.common.config.storage_class = self.storageClass
+
+    def tearDown(self):
+        """Restores the config that setUp replaced."""
+        config = lg_authority.common.config
+        sections, storage_class = self._savedConfig
+        if sections is missing:
+            config.pop('site_storage_sections_test', None)
+        else:
+            config['site_storage_sections_test'] = sections
+        if storage_class is missing:
+            if hasattr(config, 'storage_class'):
+                del config.storage_class
+        else:
+            config.storage_class = storage_class
 
     def getStorage(self, name=missing, timeout=None):
         """Gets a storage object that can be tested."""
@@ -32,6 +63,156 @@ class StorageTestCommon(object):
             name = 'test_' + self.storageName + '_' + name
         return self.storageClass('test', name, timeout=timeout)
 
+    def test_batchClear(self):
+        store = self.getStorage(timeout=60)
+        store.update({ 'a': 'b', 'c': 'd' })
+
+        batch = SlateBatch()
+        batch.begin()
+        try:
+            store = self.getStorage(timeout=60)
+            store.clear()
+            store.set('e', 'f')
+            self.assertEqual([ ('e', 'f') ], store.items())
+        finally:
+            batch.end()
+        batch.flush()
+
+        store = self.getStorage(timeout=60)
+        self.assertEqual([ ('e', 'f') ], store.items())
+
+    def test_batchContext(self):
+        with SlateBatch():
+            store = self.getStorage('a', timeout=60)
+            store.set('a', 'b')
+            store2 = self.getStorage('b', timeout=60)
+            store2.update({ 'c': 'd', 'e': 'f' })
+            store2.pop('e', None)
+
+        self.assertEqual([ ('a', 'b') ], self.getStorage('a').items())
+        self.assertEqual([ ('c', 'd') ], self.getStorage('b').items())
+
+    def test_batchExpire(self):
+        batch = SlateBatch()
+        batch.begin()
+        try:
+            store = self.getStorage(timeout=60)
+            store.set('a', 'b')
+            store.expire()
+            self.assertTrue(store.is_expired())
+        finally:
+            batch.end()
+        batch.flush()
+
+        self.assertTrue(self.getStorage().is_expired())
+
+    def test_batchReadYourWrites(self):
+        batch = SlateBatch()
+        batch.begin()
+        try:
+            store = self.getStorage(None, timeout=60)
+            store.set('a', 'b')
+            self.assertNotEqual(None, store.id)
+
+            # A slate loaded later in the batch sees the held write
+            store2 = self.storageClass('test', store.id, {})
+            self.assertFalse(store2.is_expired())
+            self.assertEqual('b', store2.get('a', None))
+            self.assertEqual(60, store2.timeout)
+            store2.set('c', 'd')
+        finally:
+            batch.end()
+        batch.flush()
+
+        store = self.storageClass('test', store.id, {})
+        self.assertEqual([ ('a', 'b'), ('c', 'd') ], sorted(store.items()))
+
+    def test_batchWrites(self):
+        store = self.getStorage(timeout=60)
+        store.set('z', 'y')
+
+        batch = SlateBatch()
+        batch.begin()
+        try:
+            store = self.getStorage(timeout=60)
+            store.set('a', 'b')
+            store.update({ 'b': 'c', 'c': 'd', 'tags': [ 'x' ] })
+            self.assertEqual('d', store.pop('c', None))
+            self.assertEqual('y', store.pop('z', None))
+            store.touch()
+            self.assertEqual(
+                [ ('a', 'b'), ('b', 'c'), ('tags', [ 'x' ]) ]
+                , sorted(store.items())
+                )
+        finally:
+            batch.end()
+        batch.flush()
+
+        store = self.getStorage(timeout=60)
+        self.assertEqual(
+            [ ('a', 'b'), ('b', 'c'), ('tags', [ 'x' ]) ]
+            , sorted(store.items())
+            )
+        self.assertEqual(1, self.storageClass.count_with('test', 'tags', 'x'))
+
+    def test_cacheKeys(self):
+        store = self.getStorage(timeout=60)
+        store.update({ 'a': 1, 'b': 2, 'c': 3 })
+
+        lg_authority.common.config['site_storage_sections_test']['cache'] = [
+            'a', 'z'
+            ]
+        store = self.getStorage()
+        self.assertEqual(1, store.get('a', None))
+        self.assertEqual(2, store.get('b', None))
+        self.assertEqual(None, store.get('y', None))
+        self.assertEqual(None, store.get('z', None))
+        self.assertEqual([ ('a', 1), ('b', 2), ('c', 3) ], sorted(store.items()))
+
+        store = self.getStorage()
+        store.set('c', 4)
+        self.assertEqual(
+            [ ('a', 1), ('b', 2), ('c', 4) ]
+            , sorted(store.items())
+            )
+
+        store = self.getStorage()
+        store.clear()
+        self.assertEqual(None, store.get('b', None))
+        self.assertEqual([], store.items())
+        self.assertEqual([], self.getStorage().items())
+
+    def test_codec(self):
+        store = self.getStorage(timeout=60)
+        store.set('a', [ 1, 2 ])
+
+        lg_authority.common.config['site_storage_sections_test']['codec'] = \
+            'json'
+        store = self.getStorage(timeout=60)
+        self.assertEqual([ 1, 2 ], store.get('a', None))
+        store.update({ 'b': { 'c': 1 }, 'd': set([ 1 ]) })
+
+        store = self.getStorage(timeout=60)
+        self.assertEqual([ 1, 2 ], store.get('a', None))
+        self.assertEqual({ 'c': 1 }, store.get('b', None))
+        self.assertEqual(set([ 1 ]), store.get('d', None))
+
+    def test_compress(self):
+        big = [ 'token' + str(i) for i in range(200) ]
+        store = self.getStorage(timeout=60)
+        store.set('a', big)
+
+        lg_authority.common.config['site_storage_sections_test'][
+            'compress_threshold'] = 64
+        store = self.getStorage(timeout=60)
+        self.assertEqual(big, store.get('a', None))
+        store.update({ 'b': big, 'c': 1 })
+
+        store = self.getStorage(timeout=60)
+        self.assertEqual(big, store.get('a', None))
+        self.assertEqual(big, store.get('b', None))
+        self.assertEqual(1, store.get('c', None))
+
     def test_clear(self):
         store = self.getStorage()
         store.set('a', 'b')
@@ -73,6 +254,68 @@ class StorageTestCommon(object):
         self.assertTrue(store.is_expired())
         self.assertEqual(None, store.get('a', None))
 
+    def _makeBetween(self):
+        """Creates slates a through e and returns the name prefix used"""
+        for name in [ 'c', 'a', 'e', 'b', 'd' ]:
+            self.getStorage(name, timeout=60).touch()
+        return 'test_' + self.storageName + '_'
+
+    def _betweenIds(self, slates):
+        return [ s.id[-1] for s in slates ]
+
+    def test_findBetweenLimitSkip(self):
+        p = self._makeBetween()
+        find = self.storageClass.find_between
+        self.assertEqual([ 'a', 'b', 'c', 'd' ]
+            , self._betweenIds(find('test', p + 'a', p + 'e'))
+            )
+        self.assertEqual([ 'a', 'b' ]
+            , self._betweenIds(find('test', p + 'a', p + 'z', 2))
+            )
+        self.assertEqual([ 'c', 'd' ]
+            , self._betweenIds(find('test', p + 'a', p + 'z', 2, 2))
+            )
+        self.assertEqual([ 'd', 'e' ]
+            , self._betweenIds(find('test', p + 'a', p + 'z', skip=3))
+            )
+
+    def test_findBetweenAfter(self):
+        p = self._makeBetween()
+        find = self.storageClass.find_between
+        page = find('test', p + 'a', p + 'z', 2)
+        self.assertEqual([ 'a', 'b' ], self._betweenIds(page))
+        page = find('test', p + 'a', p + 'z', 2, after=page[-1].id)
+        self.assertEqual([ 'c', 'd' ], self._betweenIds(page))
+        page = find('test', p + 'a', p + 'z', 2, after=page[-1].id)
+        self.assertEqual([ 'e' ], self._betweenIds(page))
+        page = find('test', p + 'a', p + 'z', 2, after=page[-1].id)
+        self.assertEqual([], page)
+
+    def test_countBetween(self):
+        p = self._makeBetween()
+        count = self.storageClass.count_between
+        self.assertEqual(4, count('test', p + 'a', p + 'e'))
+        self.assertEqual(5, count('test', p, p + 'z'))
+        self.assertEqual(0, count('test', p + 'f', p + 'z'))
+        self.assertEqual(0, count('empty', 'a', 'z'))
+
+    def test_countWith(self):
+        self.getStorage('a', timeout=60).set('tags', [ 'x', 'y' ])
+        self.getStorage('b', timeout=60).set('tags', [ 'y' ])
+        self.getStorage('c', timeout=60).set('tags', [])
+        count = self.storageClass.count_with
+        self.assertEqual(1, count('test', 'tags', 'x'))
+        self.assertEqual(2, count('test', 'tags', 'y'))
+        self.assertEqual(0, count('test', 'tags', 'z'))
+        self.assertEqual(
+            len(self.storageClass.find_with('test', 'tags', 'y'))
+            , count('test', 'tags', 'y')
+            )
+
+        self.getStorage('b', timeout=60).set('tags', [ 'x' ])
+        self.assertEqual(2, count('test', 'tags', 'x'))
+        self.assertEqual(1, count('test', 'tags', 'y'))
+
     def test_isExpiredNonExisting(self):
         # Make sure that any non-existing slate is shown as expired until
         # it has something written to it.
@@ -138,6 +381,23 @@ class StorageTestCommon(object):
         r = self.storageClass.find_between('user', 'a', 'z')
         self.assertEqual([], r)
 
+    def test_update(self):
+        store = self.getStorage(timeout=60)
+        store.set('a', 'old')
+        store.update({ 'a': 'b', 'b': 'c', 'tags': [ 'x' ] })
+        self.assertEqual('b', store.get('a', None))
+
+        store = self.getStorage(timeout=60)
+        self.assertEqual(
+            [ ('a', 'b'), ('b', 'c'), ('tags', [ 'x' ]) ]
+            , sorted(store.items())
+            )
+        self.assertEqual(1, self.storageClass.count_with('test', 'tags', 'x'))
+
+        store.update({ 'tags': [ 'y' ] })
+        self.assertEqual(0, self.storageClass.count_with('test', 'tags', 'x'))
+        self.assertEqual(1, self.storageClass.count_with('test', 'tags', 'y'))
+
     def test_timeoutValues(self):
         # Test that the different timeout meanings catch on
         store = self.getStorage(timeout=60)
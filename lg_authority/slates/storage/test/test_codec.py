@@ -0,0 +1,94 @@
+import datetime
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from lg_authority.testutil import LgTestCase
+from lg_authority.slates.storage import codec
+
+class FixedOffset(datetime.tzinfo):
+    """Picklable tzinfo five hours ahead of UTC."""
+    def utcoffset(self, dt):
+        return datetime.timedelta(hours=5)
+
+    def dst(self, dt):
+        return datetime.timedelta(0)
+
+class TestCodec(LgTestCase):
+
+    def getNames(self):
+        names = [ 'pickle', 'json', 'marshal' ]
+        try:
+            codec.get_codec('msgpack')
+            names.append('msgpack')
+        except ImportError:
+            pass
+        return names
+
+    def test_roundTrip(self):
+        value = { 'a': [ 1, 2.5, None, True ], 'b': { 'c': 'd' } }
+        for name in self.getNames():
+            data = codec.encode(codec.get_codec(name), value)
+            self.assertEqual(value, codec.decode(data), name)
+
+    def test_datetime(self):
+        value = { 'authtime': datetime.datetime(2011, 3, 4, 5, 6, 7, 8) }
+        for name in self.getNames():
+            data = codec.encode(codec.get_codec(name), value)
+            self.assertEqual(value, codec.decode(data), name)
+
+    def test_fallbackToPickle(self):
+        # json cannot represent sets; the value is pickled instead
+        data = codec.encode(codec.get_codec('json'), set([ 1 ]))
+        self.assertEqual(codec.PickleCodec.tag, ord(data[:1]))
+        self.assertEqual(set([ 1 ]), codec.decode(data))
+
+    def test_fallbackUnchanged(self):
+        # Values json or msgpack would change are pickled instead
+        for value in [ { 'a': { 1: 'x' } }, { 't': (1, 2) }, [ [ (1,) ] ] ]:
+            for name in self.getNames():
+                data = codec.encode(codec.get_codec(name), value)
+                result = codec.decode(data)
+                self.assertEqual(value, result, name)
+                self.assertEqual(repr(value), repr(result), name)
+
+    def test_fallbackDatetimes(self):
+        aware = datetime.datetime(2020, 1, 1, tzinfo=FixedOffset())
+        for name in self.getNames():
+            result = codec.decode(codec.encode(codec.get_codec(name)
+                , { 't': aware }
+                ))
+            self.assertEqual(aware, result['t'], name)
+            self.assertEqual(datetime.timedelta(hours=5)
+                , result['t'].utcoffset(), name
+                )
+
+            value = { '__datetime__': '2020-01-01T00:00:00.000000' }
+            result = codec.decode(codec.encode(codec.get_codec(name), value))
+            self.assertEqual(value, result, name)
+
+    def test_untaggedPickle(self):
+        # Values stored before codecs existed are plain pickles
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            data = pickle.dumps({ 'a': 'b' }, protocol)
+            self.assertEqual({ 'a': 'b' }, codec.decode(data))
+
+    def test_unknown(self):
+        self.assertRaises(ValueError, codec.get_codec, 'blah')
+
+    def test_compress(self):
+        value = { 'auth_token': [ 'x' * 40 ] * 50 }
+        small = { 'a': 1 }
+        for name in self.getNames():
+            c = codec.get_codec(name)
+            plain = codec.encode(c, value)
+            data = codec.encode(c, value, 100)
+            self.assertTrue(ord(data[:1]) & codec.COMPRESSED, name)
+            self.assertTrue(len(data) < len(plain), name)
+            self.assertEqual(value, codec.decode(data), name)
+
+            # Below the threshold, values are stored as-is
+            data = codec.encode(c, small, 100)
+            self.assertEqual(codec.encode(c, small), data, name)
+            self.assertEqual(small, codec.decode(data), name)
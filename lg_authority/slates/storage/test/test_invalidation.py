@@ -0,0 +1,72 @@
+from lg_authority.testutil import LgTestCase
+from lg_authority.slates.storage.invalidation import InvalidationBus
+
+import os
+import shutil
+import socket
+import tempfile
+import threading
+
+class TestInvalidationBus(LgTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_publish(self):
+        received = []
+        event = threading.Event()
+        def callback(section, id):
+            received.append((section, id))
+            event.set()
+        sender = InvalidationBus(self.directory, lambda s, i: None)
+        receiver = InvalidationBus(self.directory, callback)
+        try:
+            sender.publish('user', 'someone')
+            event.wait(5)
+            self.assertEqual([ ('user', 'someone') ], received)
+
+            # Nothing is sent to the publisher itself
+            event.clear()
+            receiver.publish('user', 'other')
+            sender.publish(u'user', u'\xe9')
+            event.wait(5)
+            self.assertEqual(('user', u'\xe9'), received[-1])
+            self.assertEqual(2, len(received))
+        finally:
+            sender.close()
+            receiver.close()
+        self.assertEqual([], os.listdir(self.directory))
+
+    def test_staleSocket(self):
+        # A socket whose process died without closing it is removed
+        stale = os.path.join(self.directory, '12345.deadbeef')
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(stale)
+        sock.close()
+        bus = InvalidationBus(self.directory, lambda s, i: None)
+        try:
+            bus.publish('user', 'someone')
+            self.assertFalse(os.path.exists(stale))
+        finally:
+            bus.close()
+
+    def test_otherFiles(self):
+        # Only the bus' own sockets are sent to or removed
+        other = os.path.join(self.directory, 'notes.txt')
+        named = os.path.join(self.directory, '12345.cafebabe')
+        for path in [ other, named ]:
+            with open(path, 'w') as f:
+                f.write('keep')
+        unnamed = os.path.join(self.directory, 'unnamed')
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(unnamed)
+        sock.close()
+        bus = InvalidationBus(self.directory, lambda s, i: None)
+        try:
+            bus.publish('user', 'someone')
+            for path in [ other, named, unnamed ]:
+                self.assertTrue(os.path.exists(path))
+        finally:
+            bus.close()
@@ -1,3 +1,7 @@
+import sys
+import threading
+
+import lg_authority
 from lg_authority.testutil import LgTestCase
 from .storageTestCommon import StorageTestCommon
 
@@ -5,3 +9,227 @@ class TestStorageRam(StorageTestCommon, LgTestCase):
     storageName = 'ram'
     storageConfig = { }
 
+    def test_cleanUp(self):
+        for i in range(3):
+            self.getStorage('dead' + str(i), timeout=-10).set('a', 1)
+        self.getStorage('live', timeout=60).set('a', 1)
+        self.getStorage('forever', timeout=None).set('a', 1)
+        # Rewritten after being scheduled as expired
+        self.getStorage('revived', timeout=-10).set('a', 1)
+        self.getStorage('revived', timeout=60).set('a', 2)
+
+        self.assertEqual(3, self.storageClass.clean_up()['test'])
+        self.assertEqual(
+            [ 'test_ram_forever', 'test_ram_live', 'test_ram_revived' ]
+            , sorted(self.storageClass.section_cache['test'].keys())
+            )
+        self.assertEqual(2, self.getStorage('revived').get('a', None))
+        self.assertEqual(0, self.storageClass.clean_up()['test'])
+
+    def test_cleanUpHeapBounded(self):
+        # Touching a slate repeatedly must not grow its heap without bound
+        store = self.getStorage(timeout=60)
+        for i in range(1000):
+            store.touch()
+        self.assertTrue(len(self.storageClass.expiry_heaps['test']) < 100)
+
+    def test_indexKeptInSync(self):
+        index = lambda: self.storageClass.indexes['test'].get('tags', {})
+        a = self.getStorage('a', timeout=60)
+        a.set('tags', [ 'x', 'y' ])
+        self.getStorage('b', timeout=60).set('tags', [ 'x' ])
+        self.assertEqual(
+            set([ 'test_ram_a', 'test_ram_b' ]), index()['x']
+            )
+
+        a.set('tags', [ 'y' ])
+        self.assertEqual(set([ 'test_ram_b' ]), index()['x'])
+        a.pop('tags', None)
+        self.assertFalse('y' in index())
+        a.set('tags', [ 'z' ])
+        a.clear()
+        self.assertFalse('z' in index())
+
+        # Expired slates leave the index when expired explicitly, or when
+        # they are cleaned up
+        self.getStorage('c', timeout=-10).set('tags', [ 'w' ])
+        self.getStorage('d', timeout=-10).set('tags', [ 'w' ])
+        self.assertEqual(2, self.storageClass.count_with('test', 'tags', 'w'))
+        self.getStorage('c').expire()
+        self.assertEqual(1, self.storageClass.count_with('test', 'tags', 'w'))
+        self.storageClass.clean_up()
+        self.assertFalse('w' in index())
+
+    def test_sortedIdsKeptInSync(self):
+        ids = lambda: self.storageClass.sorted_ids['test']
+        for name in [ 'c', 'a', 'b' ]:
+            self.getStorage(name, timeout=60).set('a', 1)
+        # Rewriting an existing or expired slate must not duplicate its id
+        self.getStorage('b', timeout=60).set('a', 2)
+        self.getStorage('d', timeout=-10).set('a', 1)
+        self.getStorage('d', timeout=60).set('a', 1)
+        self.assertEqual(
+            [ 'test_ram_a', 'test_ram_b', 'test_ram_c', 'test_ram_d' ], ids()
+            )
+
+        self.getStorage('a').expire()
+        self.getStorage('b', timeout=-10).set('a', 1)
+        self.storageClass.clean_up()
+        self.assertEqual([ 'test_ram_c', 'test_ram_d' ], ids())
+        self.assertEqual(
+            2, self.storageClass.count_between('test', 'test_ram_', 'test_ram_z')
+            )
+
+    def _hammer(self, threads, work):
+        """Runs work(i) in each of threads threads at once, switching
+        threads as often as the interpreter allows.
+        """
+        interval = sys.getcheckinterval()
+        sys.setcheckinterval(1)
+        try:
+            start = threading.Event()
+            def run(i):
+                start.wait()
+                work(i)
+            workers = [ threading.Thread(target=run, args=(i,))
+                for i in range(threads) ]
+            for w in workers:
+                w.start()
+            start.set()
+            for w in workers:
+                w.join()
+        finally:
+            sys.setcheckinterval(interval)
+
+    def test_threadsNewIds(self):
+        ids = [ [] for i in range(8) ]
+        def work(i):
+            for j in range(500):
+                store = self.getStorage(None, timeout=60)
+                store.set('a', 1)
+                ids[i].append(store.id)
+        self._hammer(8, work)
+        allIds = sum(ids, [])
+        self.assertEqual(4000, len(set(allIds)))
+
+    def test_threadsNoLostUpdates(self):
+        # Every thread creates the same new slate and writes its own key;
+        # none may replace the record another thread just created
+        def work(i):
+            for j in range(300):
+                name = 'shared' + str(j)
+                self.getStorage(name, timeout=60).set('t' + str(i), j)
+        self._hammer(8, work)
+        for j in range(300):
+            data = dict(self.getStorage('shared' + str(j)).items())
+            self.assertEqual(dict([ ('t' + str(i), j) for i in range(8) ])
+                , data
+                )
+        self.assertEqual(300, self.storageClass.count_between(
+            'test', 'test_ram_shared', 'test_ram_shared~'
+            ))
+
+    def test_maxEntries(self):
+        lg_authority.common.config['site_storage_sections_test'][
+            'max_entries'] = 3
+        self.getStorage('a', timeout=60).set('v', 1)
+        self.getStorage('b', timeout=60).set('v', 1)
+        self.getStorage('dead', timeout=-10).set('v', 1)
+        # The expired slate goes first, even though it was used last
+        self.getStorage('c', timeout=60).set('v', 1)
+        stats = self.storageClass.get_stats('test')
+        self.assertEqual(3, stats['entries'])
+        self.assertEqual(1, stats['expired_evictions'])
+        self.assertEqual(0, stats['evictions'])
+
+        # Then the least recently used
+        self.getStorage('a').get('v', None)
+        self.getStorage('d', timeout=60).set('v', 1)
+        self.assertEqual(
+            [ 'test_ram_a', 'test_ram_c', 'test_ram_d' ]
+            , sorted(self.storageClass.section_cache['test'].keys())
+            )
+        self.assertEqual(1, self.storageClass.get_stats('test')['evictions'])
+        self.assertEqual(3, self.storageClass.count_between(
+            'test', 'test_ram_', 'test_ram_z'
+            ))
+
+    def test_maxBytes(self):
+        lg_authority.common.config['site_storage_sections_test'][
+            'max_bytes'] = 20000
+        for i in range(10):
+            self.getStorage(str(i), timeout=60).set('v', 'x' * 5000)
+        stats = self.storageClass.get_stats('test')
+        self.assertTrue(stats['bytes'] <= 20000)
+        self.assertEqual(10, stats['entries'] + stats['evictions'])
+        self.assertTrue(stats['evictions'] >= 6)
+        self.assertTrue(self.getStorage('0').is_expired())
+        self.assertFalse(self.getStorage('9').is_expired())
+
+        # Shrinking a slate gives its bytes back
+        self.getStorage('9', timeout=60).set('v', '')
+        self.assertTrue(
+            self.storageClass.get_stats('test')['bytes'] < stats['bytes']
+            )
+
+    def test_loadSharesData(self):
+        self.getStorage('a', timeout=60).set('k', 1)
+        record = self.storageClass.section_cache['test']['test_ram_a']
+        self.assertFalse(hasattr(record, '__dict__'))
+
+        reader = self.getStorage('a')
+        self.assertEqual(1, reader.get('k', None))
+        self.assertTrue(reader.data is record.data)
+
+        # Writes replace the stored dict, so readers keep what they loaded
+        self.getStorage('a', timeout=60).set('k', 2)
+        self.assertEqual(1, reader.get('k', None))
+        self.assertEqual(2, self.getStorage('a').get('k', None))
+
+    def test_writesCopyOnce(self):
+        self.getStorage('a', timeout=60).update({ 'k': 1, 'l': 2 })
+        reader = self.getStorage('a')
+        self.assertEqual(1, reader.get('k', None))
+
+        # The first write copies what the reader shares; later ones change
+        # the writer's own copy
+        writer = self.getStorage('a', timeout=60)
+        writer.set('k', 2)
+        record = self.storageClass.section_cache['test']['test_ram_a']
+        data = record.data
+        writer.set('k', 3)
+        writer.pop('l', None)
+        self.assertTrue(data is record.data)
+        self.assertTrue(writer.data is record.data)
+        self.assertEqual([ ('k', 1), ('l', 2) ], sorted(reader.items()))
+
+        # Once loaded again, the next write copies again
+        reader = self.getStorage('a')
+        self.assertEqual(3, reader.get('k', None))
+        writer.set('k', 4)
+        self.assertFalse(data is record.data)
+        self.assertEqual([ ('k', 3) ], reader.items())
+        self.assertEqual([ ('k', 4) ], self.getStorage('a').items())
+
+    def test_indexListChangedInPlace(self):
+        # As AuthInterface.token_delete does: change the list get() returned,
+        # then set it again
+        store = self.getStorage('a', timeout=60)
+        store.set('tags', [ 't1', 't2' ])
+        store = self.getStorage('a', timeout=60)
+        tags = store.get('tags', None)
+        tags.remove('t1')
+        tags.append('t3')
+        store.set('tags', tags)
+
+        find = self.storageClass.find_with
+        self.assertEqual([], find('test', 'tags', 't1'))
+        self.assertEqual(0, self.storageClass.count_with('test', 'tags', 't1'))
+        self.assertEqual([ 'test_ram_a' ]
+            , [ s.id for s in find('test', 'tags', 't3') ]
+            )
+
+        # Dropping the slate removes what was indexed, not what it holds now
+        tags.append('t4')
+        self.getStorage('a').expire()
+        self.assertEqual({}, self.storageClass.indexes['test']['tags'])
@@ -0,0 +1,88 @@
+import lg_authority
+from lg_authority.testutil import LgTestCase
+from lg_authority.slates.storage.shm_store import ShmBucketFullError
+from .storageTestCommon import StorageTestCommon, testDir
+
+import multiprocessing
+import os
+testPath = os.path.join(testDir, 'test.shm')
+
+def _writeFromProcess(storageClass, i):
+    for j in range(50):
+        storageClass('test', 'test_shm_shared', 60).set('p' + str(i), j)
+        storageClass('test', 'test_shm_p' + str(i) + '_' + str(j), 60).touch()
+
+class TestStorageShm(StorageTestCommon, LgTestCase):
+    storageName = 'shm'
+    storageConfig = { 'file': testPath, 'buckets': 64, 'bucket_size': 65536 }
+
+    def test_processes(self):
+        # Forked processes share the file; none may lose another's writes
+        workers = [ multiprocessing.Process(target=_writeFromProcess
+            , args=(self.storageClass, i)) for i in range(4)
+            ]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+            self.assertEqual(0, w.exitcode)
+
+        self.assertEqual(
+            dict([ ('p' + str(i), 49) for i in range(4) ])
+            , dict(self.getStorage('shared').items())
+            )
+        self.assertEqual(200, self.storageClass.count_between(
+            'test', 'test_shm_p', 'test_shm_q'
+            ))
+
+    def test_cleanUp(self):
+        for i in range(3):
+            self.getStorage('dead' + str(i), timeout=-10).set('a', 1)
+        self.getStorage('live', timeout=60).set('a', 1)
+        self.assertEqual(3, self.storageClass.clean_up()['test'])
+        self.assertEqual(0, self.storageClass.clean_up().get('test', 0))
+        self.assertEqual(1, self.getStorage('live').get('a', None))
+
+    def test_bucketFull(self):
+        try:
+            self.storageClass.setup(dict(self.storageConfig
+                , file=testPath + '.small', buckets=1, bucket_size=512
+                ))
+            store = self.getStorage('big', timeout=60)
+            self.assertRaises(ShmBucketFullError, store.set, 'a', 'x' * 1000)
+            # Expired slates make room, and then those closest to expiry
+            self.getStorage('dead', timeout=-10).set('a', 'x' * 100)
+            self.getStorage('soon', timeout=30).set('a', 'x' * 100)
+            self.getStorage('later', timeout=3600).set('a', 'x' * 100)
+            self.getStorage('forever', timeout=None).set('a', 'x' * 100)
+            self.getStorage('new', timeout=60).set('a', 'x' * 100)
+            self.assertTrue(self.getStorage('soon').is_expired())
+            for name in [ 'later', 'forever', 'new' ]:
+                self.assertFalse(self.getStorage(name).is_expired(), name)
+            self.getStorage('newer', timeout=60).set('a', 'x' * 100)
+            self.assertTrue(self.getStorage('new').is_expired())
+            self.assertFalse(self.getStorage('forever').is_expired())
+        finally:
+            self.storageClass.setup(self.storageConfig)
+            os.remove(testPath + '.small')
+
+    def test_bucketHalfWritten(self):
+        store = self.getStorage('a', timeout=60)
+        store.set('a', 'x' * 100)
+        bucket = self.storageClass._bucket_of(store._key())
+        start = (self.storageClass.header_size
+            + bucket * self.storageClass.bucket_size
+            )
+        # As if a writer died while copying in the bucket's new entries
+        self.storageClass.map[start + 8:start + 40] = b'\xff' * 32
+        self.assertTrue(self.getStorage('a').is_expired())
+        self.getStorage('a', timeout=60).set('b', 1)
+        self.assertEqual([ ('b', 1) ], self.getStorage('a').items())
+
+    def test_geometryMismatch(self):
+        try:
+            self.assertRaises(ValueError, self.storageClass.setup
+                , dict(self.storageConfig, buckets=32)
+                )
+        finally:
+            self.storageClass.setup(self.storageConfig)
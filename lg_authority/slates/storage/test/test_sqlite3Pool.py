@@ -0,0 +1,94 @@
+import threading
+import time
+
+from lg_authority.testutil import LgTestCase
+from lg_authority.slates.storage.sqlite3_pool import ConnectionPool
+from lg_authority.slates.storage.sqlite3_pool import PoolTimeoutError
+
+class FakeConnection(object):
+    closed = False
+    rolledBack = False
+
+    def close(self):
+        self.closed = True
+
+    def rollback(self):
+        self.rolledBack = True
+
+class TestConnectionPool(LgTestCase):
+
+    def test_reentrant(self):
+        pool = ConnectionPool(FakeConnection, 1)
+        with pool.connection() as db:
+            with pool.connection() as db2:
+                self.assertTrue(db is db2)
+        with pool.connection() as db3:
+            self.assertTrue(db is db3)
+        self.assertEqual(1, pool.get_stats()['opened'])
+
+    def test_bounded(self):
+        pool = ConnectionPool(FakeConnection, 1, wait_timeout=0.05)
+        errors = []
+        def other():
+            try:
+                with pool.connection() as db:
+                    pass
+            except PoolTimeoutError:
+                errors.append(True)
+        with pool.connection() as db:
+            t = threading.Thread(target=other)
+            t.start()
+            t.join()
+        self.assertEqual([ True ], errors)
+        stats = pool.get_stats()
+        self.assertEqual(1, stats['waits'])
+        self.assertEqual(1, stats['timeouts'])
+
+    def test_wait(self):
+        pool = ConnectionPool(FakeConnection, 1)
+        got = []
+        def other():
+            with pool.connection() as db:
+                got.append(db)
+        with pool.connection() as db:
+            t = threading.Thread(target=other)
+            t.start()
+            time.sleep(0.05)
+            self.assertEqual([], got)
+        t.join()
+        self.assertTrue(got[0] is db)
+        self.assertEqual(1, pool.get_stats()['waits'])
+
+    def test_reap(self):
+        pool = ConnectionPool(FakeConnection, 2, idle_timeout=0)
+        with pool.connection() as db:
+            pass
+        self.assertTrue(db.closed)
+        self.assertEqual(0, pool.get_stats()['open'])
+
+    def test_close(self):
+        pool = ConnectionPool(FakeConnection)
+        with pool.connection() as idle:
+            pass
+        pool.close()
+        self.assertTrue(idle.closed)
+
+        # Connections in use are closed when returned
+        with pool.connection() as held:
+            pool.close()
+            self.assertFalse(held.closed)
+        self.assertTrue(held.closed)
+        self.assertEqual(0, pool.get_stats()['open'])
+
+        # Usable afterward
+        with pool.connection() as db:
+            self.assertFalse(db.closed)
+
+    def test_rollbackOnError(self):
+        pool = ConnectionPool(FakeConnection)
+        try:
+            with pool.connection() as db:
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertTrue(db.rolledBack)
@@ -1,10 +1,417 @@
+import lg_authority
 from lg_authority.testutil import LgTestCase
-from .storageTestCommon import StorageTestCommon
+from lg_authority.slates.batch import SlateBatch
+from lg_authority.slates.storage.common import StoredValue
+from lg_authority.slates.storage.sqlite3_pool import ConnectionPool
+from .storageTestCommon import StorageTestCommon, testDir
 
+import datetime
 import os
-testPath = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test.db') 
+import threading
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+testPath = os.path.join(testDir, 'test.db')
+
+class NoSqlConnection(object):
+    """Stand-in connection that fails on any use."""
+    def cursor(self):
+        raise AssertionError("Unexpected SQL round trip")
+
+class CountingConnection(object):
+    """Wraps a connection, counting statements executed through cursors."""
+    def __init__(self, db):
+        self.db = db
+        self.executed = []
+
+    def cursor(self):
+        return CountingCursor(self, self.db.cursor())
+
+    def __getattr__(self, name):
+        return getattr(self.db, name)
+
+class CountingCursor(object):
+    def __init__(self, connection, cur):
+        self.connection = connection
+        self.cur = cur
+
+    def execute(self, query, *args):
+        self.connection.executed.append(query)
+        return self.cur.execute(query, *args)
+
+    def __getattr__(self, name):
+        return getattr(self.cur, name)
 
 class TestStorageSqlite3(StorageTestCommon, LgTestCase):
     storageName = 'sqlite3'
     storageConfig = { 'file': testPath }
 
+    def test_sectionRegistryExisting(self):
+        # Sections already on disk are registered on first sight
+        store = self.getStorage(timeout=60)
+        store.touch()
+
+        self.storageClass.setup(self.storageConfig)
+        self.assertFalse('test' in self.storageClass.storage_checked)
+        self.getStorage()
+        self.assertTrue('test' in self.storageClass.storage_checked)
+
+    def test_sectionRegistryNoSql(self):
+        # Once registered, constructing storage must not hit the database
+        self.getStorage()
+        realPool = self.storageClass.pool
+        self.storageClass.pool = ConnectionPool(NoSqlConnection)
+        try:
+            self.getStorage()
+            self.getStorage('other')
+        finally:
+            self.storageClass.pool = realPool
+
+    def test_sectionRegistryDestroy(self):
+        store = self.getStorage(timeout=60)
+        store.touch()
+        self.storageClass.destroySectionBeCarefulWhenYouCallThis('test')
+        self.assertFalse('test' in self.storageClass.storage_checked)
+
+        # Tables must be recreated on next use
+        store = self.getStorage(timeout=60)
+        store.set('a', 'b')
+        self.assertEqual('b', self.getStorage().get('a', None))
+
+    def test_pragmas(self):
+        self.storageClass.setup(dict(self.storageConfig
+            , journal_mode='WAL', synchronous='normal', cache_size=-4000
+            , busy_timeout=2
+            ))
+        try:
+            db = self.storageClass.pool.checkout()
+            self.storageClass.pool.checkin(db)
+            self.assertEqual('wal'
+                , db.execute("PRAGMA journal_mode").fetchone()[0]
+                )
+            self.assertEqual(1, db.execute("PRAGMA synchronous").fetchone()[0])
+            self.assertEqual(-4000
+                , db.execute("PRAGMA cache_size").fetchone()[0]
+                )
+            self.assertEqual(2000
+                , db.execute("PRAGMA busy_timeout").fetchone()[0]
+                )
+            self.getStorage(timeout=60).set('a', 'b')
+            self.assertEqual('b', self.getStorage().get('a', None))
+        finally:
+            # journal_mode is stored in the database file
+            with self.storageClass._connection() as db:
+                db.execute("PRAGMA journal_mode = delete")
+            self.storageClass.setup(self.storageConfig)
+
+    def test_pragmasBad(self):
+        self.assertRaises(ValueError, self.storageClass.setup
+            , dict(self.storageConfig, synchronous='sometimes; DROP TABLE x')
+            )
+        self.storageClass.setup(self.storageConfig)
+
+    def test_poolShared(self):
+        # Threads share pooled connections rather than opening their own
+        self.storageClass.setup(dict(self.storageConfig, pool_size=2))
+        try:
+            def worker():
+                for i in range(20):
+                    store = self.getStorage('t' + str(i), timeout=60)
+                    store.set('a', i)
+            threads = [ threading.Thread(target=worker) for i in range(5) ]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+            stats = self.storageClass.pool.get_stats()
+            self.assertTrue(stats['opened'] <= 2)
+            self.assertEqual(19, self.getStorage('t19').get('a', None))
+        finally:
+            self.storageClass.setup(self.storageConfig)
+
+    def test_poolShutdown(self):
+        self.getStorage(timeout=60).set('a', 'b')
+        self.storageClass.shutdown()
+        stats = self.storageClass.pool.get_stats()
+        self.assertEqual(0, stats['open'])
+
+        # Still usable afterward
+        self.assertEqual('b', self.getStorage().get('a', None))
+
+    def test_poolMemory(self):
+        # Every thread must see the same :memory: database
+        self.storageClass.setup({ 'file': ':memory:' })
+        try:
+            self.getStorage(timeout=60).set('a', 'b')
+            result = []
+            t = threading.Thread(
+                target=lambda: result.append(self.getStorage().get('a', None))
+                )
+            t.start()
+            t.join()
+            self.assertEqual([ 'b' ], result)
+        finally:
+            self.storageClass.setup(self.storageConfig)
+
+    def test_migrateSchema1(self):
+        # Sections created before schema versions stored expire as a
+        # TIMESTAMP string
+        import sqlite3
+        self.storageClass.destroySectionBeCarefulWhenYouCallThis('test')
+        now = datetime.datetime.utcnow()
+        db = sqlite3.connect(testPath)
+        db.execute("""CREATE TABLE "test" (id TEXT, timeout INTEGER, expire TIMESTAMP)""")
+        db.execute("""CREATE TABLE "test_data" (id TEXT, key TEXT, value BLOB)""")
+        db.execute("""CREATE TABLE "test_index" (id TEXT, key TEXT, value TEXT)""")
+        db.executemany("""INSERT INTO "test" VALUES (?,?,?)""", [
+            ('live', 60, now + datetime.timedelta(seconds=30.5))
+            ,('dead', 60, now - datetime.timedelta(seconds=30))
+            ,('forever', None, None)
+            ])
+        db.execute("""INSERT INTO "test_data" VALUES (?,?,?)""", (
+            'live', 'a', sqlite3.Binary(pickle.dumps('b'))
+            ))
+        db.commit()
+        db.close()
+
+        self.storageClass.setup(self.storageConfig)
+        store = self.storageClass('test', 'live', 60)
+        self.assertEqual('b', store.get('a', None))
+        ttl = store.time_to_expire()
+        self.assertTrue(30 <= ttl <= 31.5, ttl)
+        self.assertTrue(self.storageClass('test', 'dead', 60).is_expired())
+        store = self.storageClass('test', 'forever', None)
+        self.assertFalse(store.is_expired())
+        self.assertEqual(None, store.time_to_expire())
+
+        with self.storageClass._connection() as db:
+            self.assertEqual(
+                [ (2,) ]
+                , db.execute("""SELECT version FROM lg_authority_schema WHERE section = 'test'""").fetchall()
+                )
+            self.assertEqual(
+                [ ('integer',), ('integer',) ]
+                , db.execute("""SELECT typeof(expire) FROM "test" WHERE expire IS NOT NULL""").fetchall()
+                )
+
+        # Migration happens once
+        self.storageClass.setup(self.storageConfig)
+        store = self.storageClass('test', 'live', 60)
+        self.assertTrue(30 <= store.time_to_expire() <= 31.5)
+
+        self.storageClass.clean_up()
+        with self.storageClass._connection() as db:
+            self.assertEqual(
+                [ ('forever',), ('live',) ]
+                , db.execute("""SELECT id FROM "test" ORDER BY id""").fetchall()
+                )
+
+    def test_cleanUp(self):
+        self.storageClass.setup(dict(self.storageConfig, clean_chunk=2))
+        self.storageClass.destroySectionBeCarefulWhenYouCallThis('test2')
+        try:
+            for i in range(5):
+                self.getStorage('dead' + str(i), timeout=-10).update({
+                    'a': 1, 'tags': [ 'x' ]
+                    })
+            self.getStorage('live', timeout=60).update({ 'tags': [ 'x' ] })
+            self.storageClass('test2', 'dead', -10).touch()
+
+            # Sections not yet used by this process are cleaned too
+            self.storageClass.setup(dict(self.storageConfig, clean_chunk=2))
+            result = self.storageClass.clean_up()
+            self.assertEqual(5, result['test'])
+            self.assertEqual(1, result['test2'])
+
+            self.assertEqual([ 'test_sqlite3_live' ], [ 
+                s.id for s in self.storageClass.find_with('test', 'tags', 'x')
+                ])
+            with self.storageClass._connection() as db:
+                self.assertEqual(0, db.execute("""SELECT COUNT(*) FROM "test_data" WHERE id LIKE '%dead%'""").fetchone()[0])
+            self.assertEqual(0, self.storageClass.clean_up()['test'])
+        finally:
+            self.storageClass.destroySectionBeCarefulWhenYouCallThis('test2')
+            self.storageClass.setup(self.storageConfig)
+
+    def test_batchHeldUntilFlush(self):
+        batch = SlateBatch()
+        batch.begin()
+        try:
+            store = self.getStorage(timeout=60)
+            store.set('a', 'b')
+        finally:
+            batch.end()
+
+        # Nothing was written yet
+        self.assertTrue(self.getStorage().is_expired())
+
+        batch.flush()
+        self.assertEqual('b', self.getStorage().get('a', None))
+
+    def test_batchDiscard(self):
+        batch = SlateBatch()
+        batch.begin()
+        try:
+            self.getStorage(timeout=60).set('a', 'b')
+        finally:
+            batch.end()
+        batch.discard()
+        batch.flush()
+
+        self.assertTrue(self.getStorage().is_expired())
+
+    def test_batchContextRaises(self):
+        try:
+            with SlateBatch():
+                self.getStorage(timeout=60).set('a', 'b')
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertTrue(self.getStorage().is_expired())
+
+    def test_batchContextAllOrNothing(self):
+        # A failure writing any slate writes none of them
+        def unpicklable():
+            pass
+        try:
+            with SlateBatch():
+                self.getStorage('a', timeout=60).set('a', 'b')
+                self.getStorage('b', timeout=60).set('a', unpicklable)
+        except Exception:
+            pass
+        else:
+            self.fail("Expected an error pickling a function")
+        self.assertTrue(self.getStorage('a').is_expired())
+        self.assertTrue(self.getStorage('b').is_expired())
+
+    def test_batchContextJoins(self):
+        with SlateBatch() as outer:
+            with SlateBatch():
+                self.getStorage(timeout=60).set('a', 'b')
+            # Held until the enclosing batch is written
+            self.assertEqual(1, len(outer.entries))
+        self.assertEqual(0, len(outer.entries))
+        self.assertEqual('b', self.getStorage().get('a', None))
+
+    def test_cacheKeysFetched(self):
+        store = self.getStorage(timeout=60)
+        store.update({ 'a': 1, 'b': 2, 'c': 3 })
+
+        lg_authority.common.config['site_storage_sections_test']['cache'] = [
+            'a'
+            ]
+        store = self.getStorage()
+        store.touch()
+        self.assertEqual([ 'a' ], list(store.cache.keys()))
+        self.assertEqual(2, store.get('b', None))
+        self.assertEqual(set([ 'a', 'b' ]), set(store.cache.keys()))
+
+    def test_accessOneQuery(self):
+        store = self.getStorage(timeout=60)
+        store.update({ 'a': 1, 'b': 2 })
+
+        realPool = self.storageClass.pool
+        counting = CountingConnection(self.storageClass._connect())
+        self.storageClass.pool = ConnectionPool(lambda: counting)
+        try:
+            store = self.getStorage()
+            self.assertEqual(1, store.get('a', None))
+            self.assertEqual(2, store.get('b', None))
+            self.assertEqual(1, len(counting.executed))
+
+            store.expire()
+            del counting.executed[:]
+            store = self.getStorage()
+            self.assertTrue(store.is_expired())
+            self.assertEqual(1, len(counting.executed))
+        finally:
+            self.storageClass.pool = realPool
+
+    def test_popMissingNoWrite(self):
+        store = self.getStorage(timeout=60)
+        store.update({ 'a': 1 })
+
+        realPool = self.storageClass.pool
+        counting = CountingConnection(self.storageClass._connect())
+        self.storageClass.pool = ConnectionPool(lambda: counting)
+        try:
+            store = self.getStorage()
+            self.assertEqual(None, store.pop('b', None))
+            self.assertEqual(1, len(counting.executed))
+        finally:
+            self.storageClass.pool = realPool
+        self.assertEqual(1, store.pop('a', None))
+        self.assertEqual([], self.getStorage().items())
+
+    def test_decodeOnRead(self):
+        store = self.getStorage(timeout=60)
+        store.update({ 'a': { 'x': 1 }, 'b': [ 2 ] })
+
+        store = self.getStorage()
+        store.touch()
+        self.assertTrue(isinstance(store.cache['a'], StoredValue))
+        self.assertEqual({ 'x': 1 }, store.get('a', None))
+        self.assertEqual({ 'x': 1 }, store.cache['a'])
+        self.assertTrue(isinstance(store.cache['b'], StoredValue))
+
+class TestStorageSqlite3Document(StorageTestCommon, LgTestCase):
+    """The shared storage tests, against the document layout"""
+    storageName = 'sqlite3'
+    storageConfig = { 'file': testPath }
+
+    def setUp(self):
+        StorageTestCommon.setUp(self)
+        lg_authority.common.config['site_storage_sections_test'][
+            'layout'] = 'document'
+
+    def test_documentTables(self):
+        store = self.getStorage(timeout=60)
+        store.update({ 'a': 1, 'tags': [ 'x' ] })
+        self.assertEqual('document'
+            , self.storageClass.section_layouts['test']
+            )
+        with self.storageClass._connection() as db:
+            self.assertEqual(0, db.execute("""SELECT COUNT(*) FROM SQLite_Master WHERE name = 'test_data'""").fetchone()[0])
+        self.assertEqual(1, self.storageClass.count_with('test', 'tags', 'x'))
+
+    def test_migrateLayout(self):
+        lg_authority.common.config['site_storage_sections_test'][
+            'layout'] = 'rows'
+        self.getStorage('a', timeout=60).update({ 'a': 1, 'tags': [ 'x' ] })
+        self.getStorage('b', timeout=60).update({ 'b': set([ 2 ]) })
+        self.getStorage('c', timeout=None).touch()
+        ttl = self.getStorage('a').time_to_expire()
+        self.assertEqual('rows', self.storageClass.section_layouts['test'])
+
+        for layout in [ 'document', 'rows' ]:
+            lg_authority.common.config['site_storage_sections_test'][
+                'layout'] = layout
+            self.assertEqual(3
+                , self.storageClass.migrate_layout('test', layout)
+                )
+            self.assertEqual(0
+                , self.storageClass.migrate_layout('test', layout)
+                )
+            self.storageClass.setup(self.storageConfig)
+            self.getStorage('a')
+            self.assertEqual(layout
+                , self.storageClass.section_layouts['test']
+                )
+
+            store = self.getStorage('a')
+            self.assertEqual(
+                [ ('a', 1), ('tags', [ 'x' ]) ], sorted(store.items())
+                )
+            self.assertTrue(abs(store.time_to_expire() - ttl) < 2)
+            self.assertEqual(set([ 2 ]), self.getStorage('b').get('b', None))
+            self.assertEqual(None, self.getStorage('c').time_to_expire())
+            self.assertEqual([ 'test_sqlite3_a' ], [
+                s.id for s in self.storageClass.find_with('test', 'tags', 'x')
+                ])
+
+            # Still writable
+            self.getStorage('b').set('d', 4)
+            self.assertEqual(4, self.getStorage('b').get('d', None))
+            self.getStorage('b').pop('d', None)
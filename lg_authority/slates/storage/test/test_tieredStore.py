@@ -0,0 +1,196 @@
+import lg_authority
+from lg_authority.testutil import LgTestCase
+from lg_authority.slates.batch import SlateBatch
+from lg_authority.slates.storage import get_storage_class
+from lg_authority.slates.storage.invalidation import InvalidationBus
+from .storageTestCommon import StorageTestCommon, testDir
+
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+testPath = os.path.join(testDir, 'test.db')
+shmPath = os.path.join(testDir, 'test.shm')
+
+class TestStorageTiered(StorageTestCommon, LgTestCase):
+    storageName = 'tiered'
+    storageConfig = { 'backend': 'sqlite3', 'backend_conf': { 'file': testPath }
+        , 'ttl': 60
+        }
+
+    def tearDown(self):
+        self.storageClass.shutdown()
+        StorageTestCommon.tearDown(self)
+
+    def test_readThrough(self):
+        self.getStorage('a', timeout=60).set('k', 1)
+        self.assertEqual(1, self.getStorage('a').get('k', None))
+        self.assertEqual(1, self.getStorage('a').get('k', None))
+        # The writer found nothing to cache; the first reader cached it
+        stats = self.storageClass.get_stats('test')
+        self.assertEqual(2, stats['misses'])
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(1, stats['cached'])
+
+        # Served from memory, so a write made straight to the backend is
+        # not seen until the TTL runs out
+        backend = get_storage_class('sqlite3')
+        backend('test', 'test_tiered_a', 60).set('k', 2)
+        self.assertEqual(1, self.getStorage('a').get('k', None))
+        lg_authority.common.config['site_storage_sections_test'][
+            'cache_ttl'] = 0
+        self.assertEqual(2, self.getStorage('a').get('k', None))
+
+    def test_writeUpdatesCache(self):
+        self.getStorage('a', timeout=60).set('k', 1)
+        reader = self.getStorage('a')
+        self.assertEqual(1, reader.get('k', None))
+        self.getStorage('a', timeout=60).update({ 'k': 2, 'l': 3 })
+        # Readers keep what they loaded; later ones see the write
+        self.assertEqual(1, reader.get('k', None))
+        store = self.getStorage('a')
+        self.assertEqual([ ('k', 2), ('l', 3) ], sorted(store.items()))
+        self.assertEqual(2, self.storageClass.get_stats('test')['hits'])
+
+    def test_writeDuringRead(self):
+        self.getStorage('a', timeout=60).set('k', 1)
+        backend = get_storage_class('sqlite3')
+        items = backend.items
+        def itemsThenWrite(slate):
+            # A write lands after the reader read the backend, but before
+            # it cached what it read
+            result = items(slate)
+            backend.items = items
+            self.getStorage('a', timeout=60).set('k', 2)
+            return result
+        backend.items = itemsThenWrite
+        try:
+            self.assertEqual(1, self.getStorage('a').get('k', None))
+        finally:
+            backend.items = items
+        self.assertEqual(2, self.getStorage('a').get('k', None))
+
+    def test_invalidateDuringRead(self):
+        self.getStorage('a', timeout=60).set('k', 1)
+        backend = get_storage_class('sqlite3')
+        items = backend.items
+        def itemsThenInvalidate(slate):
+            # Only the invalidated slate is kept from the cache
+            self.storageClass._invalidate('test', 'test_tiered_b')
+            return items(slate)
+        backend.items = itemsThenInvalidate
+        try:
+            self.assertEqual(1, self.getStorage('a').get('k', None))
+        finally:
+            backend.items = items
+        self.assertEqual(1, self.storageClass.get_stats('test')['cached'])
+
+
+class TestStorageTieredBehind(StorageTestCommon, LgTestCase):
+    storageName = 'tiered'
+    storageConfig = { 'backend': 'sqlite3', 'backend_conf': { 'file': testPath }
+        , 'ttl': 60, 'write_behind': 3600
+        }
+
+    def tearDown(self):
+        self.storageClass.shutdown()
+        StorageTestCommon.tearDown(self)
+
+    def test_writeBehind(self):
+        backend = get_storage_class('sqlite3')
+        self.getStorage('a', timeout=60).set('k', 1)
+        self.getStorage('a', timeout=60).set('l', 2)
+        self.assertTrue(backend('test', 'test_tiered_a', {}).is_expired())
+        self.assertEqual(1, self.storageClass.get_stats('test')['pending'])
+
+        # Held writes are seen even once the cached copy is gone
+        lg_authority.common.config['site_storage_sections_test'][
+            'cache_ttl'] = 0
+        self.assertEqual(2, self.getStorage('a').get('l', None))
+
+        self.assertEqual(1, self.storageClass.flush())
+        self.assertEqual([ ('k', 1), ('l', 2) ]
+            , sorted(backend('test', 'test_tiered_a', {}).items())
+            )
+        self.assertEqual(0, self.storageClass.get_stats('test')['pending'])
+
+    def test_flushInBatch(self):
+        # A flush from inside a request's batch writes to the backend, not
+        # into the batch
+        self.getStorage('a', timeout=60).set('tags', [ 't' ])
+        try:
+            with SlateBatch():
+                self.assertEqual([ 'test_tiered_a' ], [ s.id for s in
+                    self.storageClass.find_with('test', 'tags', 't')
+                    ])
+                raise KeyError()
+        except KeyError:
+            pass
+        self.assertEqual(0, self.storageClass.get_stats('test')['pending'])
+        self.assertEqual([ 't' ], get_storage_class('sqlite3')(
+            'test', 'test_tiered_a', {}
+            ).get('tags', None))
+
+    def test_writeBehindNewId(self):
+        store = self.storageClass('test', None, 60)
+        store.set('k', 1)
+        self.assertTrue(store.id is not None)
+        self.storageClass.flush()
+        self.assertEqual(1, get_storage_class('sqlite3')(
+            'test', store.id, {}
+            ).get('k', None))
+
+
+def _writeFromProcess(storageClass):
+    storageClass('test', 'test_tiered_a', 60).set('k', 2)
+
+class TestStorageTieredInvalidate(StorageTestCommon, LgTestCase):
+    storageName = 'tiered'
+    storageConfig = { 'backend': 'shm', 'backend_conf': { 'file': shmPath
+        , 'buckets': 64, 'bucket_size': 65536 }, 'ttl': 60
+        }
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.storageConfig = dict(self.storageConfig
+            , invalidate=self.directory
+            )
+        StorageTestCommon.setUp(self)
+
+    def tearDown(self):
+        self.storageClass.shutdown()
+        StorageTestCommon.tearDown(self)
+        shutil.rmtree(self.directory)
+
+    def _waitUncached(self):
+        for i in range(500):
+            if self.storageClass.get_stats('test')['cached'] == 0:
+                return
+            time.sleep(0.01)
+        self.fail("Cached slate was not invalidated")
+
+    def test_invalidate(self):
+        self.getStorage('a', timeout=60).set('k', 1)
+        self.assertEqual(1, self.getStorage('a').get('k', None))
+        self.assertEqual(1, self.storageClass.get_stats('test')['cached'])
+
+        # Another process writes the slate
+        worker = multiprocessing.Process(target=_writeFromProcess
+            , args=(self.storageClass,)
+            )
+        worker.start()
+        worker.join()
+        self.assertEqual(0, worker.exitcode)
+        self._waitUncached()
+        self.assertEqual(2, self.getStorage('a').get('k', None))
+
+    def test_invalidatePeer(self):
+        self.getStorage('a', timeout=60).set('k', 1)
+        self.getStorage('a').get('k', None)
+        peer = InvalidationBus(self.directory, lambda s, i: None)
+        try:
+            peer.publish('test', 'test_tiered_a')
+        finally:
+            peer.close()
+        self._waitUncached()
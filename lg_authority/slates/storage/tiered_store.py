@@ -0,0 +1,573 @@
+import threading
+import time
+import uuid
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    OrderedDict = dict
+
+from .common import *
+from . import get_storage_class
+from .invalidation import InvalidationBus
+from ..batch import SlateBatch
+
+class TieredEntry(object):
+    """A slate as cached in process memory by TieredStorage.  data is never
+    changed in place once cached; writes cache a modified copy.
+    """
+    __slots__ = ('data', 'timeout', 'expiry', 'loaded')
+
+    def __init__(self, data, timeout, expiry, loaded):
+        self.data = data
+        self.timeout = timeout
+        self.expiry = expiry #None if the slate never expires
+        self.loaded = loaded #When data was read from the backend
+
+
+class TieredWrite(object):
+    """Writes to one slate held by TieredStorage's write-behind."""
+    __slots__ = ('timeout', 'expiry', 'fields', 'clear')
+
+    def __init__(self, timeout, expiry):
+        self.timeout = timeout
+        self.expiry = expiry
+        self.fields = {} #key: value, or key: missing for deletion
+        self.clear = False
+
+    def merge(self, newer):
+        """Returns the writes of self followed by those of newer."""
+        if newer.clear:
+            return newer
+        result = TieredWrite(newer.timeout, newer.expiry)
+        result.clear = self.clear
+        result.fields.update(self.fields)
+        result.fields.update(newer.fields)
+        return result
+
+
+class TieredStorage(SlateStorage):
+    """Storing slates in another storage backend (sqlite3, pymongo, shm),
+    with an in-process cache in front of it.
+
+    Reads of a section with a cache TTL are served from memory while the
+    cached copy is younger than the TTL; otherwise they read through to the
+    backend and cache what they read.  Writes update the cached copy, and
+    either go straight to the backend (write-through) or are held and
+    written in one batch every write_behind seconds (write-behind).  Writes
+    held by write-behind are seen by every read in this process, and are
+    written before any find_ or count_ query.
+
+    Other processes' writes are only seen once the cached copy's TTL runs
+    out, so only cache sections that rarely change, or that only one
+    process writes.
+
+    Available params in storage_conf:
+        backend: Name of the storage backend, as for site_storage.  Default
+            'sqlite3'.
+        backend_conf: site_storage_conf for the backend.
+        ttl: Seconds a cached slate is served before it is read again.
+            Default 0, which disables caching.  Set per section with the
+            'cache_ttl' key of site_storage_sections_{section}.
+        write_behind: If set, seconds between writes of held writes to the
+            backend.  Default 0, which writes through.
+        invalidate: A directory shared by every process using the backend.
+            If set, each write to a cached section is published through an 
+            InvalidationBus on it, and every other process drops its cached
+            copy of the slate.
+    """
+
+    backend = None
+    backend__doc = "The backend's storage class"
+
+    default_ttl = 0
+    write_behind = 0
+
+    l1 = {}
+    l1__doc = "(section, id): TieredEntry for every cached slate"
+
+    pending = OrderedDict()
+    pending__doc = "(section, id): TieredWrite held by write-behind"
+
+    flushing = {}
+    flushing__doc = """Held writes being written by flush(); still seen by
+        reads until they are
+        """
+
+    lock = threading.Lock()
+    lock__doc = "Guards l1, pending, flushing and section_stats"
+
+    flush_lock = threading.Lock()
+    flush_lock__doc = "Held by flush() so only one thread writes at once"
+
+    section_stats = {}
+    section_stats__doc = "Per section cache hits and misses"
+
+    flusher = None
+    flusher__doc = "(thread, stop event) that flushes held writes"
+
+    bus = None
+    bus__doc = "InvalidationBus, if invalidate is set"
+
+    version = 0
+    version__doc = """Incremented for every change to a slate, made here or
+        invalidated by another process
+        """
+
+    versions = {}
+    versions__doc = """(section, id): version of the slate's last change.  A
+        read does not cache what it read if the slate changed while it was
+        reading.  Entries older than the previous clean_up are dropped.
+        """
+
+    versions_floor = 0
+    versions_floor__doc = "version as of the previous clean_up"
+
+    def __init__(self, section, id, timeout):
+        self.section = section
+        self.id = id
+        self.timeout = timeout
+        self.l2 = self.backend(section, id, timeout)
+
+    def _key(self):
+        return (self.section, self.id)
+
+    def _ttl(self):
+        return self.get_section_config().get('cache_ttl', self.default_ttl)
+
+    def _access(self):
+        """Called before access of any type"""
+        if hasattr(self, '_first_access'):
+            return
+        self._first_access = True
+
+        ttl = self._ttl()
+        now = time.time()
+        if ttl and self.id is not None:
+            if self.bus is not None:
+                self.bus.check_fork()
+            with self.lock:
+                stats = self._stats(self.section)
+                entry = self.l1.get(self._key())
+                if entry is not None and (
+                    now - entry.loaded >= ttl
+                    or entry.expiry is not None and entry.expiry < now
+                    ):
+                    del self.l1[self._key()]
+                    entry = None
+                if entry is None:
+                    stats['misses'] += 1
+                else:
+                    stats['hits'] += 1
+            if entry is not None:
+                self.expired = False
+                self.data = entry.data
+                self._data_owned = False
+                self.expiry = entry.expiry
+                if isinstance(self.timeout, dict):
+                    self.timeout = entry.timeout
+                log('Loaded cached slate with {0}'.format(self.data))
+                return
+
+        self._load(now, ttl)
+
+    def _load(self, now, ttl):
+        """Reads the slate from the backend, applies any held writes to it,
+        and caches it if ttl is set.
+        """
+        start = self.version
+        expired = self.id is None or self.l2.is_expired()
+        data = {}
+        timeout = self.l2.timeout
+        expiry = None
+        if not expired:
+            data = dict(self.l2.items())
+            ttx = self.l2.time_to_expire()
+            if ttx is not None:
+                expiry = now + ttx
+
+        if self.id is not None:
+            with self.lock:
+                held = [ w for w in [ self.flushing.get(self._key())
+                    , self.pending.get(self._key()) ] if w is not None
+                    ]
+            for write in held:
+                if write.clear:
+                    data = {}
+                for k, v in write.fields.items():
+                    if v is missing:
+                        data.pop(k, None)
+                    else:
+                        data[k] = v
+                expired = False
+                timeout = write.timeout
+                expiry = write.expiry
+
+        self.expired = expired
+        self.data = data
+        self._data_owned = True
+        self.expiry = expiry
+        if isinstance(self.timeout, dict) and not isinstance(timeout, dict):
+            self.timeout = timeout
+        if ttl and not expired:
+            with self.lock:
+                if self.versions.get(self._key(), 0) <= start:
+                    self.l1[self._key()] = TieredEntry(data, self.timeout
+                        , expiry, now
+                        )
+                    self._data_owned = False
+        log('Loaded slate with {0}'.format(self.data))
+
+    def _write(self, change, fields, write_l2, clear=False):
+        """Applies a write: change (which modifies a dict in place) for the
+        cached copy and this object's view, fields (key: value, or key:
+        missing for deletion) for write-behind, and write_l2 (called with
+        the backend storage object) for write-through.  Returns what change
+        returned for this object's view.
+        """
+        self._access()
+        if self.expired and isinstance(self.timeout, dict):
+            raise ValueError("Timeout must be specified when writing "
+                + "a new slate."
+                )
+
+        now = time.time()
+        if self.write_behind:
+            if self.id is None:
+                self.id = self.generateId()
+                self.l2 = self.backend(self.section, self.id, self.timeout)
+        else:
+            write_l2(self.l2)
+            if self.id is None:
+                self.id = self.l2.id
+            self._publish(self.section, self.id)
+
+        timeout = self.timeout
+        expiry = None
+        if timeout is not None:
+            expiry = now + timeout
+        with self.lock:
+            self._changed(self._key())
+            entry = self.l1.get(self._key())
+            if entry is not None:
+                data = entry.data.copy()
+                change(data)
+                self.l1[self._key()] = TieredEntry(data, timeout, expiry
+                    , entry.loaded
+                    )
+            if self.write_behind:
+                write = TieredWrite(timeout, expiry)
+                write.clear = clear
+                write.fields.update(fields)
+                old = self.pending.get(self._key())
+                if old is not None:
+                    write = old.merge(write)
+                self.pending[self._key()] = write
+
+        if not self._data_owned:
+            self.data = self.data.copy()
+            self._data_owned = True
+        self.expired = False
+        self.expiry = expiry
+        return change(self.data)
+
+    def __str__(self):
+        return "TIERED({0})".format(self.id)
+
+    def __repr__(self):
+        return str(self)
+
+    def touch(self):
+        self._write(lambda data: None, {}, lambda l2: l2.touch())
+
+    def set(self, key, value):
+        def change(data):
+            data[key] = value
+        self._write(change, { key: value }, lambda l2: l2.set(key, value))
+
+    def update(self, d):
+        self._write(lambda data: data.update(d), d, lambda l2: l2.update(d))
+
+    def get(self, key, default):
+        self._access()
+        return self.data.get(key, default)
+
+    def pop(self, key, default):
+        return self._write(lambda data: data.pop(key, default)
+            , { key: missing }, lambda l2: l2.pop(key, None)
+            )
+
+    def clear(self):
+        self._write(lambda data: data.clear(), {}, lambda l2: l2.clear()
+            , clear=True
+            )
+
+    def keys(self):
+        self._access()
+        return self.data.keys()
+
+    def items(self):
+        self._access()
+        return self.data.items()
+
+    def values(self):
+        self._access()
+        return self.data.values()
+
+    def expire(self):
+        with self.lock:
+            self.pending.pop(self._key(), None)
+        if self.id is not None:
+            #Not while a flush might be writing this slate
+            with self.flush_lock:
+                self.l2.expire()
+        with self.lock:
+            #After the backend, so that no read can cache the old slate
+            self._changed(self._key())
+            self.l1.pop(self._key(), None)
+        if self.id is not None:
+            self._publish(self.section, self.id)
+        self._first_access = True
+        self.expired = True
+        self.data = {}
+        self._data_owned = True
+
+    def is_expired(self):
+        self._access()
+        return self.expired
+
+    def time_to_expire(self):
+        self._access()
+        if self.expired:
+            return 0
+        if self.expiry is None:
+            return None
+        return max(0, self.expiry - time.time())
+
+    @classmethod
+    def generateId(cls):
+        """Generates an id for a new slate written behind, through the
+        backend if it knows how.
+        """
+        generate = getattr(cls.backend, 'generateId', None)
+        if generate is not None:
+            return generate()
+        return uuid.uuid4().hex
+
+    @classmethod
+    def destroySectionBeCarefulWhenYouCallThis(cls, section):
+        with cls.lock:
+            for store in [ cls.l1, cls.pending ]:
+                for key in [ k for k in store if k[0] == section ]:
+                    del store[key]
+            cls.section_stats.pop(section, None)
+        cls.backend.destroySectionBeCarefulWhenYouCallThis(section)
+
+    @classmethod
+    def count_with(cls, section, key, value):
+        cls.flush()
+        return cls.backend.count_with(section, key, value)
+
+    @classmethod
+    def find_with(cls, section, key, value):
+        cls.flush()
+        return cls.backend.find_with(section, key, value)
+
+    @classmethod
+    def count_between(cls, section, start, end):
+        cls.flush()
+        return cls.backend.count_between(section, start, end)
+
+    @classmethod
+    def find_between(cls, section, start, end, limit=None, skip=None
+        , after=None
+        ):
+        cls.flush()
+        return cls.backend.find_between(section, start, end, limit, skip
+            , after
+            )
+
+    @classmethod
+    def setup(cls, conf):
+        backend = get_storage_class(conf.get('backend', 'sqlite3'))
+        if issubclass(backend, TieredStorage):
+            raise ValueError("The tiered backend cannot be tiered")
+
+        cls.shutdown()
+        cls.backend = backend
+        backend.setup(conf.get('backend_conf', {}))
+        cls.default_ttl = float(conf.get('ttl', 0))
+        cls.write_behind = float(conf.get('write_behind', 0))
+        if conf.get('invalidate'):
+            cls.bus = InvalidationBus(conf['invalidate'], cls._invalidate)
+        with cls.lock:
+            cls.l1.clear()
+            cls.pending.clear()
+            cls.versions.clear()
+            cls.section_stats.clear()
+
+        if cls.write_behind:
+            stop = threading.Event()
+            thread = threading.Thread(target=cls._flush_loop
+                , args=(stop, cls.write_behind)
+                )
+            thread.daemon = True
+            thread.start()
+            cls.flusher = (thread, stop)
+
+    @classmethod
+    def shutdown(cls):
+        """Stops write-behind, writes anything it held, and shuts the
+        backend down.
+        """
+        if cls.flusher is not None:
+            thread, stop = cls.flusher
+            cls.flusher = None
+            stop.set()
+            thread.join()
+        if cls.backend is not None:
+            cls.flush()
+            cls.backend.shutdown()
+        if cls.bus is not None:
+            cls.bus.close()
+            cls.bus = None
+
+    @classmethod
+    def flush(cls):
+        """Writes everything held by write-behind to the backend, in one
+        SlateBatch of its own (never one the calling thread has open).  
+        Returns the number of slates written.
+        """
+        with cls.flush_lock:
+            with cls.lock:
+                if not cls.pending:
+                    return 0
+                cls.flushing = cls.pending
+                cls.pending = OrderedDict()
+
+            try:
+                with SlateBatch.set_aside(), SlateBatch():
+                    for (section, id), write in cls.flushing.items():
+                        cls._write_held(section, id, write)
+            except:
+                #Keep the writes for the next flush
+                with cls.lock:
+                    pending = cls.flushing
+                    for key, write in cls.pending.items():
+                        old = pending.get(key)
+                        pending[key] = write if old is None else old.merge(
+                            write
+                            )
+                    cls.pending = pending
+                    cls.flushing = {}
+                raise
+
+            for section, id in cls.flushing.keys():
+                cls._publish(section, id)
+            with cls.lock:
+                count = len(cls.flushing)
+                cls.flushing = {}
+            log('Wrote {0} held slates'.format(count))
+            return count
+
+    @classmethod
+    def _write_held(cls, section, id, write):
+        l2 = cls.backend(section, id, write.timeout)
+        if write.clear:
+            l2.clear()
+        sets = dict([ (k, v) for k, v in write.fields.items()
+            if v is not missing
+            ])
+        if sets:
+            l2.update(sets)
+        for k, v in write.fields.items():
+            if v is missing:
+                l2.pop(k, None)
+        if not write.clear and not write.fields:
+            l2.touch()
+
+    @classmethod
+    def _publish(cls, section, id):
+        """Tells other processes that a slate changed, if it is in a 
+        cached section.
+        """
+        if cls.bus is None:
+            return
+        ttl = cls._get_section_config(section).get('cache_ttl'
+            , cls.default_ttl
+            )
+        if ttl:
+            cls.bus.publish(section, id)
+
+    @classmethod
+    def _invalidate(cls, section, id):
+        """Drops a slate changed by another process from the cache."""
+        with cls.lock:
+            cls._changed((section, id))
+            cls.l1.pop((section, id), None)
+
+    @classmethod
+    def _flush_loop(cls, stop, interval):
+        while True:
+            stop.wait(interval)
+            if stop.is_set():
+                return
+            try:
+                cls.flush()
+            except Exception as e:
+                log('Failed to write held slates: {0}'.format(e))
+
+    @classmethod
+    def clean_up(cls):
+        """Writes held writes, cleans up the backend, and drops cached
+        slates that are past their TTL.  Returns the backend's result.
+        """
+        cls.flush()
+        result = cls.backend.clean_up()
+        now = time.time()
+        with cls.lock:
+            for key, entry in list(cls.l1.items()):
+                ttl = cls._get_section_config(key[0]).get('cache_ttl'
+                    , cls.default_ttl
+                    )
+                if (
+                    now - entry.loaded >= ttl
+                    or entry.expiry is not None and entry.expiry < now
+                    ):
+                    del cls.l1[key]
+            floor = cls.versions_floor
+            for key, version in list(cls.versions.items()):
+                if version <= floor:
+                    del cls.versions[key]
+            cls.versions_floor = cls.version
+        return result
+
+    @classmethod
+    def get_stats(cls, section):
+        """Returns a dict of counters for section: hits and misses (reads
+        of a cached section served from memory, or not), cached (slates
+        held in memory) and pending (slates with writes held).
+        """
+        with cls.lock:
+            result = dict(cls.section_stats.get(section, {
+                'hits': 0, 'misses': 0
+                }))
+            result['cached'] = len([ k for k in cls.l1 if k[0] == section ])
+            result['pending'] = len([ k for k in cls.pending
+                if k[0] == section
+                ])
+        return result
+
+    @classmethod
+    def _changed(cls, key):
+        """Records a change to a slate.  Called with lock held."""
+        cls.version += 1
+        cls.versions[key] = cls.version
+
+    @classmethod
+    def _stats(cls, section):
+        """Returns section's counters.  Called with lock held."""
+        stats = cls.section_stats.get(section)
+        if stats is None:
+            stats = cls.section_stats[section] = { 'hits': 0, 'misses': 0 }
+        return stats
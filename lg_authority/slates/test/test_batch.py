@@ -0,0 +1,69 @@
+import unittest
+
+import cherrypy
+
+from lg_authority.common import config
+from lg_authority.slates import Slate
+from lg_authority.slates.batch import begin_request_batch, flush_request_batch
+from lg_authority.slates.batch import end_request_batch
+from lg_authority.slates.session import Session
+from lg_authority.slates.storage import get_storage_class
+
+class TestRequestBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.oldStorageClass = getattr(config, 'storage_class', None)
+        config.storage_class = get_storage_class('sqlite3')
+        config.storage_class.setup({ 'file': ':memory:' })
+
+    def tearDown(self):
+        end_request_batch()
+        config.storage_class = self.oldStorageClass
+
+    def test_flush(self):
+        begin_request_batch()
+        s = Slate('batch', 'a', timeout=60)
+        s['x'] = 1
+        s.update({ 'y': 2 })
+        self.assertEqual(1, Slate('batch', 'a')['x'])
+        flush_request_batch()
+        end_request_batch()
+
+        self.assertEqual({ 'x': 1, 'y': 2 }, Slate('batch', 'a').todict())
+
+    def test_failedRequest(self):
+        begin_request_batch()
+        Slate('batch', 'a', timeout=60)['x'] = 1
+        end_request_batch()
+
+        self.assertTrue(Slate('batch', 'a').is_expired())
+
+        # Later writes are not held
+        Slate('batch', 'a', timeout=60)['x'] = 2
+        self.assertEqual(2, Slate('batch', 'a')['x'])
+
+    def test_session(self):
+        begin_request_batch()
+        sess = Session(None, session_cookie='batch_session')
+        oldId = sess.id
+        sess['a'] = 1
+        sess.regen_id()
+        sess['b'] = 2
+        self.assertNotEqual(oldId, sess.id)
+        flush_request_batch()
+        end_request_batch()
+
+        sess2 = Session(sess.id, session_cookie='batch_session')
+        self.assertEqual(sess.id, sess2.id)
+        self.assertEqual({ 'a': 1, 'b': 2 }, sess2.todict())
+        self.assertTrue(Slate('batch_session', oldId).is_expired())
+
+    def test_slateBatch(self):
+        with Slate.batch():
+            a = Slate('batch', 'a', timeout=60)
+            a['x'] = 1
+            b = Slate('batch', 'b', timeout=60)
+            b['y'] = a['x']
+            self.assertEqual(1, Slate('batch', 'b')['y'])
+        self.assertEqual({ 'x': 1 }, Slate('batch', 'a').todict())
+        self.assertEqual({ 'y': 1 }, Slate('batch', 'b').todict())
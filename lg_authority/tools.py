@@ -99,9 +99,14 @@ class AuthTool(cherrypy.Tool):
 
         p = conf.pop('priority', 60) #Priority should be higher than session
                                      #priority, since we read the session.
+        if conf['site_storage_buffered']:
+            hooks.attach('before_request_body', slates.begin_request_batch, priority=p-20, **conf)
         if conf['override_sessions']:
             hooks.attach('before_request_body', slates.init_session, priority=p-10, **conf)
             hooks.attach('before_finalize', slates.send_session_cookie, priority=p, **conf)
+        if conf['site_storage_buffered']:
+            hooks.attach('before_finalize', slates.flush_request_batch, priority=p, **conf)
+            hooks.attach('on_end_request', slates.end_request_batch, **conf)
         hooks.attach('before_handler', self.check_auth, priority=p, **conf)
 
     def _setup_initialize(self, conf):
@@ -130,6 +135,12 @@ class AuthTool(cherrypy.Tool):
         log('Found: ' + str(config.storage_class))
         config.storage_class.setup(conf['site_storage_conf'])
 
+        #Release storage connections when the engine stops
+        if getattr(config, 'storage_shutdown', None) is not None:
+            cherrypy.engine.unsubscribe('stop', config.storage_shutdown)
+        config.storage_shutdown = config.storage_class.shutdown
+        cherrypy.engine.subscribe('stop', config.storage_shutdown)
+
         #Setup monitor thread...
         if getattr(config, 'storage_cleanup_thread', None) is not None:
             config.storage_cleanup_thread.stop()